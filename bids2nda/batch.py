@@ -0,0 +1,136 @@
+"""Conversion of many datasets in one process (``bids2nda batch``)
+
+A batch file lists the datasets to convert, one (bids_directory,
+guid_mapping, output_directory) row each, as a tab separated file with
+those column names.  The images of all datasets are converted by a single
+pool of worker processes, GUID mapping files used by several datasets are
+loaded once and parsed JSON sidecars are shared between datasets.
+
+A dataset which cannot be converted (missing participants.tsv, an image
+failing to convert...) is reported as failed without stopping the others;
+its image03.txt is only replaced once all of its images are converted.
+"""
+from __future__ import print_function
+import os
+from collections import namedtuple
+
+from .guid_mapping import load_guid_mapping
+from .image03 import Image03Writer
+from .main import (check_guid_mapping, ConversionContext, image03_record, ParticipantsIndex, read_tsv,
+                   SidecarResolver)
+from .metadata_zip import DEFAULT_ZIP_COMPRESSION
+
+BATCH_COLUMNS = ('bids_directory', 'guid_mapping', 'output_directory')
+
+BatchDataset = namedtuple("BatchDataset", BATCH_COLUMNS)
+
+# Outcome of the conversion of a dataset: number of images, error (None on success)
+BatchResult = namedtuple("BatchResult", ["dataset", "images", "error"])
+
+
+def read_batch_file(path):
+    """Return the BatchDataset listed in the batch file `path`"""
+    columns, rows = read_tsv(path)
+    missing = [column for column in BATCH_COLUMNS if column not in columns]
+    if missing:
+        raise ValueError("%s must have columns %s (missing %s)"
+                         % (path, ", ".join(BATCH_COLUMNS), ", ".join(missing)))
+    return [BatchDataset(*(row[column] for column in BATCH_COLUMNS)) for row in rows]
+
+
+def _batch_image03_record(contexts, task):
+    """Return (dataset number, record or None, error message or None) for a (dataset number, file) task"""
+    number, file = task
+    try:
+        return number, image03_record(contexts[number], file), None
+    except Exception as e:
+        return number, None, "Failed to process %s: %s: %s" % (file, type(e).__name__, e)
+
+
+# Conversion contexts of a worker process of the pool by dataset number, set up by _init_batch_worker
+_worker_contexts = None
+
+
+def _init_batch_worker(contexts):
+    global _worker_contexts
+    _worker_contexts = contexts
+
+
+def _worker_batch_image03_record(task):
+    return _batch_image03_record(_worker_contexts, task)
+
+
+def _prepare(dataset, strictness, zip_compression, guid_mappings, json_cache):
+    """Return the ConversionContext of a dataset, loading shared state through the given caches"""
+    guid_mapping_file = os.path.abspath(dataset.guid_mapping)
+    if guid_mapping_file not in guid_mappings:
+        guid_mappings[guid_mapping_file] = load_guid_mapping(guid_mapping_file)
+    guid_mapping = guid_mappings[guid_mapping_file]
+
+    participants = ParticipantsIndex(os.path.join(dataset.bids_directory, "participants.tsv"))
+    check_guid_mapping(participants, guid_mapping, strictness)
+    os.makedirs(dataset.output_directory, exist_ok=True)
+    context = ConversionContext(dataset.bids_directory, dataset.output_directory, guid_mapping, participants,
+                                zip_compression=zip_compression)
+    context.sidecar_resolver = SidecarResolver(dataset.bids_directory, context.index, json_cache)
+    participants.check('sub-' + context.entities(file)['sub'] for file in context.index.nifti_files())
+    return context
+
+
+def run_batch(datasets, jobs=1, strictness='strict', zip_compression=DEFAULT_ZIP_COMPRESSION):
+    """Convert `datasets` (BatchDataset), returning a BatchResult for each of them"""
+    results = {}
+    contexts = {}
+    guid_mappings = {}
+    json_cache = {}
+    for number, dataset in enumerate(datasets):
+        try:
+            contexts[number] = _prepare(dataset, strictness, zip_compression, guid_mappings, json_cache)
+        except Exception as e:
+            results[number] = BatchResult(dataset, 0, "%s: %s" % (type(e).__name__, e))
+
+    # images of all datasets, dataset after dataset
+    tasks = [(number, file) for number in sorted(contexts) for file in contexts[number].index.nifti_files()]
+    if jobs <= 1:
+        outputs = (_batch_image03_record(contexts, task) for task in tasks)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1, min(32, len(tasks) // (jobs * 4)))
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker, initargs=(contexts,))
+        outputs = executor.map(_worker_batch_image03_record, tasks, chunksize=chunksize)
+
+    writers = {}
+    errors = {}
+    try:
+        for number, record, error in outputs:
+            if error is not None:
+                errors.setdefault(number, error)
+            if number in errors:
+                continue
+            if number not in writers:
+                image03_file = os.path.join(datasets[number].output_directory, "image03.txt")
+                writers[number] = Image03Writer("%s.%d.tmp" % (image03_file, os.getpid()))
+            writers[number].write(record)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        for writer in writers.values():
+            writer.close()
+
+    for number in sorted(contexts):
+        dataset = datasets[number]
+        image03_file = os.path.join(dataset.output_directory, "image03.txt")
+        writer = writers.get(number)
+        if number in errors:
+            if writer is not None:
+                os.remove(writer.path)
+            results[number] = BatchResult(dataset, 0, errors[number])
+            continue
+        if writer is None:
+            # dataset without images
+            writer = Image03Writer("%s.%d.tmp" % (image03_file, os.getpid()))
+            writer.close()
+        os.replace(writer.path, image03_file)
+        results[number] = BatchResult(dataset, writer.rows, None)
+    return [results[number] for number in range(len(datasets))]
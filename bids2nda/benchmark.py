@@ -0,0 +1,288 @@
+"""Synthetic BIDS datasets and throughput benchmarks for bids2nda
+
+Generates a BIDS tree of configurable size made of header-only NIfTI files
+(no voxel data), inherited and per-run sidecars, scans.tsv, events and
+bval/bvec files, then times the conversion end to end and per stage
+(discovery, sidecars, headers, zips, output).  The time needed to import
+the command line module and to print its help, each in a fresh interpreter,
+is measured too so that startup regressions show up.  Results are written as
+JSON.
+
+Example::
+
+    python -m bids2nda.benchmark --subjects 50 --sessions 2 --runs 4 --output bench.json
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from .bids_index import BIDSIndex
+from .guid_mapping import load_guid_mapping
+from .image03 import Image03Writer
+from .main import ConversionContext, iter_records, ParticipantsIndex, run, SidecarResolver
+from .metadata_zip import write_metadata_zip
+from .nifti_header import read_nifti_header
+
+
+def write_header_only_nifti(path, shape, zooms, units=("mm", "sec")):
+    """Write a NIfTI-1 file holding only a header (no voxel data)"""
+    import nibabel as nb
+
+    hdr = nb.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_zooms(zooms)
+    hdr.set_xyzt_units(*units)
+    block = hdr.binaryblock + b"\0" * 4
+    if path.endswith(".gz"):
+        with gzip.open(path, "wb") as fp:
+            fp.write(block)
+    else:
+        with open(path, "wb") as fp:
+            fp.write(block)
+
+
+def _write_json(path, content):
+    with open(path, "w") as fp:
+        json.dump(content, fp, indent=4)
+
+
+def _write_tsv(path, header, rows):
+    with open(path, "w") as fp:
+        fp.write("\t".join(header) + "\n")
+        for row in rows:
+            fp.write("\t".join(str(value) for value in row) + "\n")
+
+
+def generate_dataset(bids_root, subjects=10, sessions=1, runs=2, tasks=("rest",), dwi=True):
+    """Generate a synthetic BIDS dataset and its GUID mapping file
+
+    Every subject (and session, unless `sessions` is 0) gets a T1w image,
+    `runs` bold runs of each task and, if `dwi`, a dwi image.  Bold sidecars
+    inherit from dataset level task-<task>_bold.json files.
+
+    Returns (path to the GUID mapping file, number of NIfTI images).
+    """
+    os.makedirs(bids_root, exist_ok=True)
+    _write_json(os.path.join(bids_root, "dataset_description.json"),
+                {"Name": "bids2nda synthetic benchmark", "BIDSVersion": "1.8.0"})
+    for task in tasks:
+        _write_json(os.path.join(bids_root, "task-%s_bold.json" % task),
+                    {"TaskName": task, "RepetitionTime": 2.0, "EchoTime": 0.03, "FlipAngle": 52,
+                     "Manufacturer": "Siemens", "ManufacturersModelName": "Prisma",
+                     "MagneticFieldStrength": 3, "SliceTiming": [0.0, 0.5, 1.0, 1.5]})
+        _write_tsv(os.path.join(bids_root, "task-%s_events.tsv" % task),
+                   ["onset", "duration", "trial_type"], [(0, 10, "rest")])
+
+    subject_ids = ["%04d" % (i + 1) for i in range(subjects)]
+    _write_tsv(os.path.join(bids_root, "participants.tsv"), ["participant_id", "sex", "age"],
+               [("sub-" + sub, "MF"[i % 2], 20 + i % 50) for i, sub in enumerate(subject_ids)])
+    guid_mapping = os.path.join(os.path.dirname(os.path.abspath(bids_root)),
+                                os.path.basename(os.path.abspath(bids_root)) + "_guid_mapping.txt")
+    with open(guid_mapping, "w") as fp:
+        for sub in subject_ids:
+            fp.write("sub-%s - NDAR_INV%s\n" % (sub, sub.zfill(8)))
+
+    n_images = 0
+    for sub in subject_ids:
+        for ses in (["%d" % (i + 1) for i in range(sessions)] or [None]):
+            if ses is None:
+                session_dir = os.path.join(bids_root, "sub-" + sub)
+                prefix = "sub-" + sub
+            else:
+                session_dir = os.path.join(bids_root, "sub-" + sub, "ses-" + ses)
+                prefix = "sub-%s_ses-%s" % (sub, ses)
+            scans = []
+
+            os.makedirs(os.path.join(session_dir, "anat"), exist_ok=True)
+            fname = os.path.join("anat", prefix + "_T1w.nii.gz")
+            write_header_only_nifti(os.path.join(session_dir, fname), (176, 256, 256), (1.0, 1.0, 1.0))
+            _write_json(os.path.join(session_dir, "anat", prefix + "_T1w.json"),
+                        {"Manufacturer": "Siemens", "ImageOrientationPatientDICOM": [1, 0, 0, 0, 1, 0]})
+            scans.append(fname)
+
+            os.makedirs(os.path.join(session_dir, "func"), exist_ok=True)
+            for task in tasks:
+                for run_idx in range(1, runs + 1):
+                    stem = "%s_task-%s_run-%d" % (prefix, task, run_idx)
+                    fname = os.path.join("func", stem + "_bold.nii.gz")
+                    write_header_only_nifti(os.path.join(session_dir, fname), (64, 64, 36, 200),
+                                            (3.0, 3.0, 3.3, 2.0))
+                    _write_json(os.path.join(session_dir, "func", stem + "_bold.json"),
+                                {"AcquisitionTime": "10:%02d:00" % run_idx})
+                    _write_tsv(os.path.join(session_dir, "func", stem + "_events.tsv"),
+                               ["onset", "duration", "trial_type"], [(0, 2, "a"), (10, 2, "b")])
+                    scans.append(fname)
+
+            if dwi:
+                os.makedirs(os.path.join(session_dir, "dwi"), exist_ok=True)
+                fname = os.path.join("dwi", prefix + "_dwi.nii.gz")
+                write_header_only_nifti(os.path.join(session_dir, fname), (96, 96, 60, 65), (2.0, 2.0, 2.0, 1.0))
+                with open(os.path.join(session_dir, "dwi", prefix + "_dwi.bval"), "w") as fp:
+                    fp.write(" ".join(["0"] + ["1000"] * 64) + "\n")
+                with open(os.path.join(session_dir, "dwi", prefix + "_dwi.bvec"), "w") as fp:
+                    fp.write("\n".join(" ".join(["0"] * 65) for _ in range(3)) + "\n")
+                scans.append(fname)
+
+            _write_tsv(os.path.join(session_dir, prefix + "_scans.tsv"), ["filename", "acq_time"],
+                       [(fname.replace(os.sep, "/"), "2020-01-%02dT10:00:00" % (1 + int(ses or 0) % 28))
+                        for fname in scans])
+            n_images += len(scans)
+    return guid_mapping, n_images
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _stage_result(seconds, n_files):
+    return {"seconds": seconds,
+            "files": n_files,
+            "files_per_second": n_files / seconds if seconds > 0 else None}
+
+
+def benchmark_stages(bids_root, guid_mapping, output_directory):
+    """Time the conversion stages separately over all images of a dataset"""
+    stages = {}
+    seconds, index = _timed(BIDSIndex, bids_root)
+    nifti_files = index.nifti_files()
+    stages["discovery"] = _stage_result(seconds, len(nifti_files))
+
+    resolver = SidecarResolver(bids_root, index)
+    seconds, metadata = _timed(lambda: [resolver.get_metadata(file) for file in nifti_files])
+    stages["sidecars"] = _stage_result(seconds, len(nifti_files))
+
+    seconds, _ = _timed(lambda: [read_nifti_header(file) for file in nifti_files])
+    stages["headers"] = _stage_result(seconds, len(nifti_files))
+
+    os.makedirs(output_directory, exist_ok=True)
+
+    def write_zips():
+        for file, file_metadata in zip(nifti_files, metadata):
+            zip_path = os.path.join(output_directory, os.path.basename(file).split(".")[0] + ".metadata.zip")
+            write_metadata_zip(zip_path, [("sidecar.json", json.dumps(file_metadata).encode())])
+
+    seconds, _ = _timed(write_zips)
+    stages["zips"] = _stage_result(seconds, len(nifti_files))
+
+    context = ConversionContext(bids_root, output_directory, load_guid_mapping(guid_mapping),
+                                ParticipantsIndex(os.path.join(bids_root, "participants.tsv")), index=index)
+    records = list(iter_records(context, nifti_files))
+
+    def write_output():
+        with Image03Writer(os.path.join(output_directory, "image03.txt")) as writer:
+            for record in records:
+                writer.write(record)
+
+    seconds, _ = _timed(write_output)
+    stages["output"] = _stage_result(seconds, len(nifti_files))
+    return stages
+
+
+# Dependencies which only the stages needing them may import
+HEAVY_MODULES = ("numpy", "pandas", "nibabel")
+
+_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import bids2nda.main
+seconds = time.perf_counter() - start
+print(seconds, ",".join(m for m in %r if m in sys.modules))
+""" % (HEAVY_MODULES,)
+
+
+def benchmark_startup(repeat=5):
+    """Time importing bids2nda.main and running ``--help``, each in a fresh interpreter (best of `repeat`)"""
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_parent, env.get("PYTHONPATH")]))
+
+    import_seconds, help_seconds = [], []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", _STARTUP_SCRIPT], env=env,
+                                         universal_newlines=True)
+        seconds, heavy = output.split(" ", 1)
+        import_seconds.append(float(seconds))
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-m", "bids2nda.main", "--help"], env=env,
+                              stdout=subprocess.DEVNULL)
+        help_seconds.append(time.perf_counter() - start)
+    return {"import_seconds": min(import_seconds),
+            "help_seconds": min(help_seconds),
+            "heavy_modules_imported": [name for name in heavy.strip().split(",") if name]}
+
+
+def run_benchmark(bids_root, guid_mapping, output_directory, jobs=1, repeat=1):
+    """Time run() end to end (best of `repeat`) and every stage; return the results as a dict"""
+    args = argparse.Namespace(bids_directory=bids_root, guid_mapping=guid_mapping,
+                              output_directory=output_directory, strictness='strict', jobs=jobs)
+    timings = []
+    for _ in range(repeat):
+        shutil.rmtree(output_directory, ignore_errors=True)
+        timings.append(_timed(run, args)[0])
+    n_images = len(BIDSIndex(bids_root).nifti_files())
+
+    stages_directory = output_directory.rstrip(os.sep) + "_stages"
+    shutil.rmtree(stages_directory, ignore_errors=True)
+    stages = benchmark_stages(bids_root, guid_mapping, stages_directory)
+    shutil.rmtree(stages_directory, ignore_errors=True)
+
+    end_to_end = _stage_result(min(timings), n_images)
+    end_to_end["all_seconds"] = timings
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "jobs": jobs,
+            "end_to_end": end_to_end,
+            "stages": stages,
+            "startup": benchmark_startup()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bids2nda on a synthetic BIDS dataset.")
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=1,
+                        help="Sessions per subject, 0 for datasets without session level")
+    parser.add_argument("--runs", type=int, default=2, help="Bold runs per task and session")
+    parser.add_argument("--tasks", nargs="+", default=["rest"])
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="Number of end to end runs (best is reported)")
+    parser.add_argument("--work-directory",
+                        help="Where to generate the dataset and outputs (kept); a temporary directory "
+                             "removed afterwards by default")
+    parser.add_argument("--output", help="JSON file to write the results to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix="bids2nda-benchmark-")
+    try:
+        bids_root = os.path.join(work_directory, "bids")
+        seconds, (guid_mapping, n_images) = _timed(
+            generate_dataset, bids_root, subjects=args.subjects, sessions=args.sessions,
+            runs=args.runs, tasks=args.tasks)
+        results = run_benchmark(bids_root, guid_mapping, os.path.join(work_directory, "nda"),
+                                jobs=args.jobs, repeat=args.repeat)
+        results["dataset"] = {"subjects": args.subjects, "sessions": args.sessions, "runs": args.runs,
+                              "tasks": args.tasks, "images": n_images, "generation_seconds": seconds}
+    finally:
+        if not args.work_directory:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
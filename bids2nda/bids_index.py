@@ -0,0 +1,186 @@
+"""In-memory index of the files of a BIDS dataset
+
+The dataset is listed once with ``os.scandir`` (dataset root, subject,
+session and datatype directories); afterwards checking whether a sidecar,
+scans.tsv, events or bval/bvec file exists is a set lookup instead of a
+``stat`` call on the file system.
+
+Discovery can be restricted to some subjects (by label or to a shard of
+all subjects) and sessions; directories outside the selection are then not
+listed at all.  It can also be restricted to images with some suffixes.
+"""
+import os
+
+from .nifti_header import NIFTI_EXTENSIONS
+
+
+def parse_entities(filename):
+    """Parse a BIDS filename into its entities
+
+    Returns a dict with one item per key-value entity (e.g. 'sub', 'ses',
+    'task', 'acq', 'run') plus 'suffix' and 'extension' (None and '' when
+    the filename has none).
+
+    >>> parse_entities("sub-01_ses-1_task-rest_run-2_bold.nii.gz")["run"]
+    '2'
+    """
+    name, dot, extension = filename.partition(".")
+    parts = name.split("_")
+    entities = {'suffix': None, 'extension': dot + extension}
+    if parts and "-" not in parts[-1]:
+        entities['suffix'] = parts.pop()
+    for part in parts:
+        key, _, value = part.partition("-")
+        entities[key] = value
+    return entities
+
+
+def parse_shard(shard):
+    """Parse an "I/N" shard specification (1 <= I <= N) into an (I, N) tuple
+
+    >>> parse_shard("2/8")
+    (2, 8)
+    """
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError("Invalid shard %r, expected I/N e.g. 1/4" % shard)
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard %r, I must be between 1 and N" % shard)
+    return index, count
+
+
+def _strip_prefix(label, prefix):
+    return label[len(prefix):] if label.startswith(prefix) else label
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as it:
+            return sorted((entry.name, entry.is_dir()) for entry in it if not entry.name.startswith("."))
+    except OSError:
+        return []
+
+
+class BIDSIndex(object):
+    """Listing of a BIDS dataset down to its datatype directories
+
+    Files directly in the dataset root, in ``sub-*`` and ``sub-*/ses-*``
+    directories and in the directories below those (``anat``, ``func``...)
+    are indexed.
+
+    `participant_labels` and `session_labels` (with or without the 'sub-'
+    and 'ses-' prefixes) restrict the index to those subjects and sessions,
+    and `shard` ((I, N), see parse_shard()) to every Nth subject directory
+    starting from the Ith, in sorted order.  With `session_labels`, images
+    outside of a session directory are left out.  `suffixes` (e.g. 'bold',
+    'T1w') restrict the NIfTI files to those with one of these suffixes;
+    all other files are still indexed, as sidecars may be shared.
+    """
+
+    def __init__(self, bids_root, participant_labels=None, session_labels=None, shard=None, suffixes=None):
+        self.bids_root = bids_root
+        self.participant_labels = None
+        if participant_labels is not None:
+            self.participant_labels = set(_strip_prefix(label, "sub-") for label in participant_labels)
+        self.session_labels = None
+        if session_labels is not None:
+            self.session_labels = set(_strip_prefix(label, "ses-") for label in session_labels)
+        self.shard = shard
+        self.suffixes = None if suffixes is None else set(suffixes)
+        self.subjects = []
+        self.files = set()
+        self.nifti = []
+        self._entities = {}
+        self._scan()
+
+    @property
+    def filtered(self):
+        """True if only part of the dataset is indexed"""
+        return (self.participant_labels is not None or self.session_labels is not None or self.shard is not None
+                or self.suffixes is not None)
+
+    def selects(self, path):
+        """Return True if the NIfTI file at `path` (of this dataset, indexed or not) is in the selection
+
+        E.g. to tell which rows of the image03 table of the whole dataset
+        the conversion of this selection replaces.
+        """
+        entities = parse_entities(os.path.basename(path))
+        if entities.get('sub') not in self._subject_set:
+            return False
+        if self.session_labels is not None and entities.get('ses') not in self.session_labels:
+            return False
+        return self.suffixes is None or entities['suffix'] in self.suffixes
+
+    def _select_subjects(self, root_entries):
+        subject_dirs = [name for name, is_dir in root_entries if is_dir and name.startswith("sub-")]
+        if self.participant_labels is not None:
+            subject_dirs = [name for name in subject_dirs if name[4:] in self.participant_labels]
+        if self.shard is not None:
+            index, count = self.shard
+            subject_dirs = subject_dirs[index - 1::count]
+        return subject_dirs
+
+    def _select_directory(self, name):
+        if self.session_labels is None:
+            return True
+        return name.startswith("ses-") and name[4:] in self.session_labels
+
+    def _add_files(self, directory, entries):
+        for name, is_dir in entries:
+            if not is_dir:
+                self.files.add(os.path.join(directory, name))
+
+    def _add_nifti(self, directory, entries, in_session):
+        for name, is_dir in entries:
+            if is_dir or not name.startswith("sub-") or not name.endswith(NIFTI_EXTENSIONS):
+                continue
+            if in_session and "_ses-" not in name:
+                continue
+            if self.suffixes is not None and parse_entities(name)['suffix'] not in self.suffixes:
+                continue
+            self.nifti.append(os.path.join(directory, name))
+
+    def _scan(self):
+        root_entries = _scandir(self.bids_root)
+        self._add_files(self.bids_root, root_entries)
+        for sub_name in self._select_subjects(root_entries):
+            self.subjects.append(sub_name[4:])
+            sub_dir = os.path.join(self.bids_root, sub_name)
+            sub_entries = _scandir(sub_dir)
+            self._add_files(sub_dir, sub_entries)
+            for name, is_dir in sub_entries:
+                if not is_dir or not self._select_directory(name):
+                    continue
+                directory = os.path.join(sub_dir, name)
+                entries = _scandir(directory)
+                self._add_files(directory, entries)
+                # sub-*/*/sub-*.nii[.gz]
+                self._add_nifti(directory, entries, in_session=False)
+                if not name.startswith("ses-"):
+                    continue
+                for datatype, is_dir in entries:
+                    if not is_dir:
+                        continue
+                    datatype_dir = os.path.join(directory, datatype)
+                    datatype_entries = _scandir(datatype_dir)
+                    self._add_files(datatype_dir, datatype_entries)
+                    # sub-*/ses-*/*/sub-*_ses-*.nii[.gz]
+                    self._add_nifti(datatype_dir, datatype_entries, in_session=True)
+        self.nifti.sort()
+        self._subject_set = set(self.subjects)
+
+    def exists(self, path):
+        """Return True if `path` is an indexed file"""
+        return path in self.files
+
+    def nifti_files(self):
+        """Return the subject (and session) level NIfTI files, sorted by path"""
+        return list(self.nifti)
+
+    def entities(self, path):
+        """Return the (cached) parse_entities() of the file at `path`"""
+        if path not in self._entities:
+            self._entities[path] = parse_entities(os.path.basename(path))
+        return self._entities[path]
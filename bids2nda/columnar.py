@@ -0,0 +1,180 @@
+"""Typed columnar (Parquet or Arrow IPC) copies of the image03 table
+
+The image03 text format has no types: once written, extents, resolutions
+and repetition times are strings.  An Image03ColumnarWriter writes the same
+rows with a typed schema (integers, floats, a list of floats for
+slice_timing and strings for everything else), one row group per
+`row_group_size` records so that it can follow a streaming conversion.
+Dictionary encoding and compression make the many always empty columns
+almost free.
+
+pyarrow is an optional dependency (``pip install bids2nda[parquet]``), only
+imported when a writer is created.
+"""
+from __future__ import print_function
+import sys
+from collections import Counter
+
+from .image03 import IMAGE03_COLUMNS
+
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
+# File extension of each format, replacing the .txt of the image03 file
+COLUMNAR_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+INT_COLUMNS = frozenset([
+    'interview_age',
+    'image_num_dimensions',
+    'image_extent1',
+    'image_extent2',
+    'image_extent3',
+    'image_extent4',
+])
+
+FLOAT_COLUMNS = frozenset([
+    'magnetic_field_strength',
+    'mri_echo_time_pd',
+    'flip_angle',
+    'image_resolution1',
+    'image_resolution2',
+    'image_resolution3',
+    'image_slice_thickness',
+    'image_resolution4',
+    'mri_repetition_time_pd',
+])
+
+FLOAT_LIST_COLUMNS = frozenset([
+    'slice_timing',
+])
+
+DEFAULT_ROW_GROUP_SIZE = 4096
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError("Parquet and Arrow output require pyarrow, install it with "
+                           "'pip install pyarrow'")
+    return pyarrow
+
+
+def image03_schema():
+    """Return the pyarrow schema of the image03 table"""
+    pa = _import_pyarrow()
+
+    def column_type(column):
+        if column in INT_COLUMNS:
+            return pa.int64()
+        if column in FLOAT_COLUMNS:
+            return pa.float64()
+        if column in FLOAT_LIST_COLUMNS:
+            return pa.list_(pa.float64())
+        return pa.string()
+
+    return pa.schema([(column, column_type(column)) for column in IMAGE03_COLUMNS])
+
+
+def _to_float(value):
+    # through str() as in image03.txt, so that float32 header values are
+    # stored as the decimal number written there (1.1, not 1.100000023841858)
+    return float(str(value))
+
+
+def _to_int(value):
+    number = _to_float(value)
+    if not number.is_integer():
+        raise ValueError(value)
+    return int(number)
+
+
+def _to_float_list(value):
+    if isinstance(value, str):
+        raise ValueError(value)
+    return [_to_float(item) for item in value]
+
+
+class Image03ColumnarWriter(object):
+    """Write image03 records to a Parquet or Arrow IPC file, in row groups
+
+    Values of typed columns which are empty are written as nulls; values
+    which cannot be converted are written as nulls too, and reported (per
+    column) when the writer is closed.
+    """
+
+    def __init__(self, path, output_format='parquet', row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        if output_format not in COLUMNAR_FORMATS:
+            raise ValueError("Unknown output format %r, must be one of %s"
+                             % (output_format, ", ".join(COLUMNAR_FORMATS)))
+        self._pa = _import_pyarrow()
+        self.path = path
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.schema = image03_schema()
+        self.rows = 0
+        self.invalid = Counter()
+        self._columns = {column: [] for column in IMAGE03_COLUMNS}
+        self._converters = {column: self._converter(column) for column in IMAGE03_COLUMNS}
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(path, self.schema, compression='zstd', use_dictionary=True)
+        else:
+            import pyarrow.ipc as ipc
+            self._writer = ipc.new_file(path, self.schema,
+                                        options=ipc.IpcWriteOptions(compression='zstd'))
+
+    def _converter(self, column):
+        if column in INT_COLUMNS:
+            return _to_int
+        if column in FLOAT_COLUMNS:
+            return _to_float
+        if column in FLOAT_LIST_COLUMNS:
+            return _to_float_list
+        return str
+
+    def _convert(self, column, value):
+        converter = self._converters[column]
+        if converter is str:
+            return "" if value is None else str(value)
+        if value is None or (isinstance(value, str) and value == ""):
+            return None
+        try:
+            return converter(value)
+        except (TypeError, ValueError):
+            self.invalid[column] += 1
+            return None
+
+    def write(self, record):
+        for column in IMAGE03_COLUMNS:
+            self._columns[column].append(self._convert(column, record.get(column, "")))
+        self.rows += 1
+        if len(self._columns[IMAGE03_COLUMNS[0]]) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._columns[IMAGE03_COLUMNS[0]]:
+            return
+        batch = self._pa.RecordBatch.from_arrays(
+            [self._pa.array(self._columns[field.name], type=field.type) for field in self.schema],
+            schema=self.schema)
+        if self.output_format == 'parquet':
+            self._writer.write_table(self._pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        for values in self._columns.values():
+            del values[:]
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+        for column, count in sorted(self.invalid.items()):
+            print("WARNING: %d values of column %s are not numbers and were written as nulls to %s"
+                  % (count, column, self.path), file=sys.stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,357 @@
+"""Check that optimized conversions produce the same output as the reference one
+
+The reference conversion, reference_run(), reads its inputs the way the
+original converter did: NIfTI headers with nibabel (``nb.load``),
+participants.tsv and the scans.tsv files with ``pandas.read_csv``, and it
+writes image03.txt at the end from a DataFrame of all records.  The default
+conversion and every variant enabling performance options (worker
+processes, prefetching, the incremental cache, cold and warm...) are run
+over the same dataset into their own output directory, and their output is
+compared with the reference one:
+
+* image03.txt cell by cell and in row order, numbers (see the typed
+  columns of bids2nda.columnar) compared with a relative tolerance, paths
+  into the output directory compared relative to it;
+* the metadata zips member by member, JSON members compared as parsed
+  JSON (with the same tolerance for numbers), other members byte for byte.
+
+The only difference expected between the reference and the other outputs
+is the formatting of the float32 voxel sizes taken from the NIfTI header:
+pandas writes float32 columns with their float64 digits (e.g.
+1.100000023841858) where image03.txt has ``str()`` of the float32 (1.1).
+Reference cells of the ZOOM_COLUMNS are normalized to the latter before
+they are compared.
+
+Example, on a synthetic dataset or on a real one::
+
+    python -m bids2nda.equivalence --subjects 20 --sessions 2
+    python -m bids2nda.equivalence --bids-directory BIDS --guid-mapping GUIDS --work-directory /tmp/eq
+"""
+from __future__ import print_function
+import argparse
+import ast
+import csv
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from collections import OrderedDict, namedtuple
+
+from .columnar import FLOAT_COLUMNS, FLOAT_LIST_COLUMNS, INT_COLUMNS
+from .guid_mapping import load_guid_mapping
+from .image03 import IMAGE03_COLUMNS, IMAGE03_HEADER, read_image03
+from .main import (ConversionContext, ImageInputs, check_guid_mapping, discover_nifti_files, events_file_candidates,
+                   get_metadata_for_nifti, image03_record, run)
+from .nifti_header import NiftiHeaderRecord
+
+DEFAULT_REL_TOL = 1e-6
+
+# name -> (run() options, number of runs into the same output directory; the
+# last one is compared, e.g. the second, warm, run of an incremental conversion)
+VARIANTS = {
+    'jobs': ({'jobs': 2}, 1),
+    'prefetch': ({'prefetch': 8}, 1),
+    'incremental-cold': ({'incremental': True}, 1),
+    'incremental-warm': ({'incremental': True}, 2),
+    'all': ({'jobs': 2, 'prefetch': 8, 'incremental': True}, 2),
+    'default': ({}, 1),
+}
+
+# image03.txt columns holding float32 NIfTI header values (voxel sizes), see
+# normalize_zoom()
+ZOOM_COLUMNS = frozenset(['image_resolution1', 'image_resolution2', 'image_resolution3', 'image_resolution4',
+                          'image_slice_thickness', 'mri_repetition_time_pd'])
+
+# A cell, zip member or file differing between the reference and a candidate
+# output.  `where` locates it, e.g. "image03.txt row 3 (sub-01_T1w.nii.gz) column flip_angle"
+Difference = namedtuple("Difference", ["where", "reference", "candidate"])
+
+
+def numbers_equal(reference, candidate, rel_tol=DEFAULT_REL_TOL):
+    return math.isclose(reference, candidate, rel_tol=rel_tol, abs_tol=rel_tol * 1e-3)
+
+
+def cells_equal(column, reference, candidate, rel_tol=DEFAULT_REL_TOL):
+    """Return whether two image03.txt cells (str) of `column` are equivalent"""
+    if reference == candidate:
+        return True
+    try:
+        if column in INT_COLUMNS or column in FLOAT_COLUMNS:
+            return numbers_equal(float(reference), float(candidate), rel_tol)
+        if column in FLOAT_LIST_COLUMNS:
+            reference, candidate = ast.literal_eval(reference), ast.literal_eval(candidate)
+            return (len(reference) == len(candidate)
+                    and all(numbers_equal(float(r), float(c), rel_tol) for r, c in zip(reference, candidate)))
+    except (TypeError, ValueError, SyntaxError):
+        pass
+    return False
+
+
+def json_equal(reference, candidate, rel_tol=DEFAULT_REL_TOL):
+    """Return whether two parsed JSON values are equal, numbers (not booleans) up to `rel_tol`"""
+    if isinstance(reference, bool) or isinstance(candidate, bool):
+        return reference is candidate
+    if isinstance(reference, (int, float)) and isinstance(candidate, (int, float)):
+        return numbers_equal(reference, candidate, rel_tol)
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        return (reference.keys() == candidate.keys()
+                and all(json_equal(reference[key], candidate[key], rel_tol) for key in reference))
+    if isinstance(reference, list) and isinstance(candidate, list):
+        return (len(reference) == len(candidate)
+                and all(json_equal(r, c, rel_tol) for r, c in zip(reference, candidate)))
+    return reference == candidate
+
+
+def normalize_zoom(value):
+    """Return a reference image03.txt cell of ZOOM_COLUMNS as image03.txt writes it
+
+    The float32 value pandas wrote with its float64 digits is written as
+    ``str()`` of the float32, e.g. '1.100000023841858' -> '1.1'.  Other
+    values (empty cells, sidecar values) are returned unchanged.
+    """
+    import numpy as np
+
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    float32 = np.float32(number)
+    if float(float32) != number:
+        return value
+    return str(float32)
+
+
+def _relative(value, directory):
+    prefix = directory.rstrip(os.sep) + os.sep
+    return value.replace(prefix, "<output>" + os.sep)
+
+
+def compare_image03(reference_file, candidate_file, rel_tol=DEFAULT_REL_TOL):
+    """Return the list of Difference between two image03.txt files
+
+    Paths into the directory of either file are compared relative to it.
+    """
+    reference_directory = os.path.dirname(os.path.abspath(reference_file))
+    candidate_directory = os.path.dirname(os.path.abspath(candidate_file))
+    reference_rows = list(read_image03(reference_file))
+    candidate_rows = list(read_image03(candidate_file))
+
+    differences = []
+    if len(reference_rows) != len(candidate_rows):
+        differences.append(Difference("image03.txt number of rows", len(reference_rows), len(candidate_rows)))
+    for number, (reference, candidate) in enumerate(zip(reference_rows, candidate_rows), 1):
+        if reference['image_file'] != candidate['image_file']:
+            differences.append(Difference("image03.txt row %d image_file (row order)" % number,
+                                          reference['image_file'], candidate['image_file']))
+            continue
+        for column, value in reference.items():
+            reference_value = _relative(value, reference_directory)
+            if column in ZOOM_COLUMNS:
+                reference_value = normalize_zoom(reference_value)
+            candidate_value = _relative(candidate.get(column, ""), candidate_directory)
+            if not cells_equal(column, reference_value, candidate_value, rel_tol):
+                differences.append(Difference("image03.txt row %d (%s) column %s"
+                                              % (number, os.path.basename(reference['image_file']), column),
+                                              reference_value, candidate_value))
+    return differences
+
+
+def compare_zip(reference_file, candidate_file, rel_tol=DEFAULT_REL_TOL):
+    """Return the list of Difference between the members of two zip files"""
+    name = os.path.basename(reference_file)
+    with zipfile.ZipFile(reference_file) as reference, zipfile.ZipFile(candidate_file) as candidate:
+        if reference.namelist() != candidate.namelist():
+            return [Difference("%s members" % name, reference.namelist(), candidate.namelist())]
+        differences = []
+        for member in reference.namelist():
+            reference_content, candidate_content = reference.read(member), candidate.read(member)
+            if reference_content == candidate_content:
+                continue
+            if member.endswith(".json"):
+                try:
+                    if json_equal(json.loads(reference_content.decode("utf-8")),
+                                  json.loads(candidate_content.decode("utf-8")), rel_tol):
+                        continue
+                except ValueError:
+                    pass
+            differences.append(Difference("%s member %s" % (name, member),
+                                          "%d bytes" % len(reference_content), "%d bytes" % len(candidate_content)))
+        return differences
+
+
+def compare_outputs(reference_directory, candidate_directory, rel_tol=DEFAULT_REL_TOL):
+    """Return the list of Difference between the image03.txt and metadata zips of two output directories"""
+    differences = compare_image03(os.path.join(reference_directory, "image03.txt"),
+                                  os.path.join(candidate_directory, "image03.txt"), rel_tol)
+
+    def zips(directory):
+        return set(name for name in os.listdir(directory) if name.endswith(".metadata.zip"))
+
+    reference_zips, candidate_zips = zips(reference_directory), zips(candidate_directory)
+    if reference_zips != candidate_zips:
+        differences.append(Difference("metadata zips only in one output",
+                                      sorted(reference_zips - candidate_zips),
+                                      sorted(candidate_zips - reference_zips)))
+    for name in sorted(reference_zips & candidate_zips):
+        differences.extend(compare_zip(os.path.join(reference_directory, name),
+                                       os.path.join(candidate_directory, name), rel_tol))
+    return differences
+
+
+class _ReferenceParticipants(object):
+    """participants.tsv read with pandas.read_csv, looked up as the original converter did"""
+
+    def __init__(self, participants_file):
+        import pandas as pd
+
+        self.participants_file = participants_file
+        self.participants_df = pd.read_csv(participants_file, header=0, sep="\t")
+        self.participant_ids = list(self.participants_df['participant_id'])
+
+    def check(self, participant_ids):
+        pass
+
+    def fields(self, participant_id):
+        participants_df = self.participants_df
+        this_subj = participants_df[participants_df.participant_id == participant_id]
+        if this_subj.shape[0] == 0:
+            raise Exception(f"{self.participants_file} must have row with participant_id = '{participant_id}'")
+        return int(round(list(this_subj.age)[0]*12, 0)), list(this_subj.sex)[0]
+
+
+class _ReferenceContext(ConversionContext):
+    """A ConversionContext reading every scans.tsv with pandas.read_csv, for every image"""
+
+    def scan_date(self, file, sub, ses):
+        import pandas as pd
+
+        scans_file = self.scans_file(sub, ses)
+        scans_df = pd.read_csv(scans_file, header=0, sep="\t")
+        for (_, row) in scans_df.iterrows():
+            if file.endswith(row["filename"].replace("/", os.sep)):
+                sdate = row.acq_time.split("-")
+                return sdate[1] + "/" + sdate[2].split("T")[0] + "/" + sdate[0]
+        raise Exception(f"{scans_file} has no row for {file}")
+
+
+def _reference_inputs(context, file):
+    import nibabel as nb
+
+    nii = nb.load(file)
+    header = NiftiHeaderRecord(shape=tuple(nii.shape), zooms=tuple(nii.header.get_zooms()),
+                               xyzt_units=tuple(nii.header.get_xyzt_units()))
+    events = None
+    if context.entities(file)['suffix'] == "bold":
+        events_files = events_file_candidates(context.bids_directory, file, context.entities(file))
+        for events_file in events_files:
+            if os.path.exists(events_file):
+                with open(events_file, "rb") as fp:
+                    events = (os.path.basename(events_files[0]), fp.read())
+                break
+    return ImageInputs(get_metadata_for_nifti(context.bids_directory, file), header, events)
+
+
+def reference_run(bids_root, guid_mapping, output_directory):
+    """Convert a dataset the straightforward way, into `output_directory`
+
+    Inputs are read as the original converter did (see the module
+    docstring): one image after the other, the NIfTI header with nibabel,
+    participants.tsv and the scans.tsv of every image with pandas, and
+    image03.txt is written at the end from a DataFrame of all records.
+    """
+    import pandas as pd
+
+    os.makedirs(output_directory, exist_ok=True)
+    guid_mapping = load_guid_mapping(guid_mapping)
+    participants = _ReferenceParticipants(os.path.join(bids_root, "participants.tsv"))
+    check_guid_mapping(participants, guid_mapping)
+    context = _ReferenceContext(bids_root, output_directory, guid_mapping, participants)
+
+    image03_dict = OrderedDict((column, []) for column in IMAGE03_COLUMNS)
+    for file in discover_nifti_files(bids_root, context.index):
+        record = image03_record(context, file, _reference_inputs(context, file))
+        for column in IMAGE03_COLUMNS:
+            image03_dict[column].append(record.get(column, ""))
+    image03_df = pd.DataFrame(image03_dict)
+
+    with open(os.path.join(output_directory, "image03.txt"), "w") as out_fp:
+        out_fp.write(IMAGE03_HEADER)
+        image03_df.to_csv(out_fp, sep="\t", index=False, quoting=csv.QUOTE_ALL, lineterminator="\n")
+
+
+def _run(bids_root, guid_mapping, output_directory, options, runs=1):
+    shutil.rmtree(output_directory, ignore_errors=True)
+    args = argparse.Namespace(bids_directory=bids_root, guid_mapping=guid_mapping,
+                              output_directory=output_directory, strictness='strict', jobs=1)
+    for option, value in options.items():
+        setattr(args, option, value)
+    for _ in range(runs):
+        run(args)
+
+
+def check_equivalence(bids_root, guid_mapping, work_directory, variants=None, rel_tol=DEFAULT_REL_TOL):
+    """Convert the dataset with reference_run() and every variant; return {variant: [Difference]}
+
+    `variants` are names of VARIANTS (all of them by default).  Outputs are
+    written into subdirectories of `work_directory`.
+    """
+    reference_directory = os.path.join(work_directory, "reference")
+    shutil.rmtree(reference_directory, ignore_errors=True)
+    reference_run(bids_root, guid_mapping, reference_directory)
+    results = {}
+    for variant in variants or sorted(VARIANTS):
+        options, runs = VARIANTS[variant]
+        candidate_directory = os.path.join(work_directory, variant)
+        _run(bids_root, guid_mapping, candidate_directory, options, runs)
+        results[variant] = compare_outputs(reference_directory, candidate_directory, rel_tol)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check that the conversion, with and without performance options, produces the same "
+                    "image03.txt and metadata zips as the reference (nibabel and pandas based) conversion, on "
+                    "a real or synthetic dataset.")
+    parser.add_argument("--bids-directory", help="Dataset to convert (default: a generated synthetic dataset)")
+    parser.add_argument("--guid-mapping", help="GUID mapping file of --bids-directory")
+    parser.add_argument("--subjects", type=int, default=5, help="Subjects of the synthetic dataset")
+    parser.add_argument("--sessions", type=int, default=1, help="Sessions per subject of the synthetic dataset")
+    parser.add_argument("--runs", type=int, default=2, help="Bold runs per session of the synthetic dataset")
+    parser.add_argument("--variant", action="append", choices=sorted(VARIANTS), dest="variants",
+                        help="Variant to check, may be repeated (default: all)")
+    parser.add_argument("--rel-tol", type=float, default=DEFAULT_REL_TOL,
+                        help="Relative tolerance of numbers (default: %(default)g)")
+    parser.add_argument("--max-differences", type=int, default=20,
+                        help="Differences listed per variant (default: %(default)d)")
+    parser.add_argument("--work-directory",
+                        help="Where to write the outputs (kept); a temporary directory removed afterwards by "
+                             "default")
+    args = parser.parse_args(argv)
+    if (args.bids_directory is None) != (args.guid_mapping is None):
+        parser.error("--bids-directory and --guid-mapping must be given together")
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix="bids2nda-equivalence-")
+    try:
+        bids_root, guid_mapping = args.bids_directory, args.guid_mapping
+        if bids_root is None:
+            from .benchmark import generate_dataset
+            bids_root = os.path.join(work_directory, "bids")
+            guid_mapping, _ = generate_dataset(bids_root, subjects=args.subjects, sessions=args.sessions,
+                                               runs=args.runs)
+        results = check_equivalence(bids_root, guid_mapping, work_directory, args.variants, args.rel_tol)
+    finally:
+        if not args.work_directory:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    for variant, differences in sorted(results.items()):
+        print("%-18s %s" % (variant, "same" if not differences else "%d differences" % len(differences)))
+        for difference in differences[:args.max_differences]:
+            print("  %s:\n    reference: %r\n    candidate: %r" % difference)
+    return 1 if any(results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""Loading and validation of GUID mapping files
+
+A GUID mapping file, as produced by NDA's GUID Tool, has one
+``<participant_id> - <GUID>`` line per subject.  Files are parsed in a
+single streaming pass and all problems are reported with their line
+numbers: malformed lines and participants listed twice with different GUIDs
+are errors, while GUIDs not following the NDA format and participants listed
+twice with the same GUID are warnings.
+
+The parsed mapping can be cached in a directory (e.g. the output directory
+shared by the shards of a conversion), in a pickle named after the SHA-256
+of the mapping file, so that it is only parsed once.  Writing the cache of
+new content removes the caches of previous contents.
+"""
+import hashlib
+import os
+import pickle
+import re
+from collections import namedtuple
+
+# NDA GUIDs (NDAR followed by 8 characters) and pseudo-GUIDs (NDAR_INV...)
+GUID_PATTERN = re.compile(r"NDAR(_INV)?[A-Z0-9]{8}$")
+
+GUID_CACHE_PREFIX = ".bids2nda_guids-"
+
+# Bump whenever the content of cached mappings changes, to invalidate old caches
+GUID_CACHE_VERSION = 1
+
+# Number of problems listed in the message of a GUIDMappingError
+MAX_REPORTED_PROBLEMS = 20
+
+GUIDProblem = namedtuple("GUIDProblem", ["line_number", "severity", "message", "line"])
+
+
+class GUIDMappingError(ValueError):
+    """Raised when a GUID mapping file has errors, all of them being in `problems`"""
+
+    def __init__(self, path, problems):
+        self.path = path
+        self.problems = problems
+        lines = [format_problem(problem) for problem in problems[:MAX_REPORTED_PROBLEMS]]
+        if len(problems) > MAX_REPORTED_PROBLEMS:
+            lines.append("... and %d more" % (len(problems) - MAX_REPORTED_PROBLEMS))
+        super(GUIDMappingError, self).__init__(
+            "%s has %d invalid lines:\n%s" % (path, len(problems), "\n".join(lines)))
+
+
+def format_problem(problem):
+    return "line %d: %s: %s (%r)" % (problem.line_number, problem.severity, problem.message, problem.line)
+
+
+def parse_guid_mapping(lines):
+    """Parse GUID mapping lines into a dict keyed by participant label (without 'sub-')
+
+    Returns (mapping, problems), problems being a list of GUIDProblem.  For
+    participants listed more than once, the first GUID is kept.
+    """
+    mapping = {}
+    first_lines = {}
+    problems = []
+    is_guid = GUID_PATTERN.match
+    for line_number, line in enumerate(lines, 1):
+        participant_id, separator, guid = line.partition(" - ")
+        participant_id = participant_id.strip()
+        guid = guid.strip()
+        if not participant_id or not guid or " - " in guid:
+            if line.strip():
+                problems.append(GUIDProblem(line_number, "error", "expected '<participant_id> - <GUID>'",
+                                            line.strip()))
+            continue
+        label = participant_id[4:] if participant_id.startswith("sub-") else participant_id
+
+        if label in mapping:
+            if mapping[label] == guid:
+                problems.append(GUIDProblem(line_number, "warning",
+                                            "sub-%s already listed on line %d" % (label, first_lines[label]),
+                                            line.strip()))
+            else:
+                problems.append(GUIDProblem(line_number, "error",
+                                            "sub-%s already mapped to %s on line %d"
+                                            % (label, mapping[label], first_lines[label]), line.strip()))
+            continue
+        if not is_guid(guid):
+            problems.append(GUIDProblem(line_number, "warning", "%r is not an NDA GUID" % guid, line.strip()))
+        mapping[label] = guid
+        first_lines[label] = line_number
+    return mapping, problems
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file, "rb") as fp:
+            version, mapping, problems = pickle.load(fp)
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+    if version != GUID_CACHE_VERSION:
+        return None
+    return mapping, [GUIDProblem(*problem) for problem in problems]
+
+
+def _write_cache(cache_file, mapping, problems):
+    # concurrent runs may write the same cache file, write it atomically
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "wb") as fp:
+        pickle.dump((GUID_CACHE_VERSION, mapping, [tuple(problem) for problem in problems]), fp,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+    # caches of previous contents of the mapping file are stale
+    cache_directory, cache_name = os.path.split(cache_file)
+    for name in os.listdir(cache_directory):
+        if name.startswith(GUID_CACHE_PREFIX) and name.endswith(".pkl") and name != cache_name:
+            try:
+                os.remove(os.path.join(cache_directory, name))
+            except OSError:
+                pass
+
+
+def read_guid_mapping(path, cache_directory=None):
+    """Return the (mapping, problems) of the GUID mapping file at `path`, see parse_guid_mapping()
+
+    With `cache_directory`, the result is cached there and reused for files
+    with the same content.
+    """
+    cache_file = None
+    if cache_directory is not None:
+        cache_file = os.path.join(cache_directory, GUID_CACHE_PREFIX + file_sha256(path) + ".pkl")
+        cached = _read_cache(cache_file)
+        if cached is not None:
+            return cached
+
+    with open(path, encoding="utf-8-sig") as fp:
+        mapping, problems = parse_guid_mapping(fp)
+
+    if cache_file is not None:
+        _write_cache(cache_file, mapping, problems)
+    return mapping, problems
+
+
+def load_guid_mapping(path, cache_directory=None, warn=True):
+    """Load a GUID mapping file into a dict keyed by participant label (without 'sub-')
+
+    Raises GUIDMappingError listing every error of the file.  Warnings are
+    printed unless `warn` is False.
+    """
+    mapping, problems = read_guid_mapping(path, cache_directory)
+    errors = [problem for problem in problems if problem.severity == "error"]
+    if errors:
+        raise GUIDMappingError(path, errors)
+    if warn:
+        for problem in problems[:MAX_REPORTED_PROBLEMS]:
+            print("WARNING: %s %s" % (path, format_problem(problem)))
+        if len(problems) > MAX_REPORTED_PROBLEMS:
+            print("WARNING: %s has %d more warnings" % (path, len(problems) - MAX_REPORTED_PROBLEMS))
+    return mapping
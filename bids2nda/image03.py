@@ -0,0 +1,292 @@
+"""The NDA image03 data structure and its tab separated text format"""
+import csv
+import os
+from collections import OrderedDict
+
+# Columns of image03.txt, in order.  Columns an image03 record does not set
+# (e.g. the microscopy fields added with the image03 changes from 12/30/19,
+# https://nda.nih.gov/data_structure_history.html?short_name=image03) are
+# written out empty.
+IMAGE03_COLUMNS = (
+    'subjectkey',
+    'src_subject_id',
+    'interview_date',
+    'interview_age',
+    'gender',
+    'image_file',
+    'experiment_id',
+    'image_description',
+    'scan_type',
+    'scan_object',
+    'image_file_format',
+    'image_modality',
+    'scanner_manufacturer_pd',
+    'scanner_type_pd',
+    'scanner_software_versions_pd',
+    'magnetic_field_strength',
+    'mri_echo_time_pd',
+    'flip_angle',
+    'receive_coil',
+    'image_orientation',
+    'transformation_performed',
+    'transformation_type',
+    'image_num_dimensions',
+    'image_extent1',
+    'image_extent2',
+    'image_extent3',
+    'image_extent4',
+    'extent4_type',
+    'acquisition_matrix',
+    'image_resolution1',
+    'image_resolution2',
+    'image_resolution3',
+    'image_slice_thickness',
+    'photomet_interpret',
+    'image_resolution4',
+    'image_unit1',
+    'image_unit2',
+    'image_unit3',
+    'mri_repetition_time_pd',
+    'slice_timing',
+    'image_unit4',
+    'mri_field_of_view_pd',
+    'patient_position',
+    'visit',
+    'data_file2',
+    'data_file2_type',
+    'bvecfile',
+    'bvalfile',
+    'bvek_bval_files',
+    'deviceserialnumber',
+    'procdate',
+    'visnum',
+    'manifest',
+    'emission_wavelength',
+    'objective_magnification',
+    'objective_na',
+    'immersion',
+    'exposure_time',
+    'camera_sn',
+    'block_number',
+    'level',
+    'cut_thickness',
+    'stain',
+    'stain_details',
+    'pipeline_stage',
+    'deconvolved',
+    'decon_software',
+    'decon_method',
+    'psf_type',
+    'psf_file',
+    'decon_snr',
+    'decon_iterations',
+    'micro_temmplate_name',
+    'in_stack',
+    'decon_template_name',
+    'stack',
+    'slices',
+    'slice_number',
+    'slice_thickness',
+    'type_of_microscopy',
+)
+
+IMAGE03_HEADER = '"image"\t"3"\n'
+
+
+class Image03Record(object):
+    """A single image03 row, with one slot per IMAGE03_COLUMNS column
+
+    Records behave like a (column ordered) mapping of the columns which were
+    set; unknown column names raise KeyError.  Using slots instead of a dict
+    per row keeps streams of many records small.
+    """
+    __slots__ = IMAGE03_COLUMNS
+
+    def __init__(self, *args, **kwargs):
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, column):
+        if column not in Image03Record.__slots__:
+            raise KeyError(column)
+        try:
+            return getattr(self, column)
+        except AttributeError:
+            raise KeyError(column)
+
+    def __setitem__(self, column, value):
+        if column not in Image03Record.__slots__:
+            raise KeyError(column)
+        setattr(self, column, value)
+
+    def __contains__(self, column):
+        return column in Image03Record.__slots__ and hasattr(self, column)
+
+    def __iter__(self):
+        return (column for column in IMAGE03_COLUMNS if hasattr(self, column))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, Image03Record):
+            return self.items() == other.items()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return "Image03Record(%s)" % ", ".join("%s=%r" % item for item in self.items())
+
+    def __getstate__(self):
+        return self.items()
+
+    def __setstate__(self, state):
+        self.update(state)
+
+    def get(self, column, default=None):
+        try:
+            return self[column]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [getattr(self, column) for column in self]
+
+    def items(self):
+        return [(column, getattr(self, column)) for column in self]
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            items = other.items() if hasattr(other, "items") else other
+            for column, value in items:
+                self[column] = value
+
+    def copy(self):
+        return Image03Record(self.items())
+
+    def as_dict(self):
+        """Return the set columns as an OrderedDict, in IMAGE03_COLUMNS order"""
+        return OrderedDict(self.items())
+
+    def as_row(self):
+        """Return the values of all IMAGE03_COLUMNS, '' for the columns not set"""
+        return [getattr(self, column, "") for column in IMAGE03_COLUMNS]
+
+
+class Image03Writer(object):
+    """Write image03 records to an image03.txt file one row at a time
+
+    Rows are flushed as they are written, so memory use does not depend on
+    the number of images and partial output can be inspected during a run.
+    Values are written with ``str()``, every field quoted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "w", newline="")
+        self._fp.write(IMAGE03_HEADER)
+        self._writer = csv.writer(self._fp, delimiter="\t", quoting=csv.QUOTE_ALL, lineterminator="\n")
+        self._writer.writerow(IMAGE03_COLUMNS)
+        self.rows = 0
+
+    def write(self, record):
+        if isinstance(record, Image03Record):
+            row = record.as_row()
+        else:
+            row = [record.get(column, "") for column in IMAGE03_COLUMNS]
+        self._writer.writerow(row)
+        self._fp.flush()
+        self.rows += 1
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_image03(path):
+    """Yield the rows of an image03.txt file as Image03Record objects (of str values)
+
+    Raises ValueError if the file does not start with the image03 header
+    lines or has rows not matching its column header.
+    """
+    with open(path, newline="") as fp:
+        header = fp.readline()
+        if header.rstrip("\r\n") != IMAGE03_HEADER.rstrip("\n"):
+            raise ValueError("%s is not an image03 file, it starts with %r" % (path, header))
+        reader = csv.reader(fp, delimiter="\t")
+        columns = next(reader, [])
+        unknown = [column for column in columns if column not in IMAGE03_COLUMNS]
+        if unknown or 'image_file' not in columns:
+            raise ValueError("%s has unknown image03 columns %s or no image_file column" % (path, unknown))
+        for row in reader:
+            if len(row) != len(columns):
+                raise ValueError("%s line %d has %d fields instead of %d"
+                                 % (path, reader.line_num + 1, len(row), len(columns)))
+            yield Image03Record(zip(columns, row))
+
+
+def merge_image03(input_paths, output_path):
+    """Merge image03 files into a single one, returning the number of rows written
+
+    Rows are de-duplicated on image_file, a row from a later input replacing
+    the one of an earlier input, and written sorted by image_file (the
+    order of a complete conversion).  `output_path` may be one of the
+    inputs as all of them are read before it is written.
+    """
+    records = {}
+    for path in input_paths:
+        for record in read_image03(path):
+            records[record['image_file']] = record
+    write_image03(output_path, (records[image_file] for image_file in sorted(records)))
+    return len(records)
+
+
+def replace_image03_rows(path, records, replaces):
+    """Replace the rows of the image03 file `path` for which `replaces(image_file)` is true by `records`
+
+    Rows of other images are kept as they are, so that the conversion of
+    part of a dataset (a subject, a session...) can be folded into the
+    table of the whole dataset; rows of images of that part which are gone
+    are dropped.  The result is sorted by image_file and written atomically.
+    A missing `path` is treated as an empty table.  Returns (number of rows
+    removed, number of rows written).
+    """
+    kept = {}
+    removed = 0
+    if os.path.exists(path):
+        for record in read_image03(path):
+            if replaces(record['image_file']):
+                removed += 1
+            else:
+                kept[record['image_file']] = record
+    for record in records:
+        kept[record['image_file']] = record
+    return removed, write_image03(path, (kept[image_file] for image_file in sorted(kept)))
+
+
+def write_image03(path, records):
+    """Write `records` to the image03 file `path` atomically, returning the number of rows
+
+    The rows are written to a temporary file which then replaces `path`, so
+    that readers of `path` never see a partial table.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with Image03Writer(tmp_path) as writer:
+            for record in records:
+                writer.write(record)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return writer.rows
@@ -6,73 +6,236 @@ from __future__ import print_function
 import argparse
 import csv
 import logging
-import zipfile
-from collections import OrderedDict
-from glob import glob
+from collections import namedtuple, OrderedDict
+from contextlib import ExitStack
 import os
 import sys
 
-import nibabel as nb
 import json
-import pandas as pd
-import numpy as np
+
+from .bids_index import BIDSIndex, parse_shard
+from .guid_mapping import load_guid_mapping
+from .image03 import Image03Record, Image03Writer, merge_image03, read_image03, replace_image03_rows
+from .metadata_zip import (DEFAULT_ZIP_COMPRESSION, write_metadata_zip,
+                           ZIP_COMPRESSION_CHOICES)
+from .nifti_header import read_nifti_header, split_nifti_ext
+from .profiler import NullProfiler, PROFILE_FILENAME, Profiler
+from .record_cache import CACHE_FILENAME, fingerprint, RecordCache
 
 
 # Gather our code in a main() function
 from shutil import copy
 
 
-def get_metadata_for_nifti(bids_root, path):
-
-    #TODO support .nii
-    sidecarJSON = path.replace(".nii.gz", ".json")
+class SidecarResolver(object):
+    """Resolve BIDS JSON sidecars following the inheritance principle
 
-    pathComponents = os.path.split(sidecarJSON)
-    filenameComponents = pathComponents[-1].split("_")
-    sessionLevelComponentList = []
-    subjectLevelComponentList = []
-    topLevelComponentList = []
-    ses = None;
-    sub = None;
+    Parsed JSON files are cached by path and modification time, and the
+    merged top/subject/session levels of the inheritance chain are memoized,
+    so that for every image only its own sidecar has to be read.  Call
+    `invalidate()` to have the chain re-checked against the file system
+    (files which did not change are still served from the JSON cache).
+    """
 
-    for filenameComponent in filenameComponents:
-        if filenameComponent[:3] != "run":
-            sessionLevelComponentList.append(filenameComponent)
-            if filenameComponent[:3] == "ses":
-                ses = filenameComponent
-            else:
-                subjectLevelComponentList.append(filenameComponent)
-                if filenameComponent[:3] == "sub":
-                    sub = filenameComponent
+    def __init__(self, bids_root, index=None, json_cache=None):
+        self.bids_root = bids_root
+        # BIDSIndex used to skip stat calls for sidecars which do not exist
+        self.index = index
+        # path -> (mtime, parsed JSON), may be shared between resolvers
+        self._json_cache = json_cache if json_cache is not None else {}
+        self._chain_cache = {}
+
+    def invalidate(self):
+        self._chain_cache = {}
+
+    def load_json(self, json_file_path):
+        """Return the parsed content of `json_file_path`, or None if it does not exist"""
+        if self.index is not None and not self.index.exists(json_file_path):
+            return None
+        try:
+            mtime = os.stat(json_file_path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._json_cache.get(json_file_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(json_file_path, "r") as fp:
+            param_dict = json.load(fp)
+        self._json_cache[json_file_path] = (mtime, param_dict)
+        return param_dict
+
+    def _merge_chain(self, json_paths):
+        # memoized on every prefix of the chain (top, top+subject, ...)
+        json_paths = tuple(json_paths)
+        if not json_paths:
+            return {}
+        if json_paths not in self._chain_cache:
+            merged_param_dict = dict(self._merge_chain(json_paths[:-1]))
+            param_dict = self.load_json(json_paths[-1])
+            if param_dict is not None:
+                merged_param_dict.update(param_dict)
+            self._chain_cache[json_paths] = merged_param_dict
+        return self._chain_cache[json_paths]
+
+    def inherited_jsons(self, path):
+        """Return the candidate top, subject and session level JSON paths for a NIfTI"""
+        filenameComponents = os.path.split(split_nifti_ext(path)[0] + ".json")[-1].split("_")
+        sessionLevelComponentList = []
+        subjectLevelComponentList = []
+        topLevelComponentList = []
+        ses = None
+        sub = None
+
+        for filenameComponent in filenameComponents:
+            if filenameComponent[:3] != "run":
+                sessionLevelComponentList.append(filenameComponent)
+                if filenameComponent[:3] == "ses":
+                    ses = filenameComponent
                 else:
-                    topLevelComponentList.append(filenameComponent)
-
-    topLevelJSON = os.path.join(bids_root, "_".join(topLevelComponentList))
-    potentialJSONs = [topLevelJSON]
-
-    subjectLevelJSON = os.path.join(bids_root, sub, "_".join(subjectLevelComponentList))
-    potentialJSONs.append(subjectLevelJSON)
+                    subjectLevelComponentList.append(filenameComponent)
+                    if filenameComponent[:3] == "sub":
+                        sub = filenameComponent
+                    else:
+                        topLevelComponentList.append(filenameComponent)
+
+        potentialJSONs = [os.path.join(self.bids_root, "_".join(topLevelComponentList)),
+                          os.path.join(self.bids_root, sub, "_".join(subjectLevelComponentList))]
+        if ses:
+            potentialJSONs.append(os.path.join(self.bids_root, sub, ses, "_".join(sessionLevelComponentList)))
+        return potentialJSONs
+
+    def get_metadata(self, path):
+        """Return the merged sidecar metadata for the NIfTI file at `path`"""
+        merged_param_dict = dict(self._merge_chain(self.inherited_jsons(path)))
+        param_dict = self.load_json(split_nifti_ext(path)[0] + ".json")
+        if param_dict is not None:
+            merged_param_dict.update(param_dict)
+        return merged_param_dict
 
-    if ses:
-        sessionLevelJSON = os.path.join(bids_root, sub, ses, "_".join(sessionLevelComponentList))
-        potentialJSONs.append(sessionLevelJSON)
 
-    potentialJSONs.append(sidecarJSON)
+def get_metadata_for_nifti(bids_root, path, resolver=None):
+    if resolver is None:
+        resolver = SidecarResolver(bids_root)
+    return resolver.get_metadata(path)
 
-    merged_param_dict = {}
-    for json_file_path in potentialJSONs:
-        if os.path.exists(json_file_path):
-            param_dict = json.load(open(json_file_path, "r"))
-            merged_param_dict.update(param_dict)
 
-    return merged_param_dict
+class ParticipantsIndex(object):
+    """participants.tsv indexed by participant_id
 
+    interview_age (in months) and sex are computed for every participant
+    when the file is loaded.  Problems with individual rows (missing or
+    non-numeric age) are recorded rather than raised, so that `check()` can
+    report them for all subjects of a run at once.
+    """
 
-def dict_append(d, key, value):
-    if key in d:
-        d[key].append(value)
-    else:
-        d[key] = [value, ]
+    def __init__(self, participants_file):
+        self.participants_file = participants_file
+        columns, rows = read_tsv(participants_file)
+
+        # Check if required columns exist
+        if 'age' not in columns or 'sex' not in columns:
+            raise Exception(f"{participants_file} must have columns 'age' and 'sex' for nda columns 'interview_age' and 'sex'")
+
+        self.participant_ids = []
+        self._fields = {}
+        self._errors = {}
+        for row in rows:
+            participant_id, age, sex = row['participant_id'], row['age'], row['sex'] or ""
+            if participant_id in self._fields or participant_id in self._errors:
+                continue
+            self.participant_ids.append(participant_id)
+            try:
+                interview_age = int(round(float(age)*12, 0))
+            except (TypeError, ValueError, OverflowError):
+                self._errors[participant_id] = f"age {age!r} is not a number"
+                continue
+            self._fields[participant_id] = (interview_age, "" if sex in TSV_NA_VALUES else sex)
+
+    def __contains__(self, participant_id):
+        return participant_id in self._fields or participant_id in self._errors
+
+    def check(self, participant_ids):
+        """Raise an Exception describing the problems of all given participants, if any"""
+        problems = []
+        for participant_id in sorted(set(participant_ids)):
+            if participant_id not in self:
+                problems.append(f"no row with participant_id = '{participant_id}'")
+            elif participant_id in self._errors:
+                problems.append(f"{participant_id}: {self._errors[participant_id]}")
+        if problems:
+            raise Exception(f"{self.participants_file} has problems for nda columns 'interview_age' and 'sex':\n  "
+                            + "\n  ".join(problems))
+
+    def fields(self, participant_id):
+        """Return (interview_age, sex) of `participant_id`"""
+        if participant_id not in self._fields:
+            self.check([participant_id])
+        return self._fields[participant_id]
+
+
+# Values read as missing from .tsv files: the default na_values of pandas.read_csv
+TSV_NA_VALUES = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+                           "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+
+
+def read_tsv(path):
+    """Read a BIDS .tsv file into its column names and a list of rows (dicts of str)"""
+    with open(path, "r", newline="", encoding="utf-8-sig") as fp:
+        reader = csv.DictReader(fp, delimiter="\t")
+        rows = list(reader)
+    return reader.fieldnames or [], rows
+
+
+def load_scans_index(scans_file):
+    """Load a *_scans.tsv file into a filename -> NDA interview_date mapping
+
+    Filenames are kept relative to the directory holding the scans file
+    (i.e. the session, or subject if there are no sessions) with "/" as
+    separator, and acq_time values are converted to NDA's MM/DD/YYYY format
+    when the file is loaded.  Rows without a valid acq_time map to None.
+    """
+    columns, rows = read_tsv(scans_file)
+
+    if 'filename' not in columns or 'acq_time' not in columns:
+        raise Exception(f"{scans_file} must have columns 'filename' and 'acq_time' (YYYY-MM-DD) to create 'interview_date' nda column'")
+
+    scans_index = {}
+    for row in rows:
+        filename = (row['filename'] or "").replace("\\", "/")
+        if filename.startswith("./"):
+            filename = filename[2:]
+        scans_index[filename] = acq_time_to_ndar_date(row['acq_time'])
+    return scans_index
+
+
+def acq_time_to_ndar_date(acq_time):
+    """Convert a BIDS acq_time (YYYY-MM-DD[Thh:mm:ss]) to NDA's MM/DD/YYYY, None if missing or invalid"""
+    if acq_time is None or acq_time in TSV_NA_VALUES:
+        return None
+    sdate = acq_time.split("T")[0].split("-")
+    if len(sdate) < 3:
+        return None
+    return sdate[1] + "/" + sdate[2] + "/" + sdate[0]
+
+
+def lookup_scan_date(scans_index, scans_file, file):
+    """Return the NDA interview_date for `file` from its session scans index"""
+    scans_dir = os.path.dirname(scans_file)
+    filename = os.path.relpath(file, scans_dir).replace(os.sep, "/")
+    if filename not in scans_index:
+        # fall back to the historical suffix match (e.g. filenames given
+        # relative to the dataset root)
+        for candidate in scans_index:
+            if file.replace(os.sep, "/").endswith(candidate):
+                filename = candidate
+                break
+    if filename not in scans_index:
+        raise Exception(f"{scans_file} has no row with filename '{filename}' - "
+                        "information about scan date required by NDA could not be found.")
+    ndar_date = scans_index[filename]
+    if ndar_date is None:
+        raise Exception(f"{scans_file} has no valid acq_time (YYYY-MM-DD) for '{filename}'")
+    return ndar_date
 
 
 def cosine_to_orientation(iop):
@@ -107,343 +270,897 @@ def cosine_to_orientation(iop):
     -------
     {'Axial', 'Coronal', 'Sagittal'}
     """
+    orientations, errors = cosines_to_orientations([iop])
+    if errors[0] is not None:
+        raise RuntimeError(errors[0])
+    return orientations[0]
+
+
+def cosines_to_orientations(iops):
+    """Deduce slicing for many ImageOrientationPatient values at once
+
+    Vectorized version of `cosine_to_orientation`.
+
+    Parameters
+    ----------
+    iops: array-like of shape (N, 6)
+       Values of the ImageOrientationPatient field, one row per image
+
+    Returns
+    -------
+    orientations: list of {'Axial', 'Coronal', 'Sagittal', ''}
+       Orientation of every row, '' where it could not be deduced
+    errors: list of str or None
+       Error message for every row whose orientation could not be deduced
+       (e.g. oblique acquisitions), None for the others
+    """
+    import numpy as np
+
+    iop_array = np.asarray(iops, dtype=float)
+    if iop_array.ndim != 2 or iop_array.shape[1] != 6:
+        raise ValueError("Expected an (N, 6) array of ImageOrientationPatient values, got shape %r"
+                         % (iop_array.shape,))
     # Solution based on https://stackoverflow.com/a/45469577
-    iop_round = np.round(iop)
-    plane = np.cross(iop_round[0:3], iop_round[3:6])
-    plane = np.abs(plane)
-    if plane[0] == 1:
-        return "Sagittal"
-    elif plane[1] == 1:
-        return "Coronal"
-    elif plane[2] == 1:
-        return "Axial"
-    else:
-        raise RuntimeError(
-            "Could not deduce the image orientation of %r. 'plane' value is %r"
-            % (iop, plane)
-        )
+    iop_round = np.round(iop_array)
+    plane = np.abs(np.cross(iop_round[:, 0:3], iop_round[:, 3:6]))
+    orientations = np.select([plane[:, 0] == 1, plane[:, 1] == 1, plane[:, 2] == 1],
+                             ["Sagittal", "Coronal", "Axial"], default="")
+    errors = [None] * len(orientations)
+    for i in np.flatnonzero(orientations == ""):
+        errors[i] = ("Could not deduce the image orientation of %r. 'plane' value is %r"
+                     % (iops[i], plane[i]))
+    return orientations.tolist(), errors
+
+
+suffix_to_scan_type = {"dwi": "MR diffusion",
+                       "bold": "fMRI",
+                       "sbref": "fMRI",
+                       #""MR structural(MPRAGE)",
+                       "T1w": "MR structural (T1)",
+                       "PD": "MR structural (PD)",
+                       #"MR structural(FSPGR)",
+                       "T2w": "MR structural (T2)",
+                       "inplaneT2": "MR structural (T2)",
+                       "FLAIR": "FLAIR",
+                       "FLASH": "MR structural (FLASH)",
+                       #PET;
+                        #ASL;
+                        #microscopy;
+                        #MR structural(PD, T2);
+                        #MR structural(B0 map);
+                        #MR structural(B1 map);
+                        #single - shell DTI;
+                        #multi - shell DTI;
+                       "epi": "Field Map",
+                       "phase1": "Field Map",
+                       "phase2": "Field Map",
+                       "phasediff": "Field Map",
+                       "magnitude1": "Field Map",
+                       "magnitude2": "Field Map",
+                       "fieldmap": "Field Map"
+                       #X - Ray
+                       }
+
+units_dict = {"mm": "Millimeters",
+              "sec": "Seconds",
+              "msec": "Milliseconds"}
+
+
+class ConversionContext(object):
+    """State shared by the conversion of all images of a dataset
+
+    One context is created per run (and per worker process when running in
+    parallel); it holds the GUID mapping and participants table as well as
+    the per-session scans.tsv indexes and the sidecar resolver caches.
+    Metadata zips are written to `output_directory`, or not at all if it is
+    None.
+    """
 
+    def __init__(self, bids_directory, output_directory, guid_mapping, participants,
+                 zip_compression=DEFAULT_ZIP_COMPRESSION, index=None, profiler=None):
+        self.bids_directory = bids_directory
+        self.index = index if index is not None else BIDSIndex(bids_directory)
+        self.output_directory = output_directory
+        self.zip_compression = zip_compression
+        self.profiler = profiler if profiler is not None else NullProfiler()
+        self.guid_mapping = guid_mapping
+        self.participants = participants
+        self.sidecar_resolver = SidecarResolver(bids_directory, self.index)
+        # scans.tsv contents are loaded once per session and shared by all its images
+        self.scans_indexes = {}
+
+    def exists(self, path):
+        return self.index.exists(path)
+
+    def entities(self, file):
+        return self.index.entities(file)
+
+    def scans_file(self, sub, ses):
+        if ses is not None:
+            return os.path.join(self.bids_directory, "sub-" + sub, "ses-" + ses, "sub-" + sub + "_ses-" + ses + "_scans.tsv")
+        return os.path.join(self.bids_directory, "sub-" + sub, "sub-" + sub + "_scans.tsv")
+
+    def scans_index(self, scans_file):
+        """Return the (cached) load_scans_index() of an existing `scans_file`"""
+        if scans_file not in self.scans_indexes:
+            self.scans_indexes[scans_file] = load_scans_index(scans_file)
+        return self.scans_indexes[scans_file]
+
+    def scan_date(self, file, sub, ses):
+        scans_file = self.scans_file(sub, ses)
+        if not self.exists(scans_file):
+            raise Exception("%s file not found - information about scan date required by NDA could not be found."
+                            % scans_file)
+
+        return lookup_scan_date(self.scans_index(scans_file), scans_file, file)
+
+
+def subject_fields(context, file):
+    """Return the image03 fields taken from the GUID mapping and participants.tsv"""
+    subject = OrderedDict()
+
+    bids_subject_id = context.entities(file)['sub']
+    subject['subjectkey'] = context.guid_mapping[bids_subject_id]
+    subject['src_subject_id'] = 'sub-' + bids_subject_id
+
+    subject['interview_age'], subject['gender'] = context.participants.fields('sub-' + bids_subject_id)
+    return subject
+
+
+def events_file_candidates(bids_directory, file, entities):
+    """Return the session level and dataset level events files a bold run may use"""
+    #TODO write a more robust function for finding those files
+    candidates = [file.split("_bold")[0] + "_events.tsv"]
+    if 'task' in entities:
+        candidates.append(os.path.join(bids_directory, "task-" + entities['task'] + "_events.tsv"))
+    return candidates
+
+
+def dwi_file_candidates(bids_directory, file, ext):
+    """Return the image level and dataset level .bvec or .bval files (`ext`) a dwi run may use"""
+    # TODO write a more robust function for finding those files
+    return [file.split("_dwi")[0] + "_dwi." + ext,
+            os.path.join(bids_directory, "dwi." + ext)]
+
+
+def image_input_files(context, file):
+    """Return all files (existing or not) the image03 record of `file` is built from"""
+    entities = context.entities(file)
+    suffix = entities['suffix']
+
+    input_files = [file, split_nifti_ext(file)[0] + ".json", context.scans_file(entities['sub'], entities.get('ses'))]
+    input_files += context.sidecar_resolver.inherited_jsons(file)
+    if suffix == "bold":
+        input_files += events_file_candidates(context.bids_directory, file, entities)
+    elif suffix == "dwi":
+        input_files += dwi_file_candidates(context.bids_directory, file, "bvec")
+        input_files += dwi_file_candidates(context.bids_directory, file, "bval")
+    return input_files
+
+
+def image_fingerprint(context, file):
+    """Return what the cached image03 record of `file` is valid for
+
+    That is the options its record and metadata zip depend on (zip
+    directory and compression) and the fingerprint() of its input files.
+    """
+    return ((context.output_directory, context.zip_compression),
+            fingerprint(image_input_files(context, file), context.exists))
 
-def run(args):
 
-    # Load GUID mapping
-    guid_mapping = dict([line.split(" - ") for line in open(args.guid_mapping).read().split("\n") if line != ''])
+# Parsed sidecar metadata, NIfTI header and events file ((arcname, bytes), or
+# None) of an image, i.e. what its image03 record is built from, and the
+# profiling entry of reading them in a Prefetcher thread (None unless profiling)
+ImageInputs = namedtuple("ImageInputs", ["metadata", "header", "events", "profile"], defaults=(None,))
 
-    # Normalize GUID mapping keys by removing 'sub-' if present
-    guid_mapping = {key.replace('sub-', ''): value for key, value in guid_mapping.items()}
 
-    # Load participants file
-    participants_file = os.path.join(args.bids_directory, "participants.tsv")
-    participants_df = pd.read_csv(participants_file, header=0, sep="\t")
+def load_image_inputs(context, file):
+    """Read the input files of the image03 record of `file`
 
-    # Check if required columns exist
-    if 'age' not in participants_df.columns or 'sex' not in participants_df.columns:
-        raise Exception(f"{participants_file} must have columns 'age' and 'sex' for nda columns 'interview_age' and 'sex'")
-        
-    # Extract subject list from participant IDs
-    all_subjects = [sub.replace('sub-', '') for sub in participants_df['participant_id']]
-    
-    # Check which subjects are actually present in GUID mapping
-    missing_subjects = []
-    valid_subjects = []
-    for bids_subject_id in all_subjects:
-        # Ensure 'sub-' prefix is handled consistently
-        stripped_subject_id = bids_subject_id.replace('sub-', '')
-        
-        if stripped_subject_id not in guid_mapping:
-            missing_subjects.append(bids_subject_id)
-        else:
-            valid_subjects.append(bids_subject_id)
+    Besides the returned ImageInputs, the scans.tsv of the image is loaded
+    into the context.  This is all the (blocking) reading image03_record()
+    does, so it can be done ahead of time by a Prefetcher.
+    """
+    profiler = context.profiler
+    entities = context.entities(file)
+    with profiler.stage("sidecars"):
+        metadata = get_metadata_for_nifti(context.bids_directory, file, context.sidecar_resolver)
+
+    with profiler.stage("header"):
+        header = read_nifti_header(file)
+
+    with profiler.stage("scans"):
+        scans_file = context.scans_file(entities['sub'], entities.get('ses'))
+        if context.exists(scans_file):
+            context.scans_index(scans_file)
+
+    events = None
+    if entities['suffix'] == "bold" and context.output_directory is not None:
+        with profiler.stage("events"):
+            events_files = events_file_candidates(context.bids_directory, file, entities)
+            arch_name = os.path.split(events_files[0])[1]
+            for events_file in events_files:
+                if context.exists(events_file):
+                    with open(events_file, "rb") as fp:
+                        events = (arch_name, fp.read())
+                    break
+    return ImageInputs(metadata, header, events)
+
+
+def _prefetch_image_inputs(context, file):
+    """load_image_inputs() in a Prefetcher thread, profiled into an entry of its own"""
+    profiler = context.profiler
+    if not profiler.enabled:
+        return load_image_inputs(context, file)
+    profiler.begin_file(file)
+    try:
+        inputs = load_image_inputs(context, file)
+    finally:
+        entry = profiler.end_file()
+    return inputs._replace(profile=entry)
 
-    # Handle missing subjects based on strictness
-    if missing_subjects:
-        if args.strictness == 'strict':
-            raise ValueError(f"The following subjects are missing from GUID mapping: {missing_subjects}")
-        elif args.strictness == 'warn':
-            print(f"WARNING: The following subjects are missing from GUID mapping: {missing_subjects}")
-            print("Continuing with available subjects.")
 
-    # Use only valid subjects
-    all_subjects = valid_subjects
-    
-    suffix_to_scan_type = {"dwi": "MR diffusion",
-                           "bold": "fMRI",
-                           "sbref": "fMRI",
-                           #""MR structural(MPRAGE)",
-                           "T1w": "MR structural (T1)",
-                           "PD": "MR structural (PD)",
-                           #"MR structural(FSPGR)",
-                           "T2w": "MR structural (T2)",
-                           "inplaneT2": "MR structural (T2)",
-                           "FLAIR": "FLAIR",
-                           "FLASH": "MR structural (FLASH)",
-                           #PET;
-                            #ASL;
-                            #microscopy;
-                            #MR structural(PD, T2);
-                            #MR structural(B0 map);
-                            #MR structural(B1 map);
-                            #single - shell DTI;
-                            #multi - shell DTI;
-                           "epi": "Field Map",
-                           "phase1": "Field Map",
-                           "phase2": "Field Map",
-                           "phasediff": "Field Map",
-                           "magnitude1": "Field Map",
-                           "magnitude2": "Field Map",
-                           "fieldmap": "Field Map"
-                           #X - Ray
-                           }
-
-    units_dict = {"mm": "Millimeters",
-                  "sec": "Seconds",
-                  "msec": "Milliseconds"}
-
-    image03_dict = OrderedDict()
-    for file in glob(os.path.join(args.bids_directory, "sub-*", "*", "sub-*.nii.gz")) + \
-            glob(os.path.join(args.bids_directory, "sub-*", "ses-*", "*", "sub-*_ses-*.nii.gz")):
-        metadata = get_metadata_for_nifti(args.bids_directory, file)
-
-        # Extract subject ID; note that "4:" will remove 'sub-'
-        bids_subject_id = os.path.split(file)[-1].split("_")[0][4:]
-        dict_append(image03_dict, 'subjectkey', guid_mapping[bids_subject_id])
-        dict_append(image03_dict, 'src_subject_id', 'sub-' + bids_subject_id)
-
-        sub = file.split("sub-")[-1].split("_")[0]
-        if "ses-" in file:
-            ses = file.split("ses-")[-1].split("_")[0]
-            scans_file = (os.path.join(args.bids_directory, "sub-" + sub, "ses-" + ses, "sub-" + sub + "_ses-" + ses + "_scans.tsv"))
-        else:
-            scans_file = (os.path.join(args.bids_directory, "sub-" + sub, "sub-" + sub + "_scans.tsv"))
+class Prefetcher(object):
+    """Read the inputs of upcoming images in a thread pool while the current one is converted
+
+    At most `depth` images are read ahead, which bounds the memory used by
+    their (parsed) input files.  Reading is mostly waiting on the file
+    system, so the threads overlap the latency of the reads.
+    """
 
-        if os.path.exists(scans_file):
-            scans_df = pd.read_csv(scans_file, header=0, sep="\t")
+    def __init__(self, context, depth, threads=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.context = context
+        self.depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=threads or min(depth, 16))
+
+    def __call__(self, files):
+        """Yield (file, future of its ImageInputs) for `files`, in order"""
+        from collections import deque
+        pending = deque()
+        files = iter(files)
+        try:
+            for file in files:
+                pending.append((file, self._executor.submit(_prefetch_image_inputs, self.context, file)))
+                if len(pending) > self.depth:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def image03_record(context, file, inputs=None):
+    """Build the image03 row for a single NIfTI file
+
+    Also writes the accompanying metadata zip into the output directory,
+    unless the context has none (then data_file2 is left empty).
+    `inputs` are the ImageInputs of `file` if they were already loaded.
+    Returns an Image03Record.
+    """
+    record = Image03Record()
+    profiler = context.profiler
+    if inputs is None:
+        inputs = load_image_inputs(context, file)
+    metadata = inputs.metadata
+
+    with profiler.stage("participants"):
+        subject = subject_fields(context, file)
+    record['subjectkey'] = subject['subjectkey']
+    record['src_subject_id'] = subject['src_subject_id']
+
+    entities = context.entities(file)
+    with profiler.stage("scans"):
+        record['interview_date'] = context.scan_date(file, entities['sub'], entities.get('ses'))
+    record['interview_age'] = subject['interview_age']
+    record['gender'] = subject['gender']
+
+    record['image_file'] = file
+
+    suffix = entities['suffix']
+    if suffix == "bold":
+        description = suffix + " " + metadata["TaskName"]
+        record['experiment_id'] = metadata.get("ExperimentID", "")
+    else:
+        description = suffix
+        record['experiment_id'] = ''
+    # Shortcut for the global.const section -- apparently might not be flattened fully
+    metadata_const = metadata.get('global', {}).get('const', {})
+    record['image_description'] = description
+    record['scan_type'] = suffix_to_scan_type[suffix]
+    record['scan_object'] = "Live"
+    record['image_file_format'] = "NIFTI"
+    record['image_modality'] = "MRI"
+    record['scanner_manufacturer_pd'] = metadata.get("Manufacturer", "")
+    record['scanner_type_pd'] = metadata.get("ManufacturersModelName", "")
+    record['scanner_software_versions_pd'] = metadata.get("SoftwareVersions", "")
+    record['magnetic_field_strength'] = metadata.get("MagneticFieldStrength", "")
+    record['mri_echo_time_pd'] = metadata.get("EchoTime", "")
+    record['flip_angle'] = metadata.get("FlipAngle", "")
+    record['receive_coil'] = metadata.get("ReceiveCoilName", "")
+    # ImageOrientationPatientDICOM is populated by recent dcm2niix,
+    # and ImageOrientationPatient might be provided by exhastive metadata
+    # record done by heudiconv
+    iop = metadata.get(
+        'ImageOrientationPatientDICOM',
+        metadata_const.get("ImageOrientationPatient", None)
+    )
+    record['image_orientation'] = cosine_to_orientation(iop) if iop else ''
+
+    record['transformation_performed'] = 'Yes'
+    record['transformation_type'] = 'BIDS2NDA'
+
+    nii = inputs.header
+    zooms = nii.zooms
+    xyz_unit = units_dict[nii.xyzt_units[0]]
+    record['image_num_dimensions'] = len(nii.shape)
+    record['image_extent1'] = nii.shape[0]
+    record['image_extent2'] = nii.shape[1]
+    record['image_extent3'] = nii.shape[2]
+    if len(nii.shape) > 3:
+        image_extent4 = nii.shape[3]
+    else:
+        image_extent4 = ""
+
+    record['image_extent4'] = image_extent4
+    if suffix == "bold":
+        extent4_type = "time"
+    elif description == "epi" and len(nii.shape) == 4:
+        extent4_type = "time"
+    elif suffix == "dwi":
+        extent4_type = "diffusion weighting"
+    else:
+        extent4_type = ""
+    record['extent4_type'] = extent4_type
+
+    record['acquisition_matrix'] = "%g x %g" %(nii.shape[0], nii.shape[1])
+
+    record['image_resolution1'] = zooms[0]
+    record['image_resolution2'] = zooms[1]
+    record['image_resolution3'] = zooms[2]
+    record['image_slice_thickness'] = metadata_const.get("SliceThickness", zooms[2])
+    record['photomet_interpret'] = metadata.get("global",{}).get("const",{}).get("PhotometricInterpretation","")
+    if len(nii.shape) > 3:
+        image_resolution4 = zooms[3]
+    else:
+        image_resolution4 = ""
+    record['image_resolution4'] = image_resolution4
+
+    record['image_unit1'] = xyz_unit
+    record['image_unit2'] = xyz_unit
+    record['image_unit3'] = xyz_unit
+    if len(nii.shape) > 3:
+        image_unit4 = units_dict[nii.xyzt_units[1]]
+        if image_unit4 == "Milliseconds":
+            TR = zooms[3]/1000.
         else:
-            print("%s file not found - information about scan date required by NDA could not be found." % scans_file)
-            sys.exit(-1)
+            TR = zooms[3]
+        record['mri_repetition_time_pd'] = TR
+    else:
+        image_unit4 = ""
+        record['mri_repetition_time_pd'] = metadata.get("RepetitionTime", "")
 
-        if 'filename' not in scans_df.columns or 'acq_time' not in scans_df.columns:
-            raise Exception(f"{scans_file} must have columns 'filename' and 'acq_time' (YYYY-MM-DD) to create 'interview_date' nda column'")
+    record['slice_timing'] = metadata.get("SliceTiming", "")
+    record['image_unit4'] = image_unit4
 
-        for (_, row) in scans_df.iterrows():
-            if file.endswith(row["filename"].replace("/", os.sep)):
-                date = row.acq_time
-                break
+    record['mri_field_of_view_pd'] = "%g x %g %s" % (zooms[0], zooms[1], xyz_unit)
+    record['patient_position'] = 'head first-supine'
 
-        sdate = date.split("-")
-        ndar_date = sdate[1] + "/" + sdate[2].split("T")[0] + "/" + sdate[0]
-        dict_append(image03_dict, 'interview_date', ndar_date)
+    record['visit'] = entities.get('ses', "")
 
-        this_subj = participants_df[participants_df.participant_id == "sub-" + sub]
-        if this_subj.shape[0] == 0:
-            raise Exception(f"{participants_file} must have row with particiapnt_id = 'sub-{sub}'")
+    if context.output_directory is not None and (len(metadata) > 0 or suffix in ['bold', 'dwi']):
+        _, fname = os.path.split(file)
+        zip_name = fname.split(".")[0] + ".metadata.zip"
 
-        interview_age = int(round(list(this_subj.age)[0]*12, 0))
-        dict_append(image03_dict, 'interview_age', interview_age)
+        with profiler.stage("zip"):
+            members = [(split_nifti_ext(fname)[0] + ".json",
+                        json.dumps(metadata, indent=4, sort_keys=True).encode())]
+            if inputs.events is not None:
+                members.append(inputs.events)
 
-        sex = list(this_subj.sex)[0]
-        dict_append(image03_dict, 'gender', sex)
+            write_metadata_zip(os.path.join(context.output_directory, zip_name), members, context.zip_compression)
 
-        dict_append(image03_dict, 'image_file', file)
+        record['data_file2'] = os.path.join(context.output_directory, zip_name)
+        record['data_file2_type'] = "ZIP file with additional metadata from Brain Imaging " \
+                                    "Data Structure (http://bids.neuroimaging.io)"
+    else:
+        record['data_file2'] = ""
+        record['data_file2_type'] = ""
+
+    if suffix == "dwi":
+        bvec_file, root_bvec_file = dwi_file_candidates(context.bids_directory, file, "bvec")
+        if not context.exists(bvec_file):
+            bvec_file = root_bvec_file
 
-        suffix = file.split("_")[-1].split(".")[0]
-        if suffix == "bold":
-            description = suffix + " " + metadata["TaskName"]
-            dict_append(image03_dict, 'experiment_id', metadata.get("ExperimentID", ""))
+        if context.exists(bvec_file):
+            record['bvecfile'] = bvec_file
         else:
-            description = suffix
-            dict_append(image03_dict, 'experiment_id', '')
-        # Shortcut for the global.const section -- apparently might not be flattened fully
-        metadata_const = metadata.get('global', {}).get('const', {})
-        dict_append(image03_dict, 'image_description', description)
-        dict_append(image03_dict, 'scan_type', suffix_to_scan_type[suffix])
-        dict_append(image03_dict, 'scan_object', "Live")
-        dict_append(image03_dict, 'image_file_format', "NIFTI")
-        dict_append(image03_dict, 'image_modality', "MRI")
-        dict_append(image03_dict, 'scanner_manufacturer_pd', metadata.get("Manufacturer", ""))
-        dict_append(image03_dict, 'scanner_type_pd', metadata.get("ManufacturersModelName", ""))
-        dict_append(image03_dict, 'scanner_software_versions_pd', metadata.get("SoftwareVersions", ""))
-        dict_append(image03_dict, 'magnetic_field_strength', metadata.get("MagneticFieldStrength", ""))
-        dict_append(image03_dict, 'mri_echo_time_pd', metadata.get("EchoTime", ""))
-        dict_append(image03_dict, 'flip_angle', metadata.get("FlipAngle", ""))
-        dict_append(image03_dict, 'receive_coil', metadata.get("ReceiveCoilName", ""))
-        # ImageOrientationPatientDICOM is populated by recent dcm2niix,
-        # and ImageOrientationPatient might be provided by exhastive metadata
-        # record done by heudiconv
-        iop = metadata.get(
-            'ImageOrientationPatientDICOM',
-            metadata_const.get("ImageOrientationPatient", None)
-        )
-        dict_append(image03_dict, 'image_orientation', cosine_to_orientation(iop) if iop else '')
-
-        dict_append(image03_dict, 'transformation_performed', 'Yes')
-        dict_append(image03_dict, 'transformation_type', 'BIDS2NDA')
-
-        nii = nb.load(file)
-        dict_append(image03_dict, 'image_num_dimensions', len(nii.shape))
-        dict_append(image03_dict, 'image_extent1', nii.shape[0])
-        dict_append(image03_dict, 'image_extent2', nii.shape[1])
-        dict_append(image03_dict, 'image_extent3', nii.shape[2])
-        if len(nii.shape) > 3:
-            image_extent4 = nii.shape[3]
+            record['bvecfile'] = ""
+
+        bval_file, root_bval_file = dwi_file_candidates(context.bids_directory, file, "bval")
+        if not context.exists(bval_file):
+            bval_file = root_bval_file
+
+        if context.exists(bval_file):
+            record['bvalfile'] = bval_file
         else:
-            image_extent4 = ""
-
-        dict_append(image03_dict, 'image_extent4', image_extent4)
-        if suffix == "bold":
-            extent4_type = "time"
-        elif description == "epi" and len(nii.shape) == 4:
-            extent4_type = "time"
-        elif suffix == "dwi":
-            extent4_type = "diffusion weighting"
+            record['bvalfile'] = ""
+        if context.exists(bval_file) or context.exists(bvec_file):
+            record['bvek_bval_files'] = 'Yes'
         else:
-            extent4_type = ""
-        dict_append(image03_dict, 'extent4_type', extent4_type)
-
-        dict_append(image03_dict, 'acquisition_matrix', "%g x %g" %(nii.shape[0], nii.shape[1]))
-
-        dict_append(image03_dict, 'image_resolution1', nii.header.get_zooms()[0])
-        dict_append(image03_dict, 'image_resolution2', nii.header.get_zooms()[1])
-        dict_append(image03_dict, 'image_resolution3', nii.header.get_zooms()[2])
-        dict_append(image03_dict, 'image_slice_thickness', metadata_const.get("SliceThickness", nii.header.get_zooms()[2]))
-        dict_append(image03_dict, 'photomet_interpret', metadata.get("global",{}).get("const",{}).get("PhotometricInterpretation",""))
-        if len(nii.shape) > 3:
-            image_resolution4 = nii.header.get_zooms()[3]
+            record['bvek_bval_files'] = 'No'
+    else:
+        record['bvecfile'] = ""
+        record['bvalfile'] = ""
+        record['bvek_bval_files'] = ""
+
+    # the remaining image03 columns (see IMAGE03_COLUMNS) are left empty
+
+    return record
+
+
+def _profiled_image03_record(context, file, inputs=None):
+    """Return the image03 record of `file` and its profiling entry (None unless profiling)
+
+    `inputs` may be a future of the ImageInputs of `file` (see Prefetcher).
+    """
+    profiler = context.profiler
+    profiler.begin_file(file)
+    try:
+        if inputs is not None:
+            with profiler.stage("prefetch_wait"):
+                inputs = inputs.result()
+            if inputs.profile is not None:
+                profiler.merge_file(inputs.profile)
+        record = image03_record(context, file, inputs)
+    except Exception as e:
+        raise RuntimeError(f"Failed to process {file}: {type(e).__name__}: {e}") from e
+    finally:
+        profile_entry = profiler.end_file()
+    return record, profile_entry
+
+
+# Conversion context of a worker process of the pool, set up by _init_worker
+_worker_context = None
+
+
+def _init_worker(context):
+    global _worker_context
+    _worker_context = context
+    if context.profiler.enabled:
+        context.profiler.activate()
+
+
+def _worker_image03_record(file):
+    """_profiled_image03_record() in a worker process of the pool"""
+    return _profiled_image03_record(_worker_context, file)
+
+
+def discover_nifti_files(bids_directory, index=None):
+    """Return all subject (and session) level NIfTI files, sorted by path"""
+    if index is None:
+        index = BIDSIndex(bids_directory)
+    return index.nifti_files()
+
+
+def iter_records(context, nifti_files, jobs=1, cache=None, prefetch=0):
+    """Yield image03 records for `nifti_files`, in order
+
+    With `jobs` > 1 the records (and metadata zips) are produced by a pool
+    of worker processes.  Otherwise, with `prefetch` > 0 the input files of
+    up to `prefetch` upcoming images are read by a Prefetcher.  With a
+    RecordCache, images whose input files did not change since they were
+    cached are not converted again.
+    """
+    inputs = {}
+    cached = {}
+    if cache is not None:
+        with context.profiler.stage("cache"):
+            for file in nifti_files:
+                inputs[file] = image_fingerprint(context, file)
+                record = cache.lookup(file, inputs[file])
+                if record is not None and (not record['data_file2'] or os.path.exists(record['data_file2'])):
+                    cached[file] = record
+    todo = [file for file in nifti_files if file not in cached]
+
+    prefetcher = None
+    if jobs <= 1:
+        # the context is bound per call: several conversions may be iterated at once
+        if prefetch > 0:
+            prefetcher = Prefetcher(context, prefetch)
+            prefetched = prefetcher(todo)
+            new_records = (_profiled_image03_record(context, file, future) for file, future in prefetched)
         else:
-            image_resolution4 = ""
-        dict_append(image03_dict, 'image_resolution4', image_resolution4)
-
-        dict_append(image03_dict, 'image_unit1', units_dict[nii.header.get_xyzt_units()[0]])
-        dict_append(image03_dict, 'image_unit2', units_dict[nii.header.get_xyzt_units()[0]])
-        dict_append(image03_dict, 'image_unit3', units_dict[nii.header.get_xyzt_units()[0]])
-        if len(nii.shape) > 3:
-            image_unit4 = units_dict[nii.header.get_xyzt_units()[1]]
-            if image_unit4 == "Milliseconds":
-                TR = nii.header.get_zooms()[3]/1000.
+            new_records = (_profiled_image03_record(context, file) for file in todo)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1, min(32, len(todo) // (jobs * 4)))
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(context,))
+        new_records = executor.map(_worker_image03_record, todo, chunksize=chunksize)
+
+    try:
+        for file in nifti_files:
+            if file in cached:
+                # participants.tsv and GUID mapping are not part of the
+                # fingerprint, so refresh the fields coming from them
+                record = cached[file].copy()
+                record.update(subject_fields(context, file))
             else:
-                TR = nii.header.get_zooms()[3]
-            dict_append(image03_dict, 'mri_repetition_time_pd', TR)
-        else:
-            image_unit4 = ""
-            dict_append(image03_dict, 'mri_repetition_time_pd', metadata.get("RepetitionTime", ""))
+                record, profile_entry = next(new_records)
+                if profile_entry is not None:
+                    context.profiler.add_file(profile_entry)
+                if cache is not None:
+                    cache.add(file, inputs[file], record)
+            yield record
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if prefetcher is not None:
+            prefetched.close()
+            prefetcher.close()
+
+
+def check_guid_mapping(participants, guid_mapping, strictness='strict', subjects=None):
+    """Check that all participants have a GUID, raising (strict) or warning (warn) about missing ones
+
+    With `subjects` (labels without 'sub-'), only those participants are checked.
+    """
+    # Extract subject list from participant IDs
+    all_subjects = [sub[4:] if sub.startswith('sub-') else sub for sub in participants.participant_ids]
+    if subjects is not None:
+        subjects = set(subjects)
+        all_subjects = [sub for sub in all_subjects if sub in subjects]
+
+    # Check which subjects are actually present in GUID mapping (keyed without 'sub-')
+    missing_subjects = [sub for sub in all_subjects if sub not in guid_mapping]
 
-        dict_append(image03_dict, 'slice_timing', metadata.get("SliceTiming", ""))
-        dict_append(image03_dict, 'image_unit4', image_unit4)
+    # Handle missing subjects based on strictness
+    if missing_subjects:
+        if strictness == 'strict':
+            raise ValueError(f"The following subjects are missing from GUID mapping: {missing_subjects}")
+        elif strictness == 'warn':
+            print(f"WARNING: The following subjects are missing from GUID mapping: {missing_subjects}")
+            print("Continuing with available subjects.")
 
-        dict_append(image03_dict, 'mri_field_of_view_pd', "%g x %g %s" % (nii.header.get_zooms()[0],
-                                                                          nii.header.get_zooms()[1],
-                                                                          units_dict[nii.header.get_xyzt_units()[0]]))
-        dict_append(image03_dict, 'patient_position', 'head first-supine')
 
-        if file.split(os.sep)[-1].split("_")[1].startswith("ses"):
-            visit = file.split(os.sep)[-1].split("_")[1][4:]
-        else:
-            visit = ""
+def iter_image03_records(bids_root, guid_mapping, zip_directory=None, zip_compression=DEFAULT_ZIP_COMPRESSION,
+                         strictness='strict', jobs=1, participant_labels=None, session_labels=None,
+                         shard=None, prefetch=0, suffixes=None):
+    """Lazily yield the image03 records (Image03Record) of a BIDS dataset, one image at a time
+
+    This is the library counterpart of the bids2nda command: nothing is
+    written unless `zip_directory` is given, in which case the metadata zips
+    are written there as images are converted and referenced in data_file2.
 
-        dict_append(image03_dict, 'visit', visit)
+    `guid_mapping` is either the path of a GUID mapping file or a dict
+    mapping participant labels (with or without 'sub-') to GUIDs.
+    Records are yielded in the order of the image paths.  `jobs` and
+    `prefetch` are as for iter_records().  `participant_labels`,
+    `session_labels`, `shard` and `suffixes` restrict the conversion to part
+    of the dataset, see BIDSIndex.
 
-        if len(metadata) > 0 or suffix in ['bold', 'dwi']:
-            _, fname = os.path.split(file)
-            zip_name = fname.split(".")[0] + ".metadata.zip"
+    >>> for record in iter_image03_records("/data/bids", "guids.txt"):
+    ...     print(record['image_file'], record['scan_type'])
+    """
+    if isinstance(guid_mapping, str):
+        guid_mapping = load_guid_mapping(guid_mapping)
+    else:
+        guid_mapping = {key.replace('sub-', ''): value for key, value in guid_mapping.items()}
+    participants = ParticipantsIndex(os.path.join(bids_root, "participants.tsv"))
+    index = BIDSIndex(bids_root, participant_labels, session_labels, shard, suffixes)
+    check_guid_mapping(participants, guid_mapping, strictness, index.subjects if index.filtered else None)
+
+    if zip_directory is not None:
+        os.makedirs(zip_directory, exist_ok=True)
+    context = ConversionContext(bids_root, zip_directory, guid_mapping, participants,
+                                zip_compression=zip_compression, index=index)
+    nifti_files = context.index.nifti_files()
+    participants.check('sub-' + context.entities(file)['sub'] for file in nifti_files)
+    yield from iter_records(context, nifti_files, jobs=jobs, prefetch=prefetch)
+
+
+def _state_filename(filename, index):
+    """Return the name of a state (cache) file of the output directory for the part of a dataset covered by `index`"""
+    if index.shard is None:
+        return filename
+    # shards may run concurrently in the same output directory
+    stem, ext = os.path.splitext(filename)
+    return "%s.shard-%d-of-%d%s" % (stem, index.shard[0], index.shard[1], ext)
+
+
+def image03_filename(index):
+    """Return the name of the image03 file written for the part of a dataset covered by `index`"""
+    if index.shard is not None:
+        return "image03.shard-%d-of-%d.txt" % index.shard
+    if index.filtered:
+        return "image03.partial.txt"
+    return "image03.txt"
 
-            os.makedirs(args.output_directory, exist_ok=True)
 
-            with zipfile.ZipFile(os.path.join(args.output_directory, zip_name), 'w', zipfile.ZIP_DEFLATED) as zipf:
+def run(args):
+    if not getattr(args, 'profile', False):
+        return _convert(args, NullProfiler())
 
-                zipf.writestr(fname.replace(".nii.gz", ".json"), json.dumps(metadata, indent=4, sort_keys=True))
-                if suffix == "bold":
-                    #TODO write a more robust function for finding those files
-                    events_file = file.split("_bold")[0] + "_events.tsv"
-                    arch_name = os.path.split(events_file)[1]
-                    if not os.path.exists(events_file):
-                        task_name = file.split("_task-")[1].split("_")[0]
-                        events_file = os.path.join(args.bids_directory, "task-" + task_name + "_events.tsv")
+    profiler = Profiler()
+    profiler.start()
+    try:
+        image03_file = _convert(args, profiler)
+    finally:
+        profiler.stop()
+    # image03.profile.json, or e.g. image03.shard-1-of-4.profile.json for a shard
+    if image03_file is not None:
+        profile_file = os.path.splitext(image03_file)[0] + PROFILE_FILENAME[len("image03"):]
+    else:
+        os.makedirs(args.output_directory, exist_ok=True)
+        profile_file = os.path.join(args.output_directory, PROFILE_FILENAME)
+    with open(profile_file, "w") as fp:
+        json.dump(profiler.report(top=getattr(args, 'profile_top', 20)), fp, indent=4)
+    print("Profile written to %s" % profile_file)
+    return image03_file
+
+
+# Suffix of the output files while they are being written
+IN_PROGRESS_SUFFIX = ".in-progress"
+
+
+def _convert(args, profiler):
+    """Convert the dataset (or part of it) as configured by `args`; return the image03 file written"""
+
+    check_only = getattr(args, 'check', False)
+    if not check_only:
+        os.makedirs(args.output_directory, exist_ok=True)
+    with profiler.stage("guid_mapping"):
+        # cached in the output directory, which shards of a conversion share,
+        # only by conversions keeping state there
+        keeps_state = getattr(args, 'incremental', False) or getattr(args, 'shard', None) is not None
+        cache_directory = args.output_directory if keeps_state and not check_only else None
+        guid_mapping = load_guid_mapping(args.guid_mapping, cache_directory=cache_directory)
+
+    with profiler.stage("participants_file"):
+        # Load participants file
+        participants_file = os.path.join(args.bids_directory, "participants.tsv")
+        participants = ParticipantsIndex(participants_file)
+
+    with profiler.stage("discovery"):
+        index = BIDSIndex(args.bids_directory,
+                          participant_labels=getattr(args, 'participant_label', None),
+                          session_labels=getattr(args, 'session_label', None),
+                          shard=getattr(args, 'shard', None),
+                          suffixes=getattr(args, 'suffix', None))
+    check_guid_mapping(participants, guid_mapping, args.strictness, index.subjects if index.filtered else None)
+
+    context = ConversionContext(args.bids_directory, args.output_directory, guid_mapping, participants,
+                                zip_compression=getattr(args, 'zip_compression', DEFAULT_ZIP_COMPRESSION),
+                                index=index, profiler=profiler)
+
+    if getattr(args, 'incremental', False) and not check_only:
+        cache = RecordCache(os.path.join(args.output_directory, _state_filename(CACHE_FILENAME, index)))
+    else:
+        cache = None
+
+    nifti_files = discover_nifti_files(args.bids_directory, context.index)
+    if check_only or getattr(args, 'preflight', False):
+        from .preflight import preflight
+        with profiler.stage("preflight"):
+            preflight(context, nifti_files)
+        if check_only:
+            print("Preflight check passed for %d images" % len(nifti_files))
+            return None
+    participants.check('sub-' + context.entities(file)['sub'] for file in nifti_files)
+
+    image03_file = os.path.join(args.output_directory, image03_filename(index))
+    output_files = [image03_file]
+    output_format = getattr(args, 'output_format', None)
+    if output_format is not None:
+        from .columnar import COLUMNAR_EXTENSIONS, Image03ColumnarWriter
+        output_files.append(os.path.splitext(image03_file)[0] + COLUMNAR_EXTENSIONS[output_format])
+    manifest_stage = None
+    completed = False
+    try:
+        with ExitStack() as stack:
+            progress = _progress(args, stack)
+            if progress is not None:
+                progress.discovered(len(nifti_files))
+            # outputs are written to in-progress files, which replace the
+            # previous outputs only once every image is converted
+            writers = [stack.enter_context(Image03Writer(image03_file + IN_PROGRESS_SUFFIX))]
+            if output_format is not None:
+                writers.append(stack.enter_context(
+                    Image03ColumnarWriter(output_files[1] + IN_PROGRESS_SUFFIX, output_format)))
+            records = iter_records(context, nifti_files, jobs=getattr(args, 'jobs', 1), cache=cache,
+                                   prefetch=getattr(args, 'prefetch', 0))
+            if getattr(args, 'manifest', False):
+                from .manifest import DEFAULT_MANIFEST_THREADS, DIGEST_CACHE_FILENAME, DigestCache, ManifestStage
+                digests = DigestCache(os.path.join(args.output_directory,
+                                                   _state_filename(DIGEST_CACHE_FILENAME, index)))
+                manifest_stage = ManifestStage(args.output_directory, digests=digests,
+                                               threads=getattr(args, 'manifest_threads', DEFAULT_MANIFEST_THREADS))
+                records = manifest_stage(records)
+            for record in records:
+                with profiler.stage("output"):
+                    for writer in writers:
+                        writer.write(record)
+                if progress is not None:
+                    progress.update(record)
+            if progress is not None:
+                progress.finish()
+        completed = True
+    finally:
+        for output_file in output_files:
+            if completed:
+                os.replace(output_file + IN_PROGRESS_SUFFIX, output_file)
+            elif os.path.exists(output_file + IN_PROGRESS_SUFFIX):
+                os.remove(output_file + IN_PROGRESS_SUFFIX)
+        if cache is not None:
+            cache.close()
+        if manifest_stage is not None:
+            manifest_stage.close()
+            # keep the digests of other subjects when only some were converted
+            manifest_stage.digests.save(None if _label_filtered(index) else manifest_stage.files)
+    if cache is not None and not _label_filtered(index):
+        # drop entries of images which are gone from the dataset (the cache
+        # of a label filtered run is shared with other runs, keep it whole)
+        cache.compact(nifti_files)
+
+    if getattr(args, 'merge', False) and index.filtered:
+        full_image03_file = os.path.join(args.output_directory, "image03.txt")
+        with profiler.stage("merge"):
+            removed, rows = replace_image03_rows(full_image03_file, read_image03(image03_file), index.selects)
+        print("Replaced %d rows of %s by the %d converted images (%d rows)"
+              % (removed, full_image03_file, len(nifti_files), rows))
+    return image03_file
+
+
+def _label_filtered(index):
+    """Return True if `index` selects subjects, sessions or suffixes (as opposed to a shard or everything)"""
+    return (index.participant_labels is not None or index.session_labels is not None
+            or index.suffixes is not None)
+
+
+def _progress(args, stack):
+    """Return the Progress reporter configured by `args` (None without --progress), closing files on `stack`"""
+    progress_file = getattr(args, 'progress_file', None)
+    if not getattr(args, 'progress', False) and progress_file is None:
+        return None
+    from .progress import Progress
+    # a bar on a terminal, JSON lines events otherwise or to --progress-file
+    bar = sys.stderr if sys.stderr.isatty() else None
+    if progress_file is not None:
+        events = stack.enter_context(open(progress_file, "a"))
+    else:
+        events = None if bar is not None else sys.stderr
+    return Progress(events=events, bar=bar, interval=getattr(args, 'progress_interval', 1.0))
 
-                    if os.path.exists(events_file):
-                        zipf.write(events_file, arch_name)
 
-            dict_append(image03_dict, 'data_file2', os.path.join(args.output_directory, zip_name))
-            dict_append(image03_dict, 'data_file2_type', "ZIP file with additional metadata from Brain Imaging "
-                                                                "Data Structure (http://bids.neuroimaging.io)")
-        else:
-            dict_append(image03_dict, 'data_file2', "")
-            dict_append(image03_dict, 'data_file2_type', "")
+class MyParser(argparse.ArgumentParser):
+    def error(self, message):
+        sys.stderr.write('error: %s\n' % message)
+        self.print_help()
+        sys.exit(2)
 
-        if suffix == "dwi":
-            # TODO write a more robust function for finding those files
-            bvec_file = file.split("_dwi")[0] + "_dwi.bvec"
-            if not os.path.exists(bvec_file):
-                bvec_file = os.path.join(args.bids_directory, "dwi.bvec")
 
-            if os.path.exists(bvec_file):
-                dict_append(image03_dict, 'bvecfile', bvec_file)
-            else:
-                dict_append(image03_dict, 'bvecfile', "")
+def _shard_argument(value):
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
-            bval_file = file.split("_dwi")[0] + "_dwi.bval"
-            if not os.path.exists(bval_file):
-                bval_file = os.path.join(args.bids_directory, "dwi.bval")
 
-            if os.path.exists(bval_file):
-                dict_append(image03_dict, 'bvalfile', bval_file)
-            else:
-                dict_append(image03_dict, 'bvalfile', "")
-            if os.path.exists(bval_file) or os.path.exists(bvec_file):
-                dict_append(image03_dict, 'bvek_bval_files', 'Yes')
-            else:
-                dict_append(image03_dict, 'bvek_bval_files', 'No')
+def merge_main(argv):
+    """bids2nda merge: combine partial image03 files (e.g. of --shard runs) into one"""
+    parser = MyParser(
+        prog="bids2nda merge",
+        description="Merge image03 files written by partial conversions (--shard, --participant-label, "
+                    "--session-label) into a single de-duplicated image03 file sorted by image_file. "
+                    "When an image is in several inputs, the row of the last one is kept.")
+    parser.add_argument(
+        "output",
+        help="image03 file to write, may be one of the inputs",
+        metavar="OUTPUT")
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Partial image03 files",
+        metavar="INPUT")
+    args = parser.parse_args(argv)
+
+    try:
+        rows = merge_image03(args.inputs, args.output)
+    except (OSError, ValueError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    print("Merged %d rows from %d files into %s" % (rows, len(args.inputs), args.output))
+    return 0
+
+
+def watch_main(argv):
+    """bids2nda watch: keep image03.txt up to date while sessions are added to the dataset"""
+    parser = MyParser(
+        prog="bids2nda watch",
+        description="Convert a BIDS dataset, then keep polling it and update OUTPUT_DIRECTORY/image03.txt "
+                    "(rewritten atomically) as images are added, changed or removed.  Only the affected "
+                    "images are converted.  Stop with Ctrl-C.")
+    parser.add_argument("bids_directory", metavar="BIDS_DIRECTORY")
+    parser.add_argument("guid_mapping", metavar="GUID_MAPPING")
+    parser.add_argument("output_directory", metavar="OUTPUT_DIRECTORY")
+    parser.add_argument('--interval',
+                        type=float,
+                        default=30.0,
+                        metavar='SECONDS',
+                        help='Time between two polls of the dataset (default: %(default)s)')
+    parser.add_argument('--strictness',
+                        choices=['strict', 'warn', 'ignore'],
+                        default='strict',
+                        help='How to handle subjects missing from the GUID mapping, see bids2nda -h')
+    parser.add_argument('--zip-compression',
+                        choices=ZIP_COMPRESSION_CHOICES,
+                        default=DEFAULT_ZIP_COMPRESSION,
+                        help='Compression of the metadata zip files (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    from .watch import Watcher
+    watcher = Watcher(args.bids_directory, args.guid_mapping, args.output_directory,
+                      strictness=args.strictness, zip_compression=args.zip_compression)
+    watcher.run(interval=args.interval)
+    return 0
+
+
+def batch_main(argv):
+    """bids2nda batch: convert several datasets with one pool of worker processes"""
+    parser = MyParser(
+        prog="bids2nda batch",
+        description="Convert all datasets listed in BATCH_FILE, a tab separated file with columns "
+                    "bids_directory, guid_mapping and output_directory.  The images of all datasets are "
+                    "converted by the same worker processes; a dataset failing does not stop the others.")
+    parser.add_argument("batch_file", metavar="BATCH_FILE")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Number of worker processes (default: 1)')
+    parser.add_argument('--strictness',
+                        choices=['strict', 'warn', 'ignore'],
+                        default='strict',
+                        help='How to handle subjects missing from the GUID mapping, see bids2nda -h')
+    parser.add_argument('--zip-compression',
+                        choices=ZIP_COMPRESSION_CHOICES,
+                        default=DEFAULT_ZIP_COMPRESSION,
+                        help='Compression of the metadata zip files (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    from .batch import read_batch_file, run_batch
+    try:
+        datasets = read_batch_file(args.batch_file)
+    except (OSError, ValueError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    results = run_batch(datasets, jobs=args.jobs, strictness=args.strictness,
+                        zip_compression=args.zip_compression)
+    for result in results:
+        if result.error is None:
+            print("OK      %s: %d images -> %s" % (result.dataset.bids_directory, result.images,
+                                                   os.path.join(result.dataset.output_directory, "image03.txt")))
         else:
-            dict_append(image03_dict, 'bvecfile', "")
-            dict_append(image03_dict, 'bvalfile', "")
-            dict_append(image03_dict, 'bvek_bval_files', "")
-
-        # comply with image03 changes from 12/30/19
-        # https://nda.nih.gov/data_structure_history.html?short_name=image03
-        
-        dict_append(image03_dict, 'deviceserialnumber', "")
-        dict_append(image03_dict, 'procdate', "")
-        dict_append(image03_dict, 'visnum', "")
-        dict_append(image03_dict, 'manifest', "")
-        dict_append(image03_dict, 'emission_wavelength', "")
-        dict_append(image03_dict, 'objective_magnification', "")
-        dict_append(image03_dict, 'objective_na', "")
-        dict_append(image03_dict, 'immersion', "")
-        dict_append(image03_dict, 'exposure_time', "")
-        dict_append(image03_dict, 'camera_sn', "")
-        dict_append(image03_dict, 'block_number', "")
-        dict_append(image03_dict, 'level', "")
-        dict_append(image03_dict, 'cut_thickness', "")
-        dict_append(image03_dict, 'stain', "")
-        dict_append(image03_dict, 'stain_details', "")
-        dict_append(image03_dict, 'pipeline_stage', "")
-        dict_append(image03_dict, 'deconvolved', "")
-        dict_append(image03_dict, 'decon_software', "")
-        dict_append(image03_dict, 'decon_method', "")
-        dict_append(image03_dict, 'psf_type', "")
-        dict_append(image03_dict, 'psf_file', "")
-        dict_append(image03_dict, 'decon_snr', "")
-        dict_append(image03_dict, 'decon_iterations', "")
-        dict_append(image03_dict, 'micro_temmplate_name', "")
-        dict_append(image03_dict, 'in_stack', "")
-        dict_append(image03_dict, 'decon_template_name', "")
-        dict_append(image03_dict, 'stack', "")
-        dict_append(image03_dict, 'slices', "")
-        dict_append(image03_dict, 'slice_number', "")
-        dict_append(image03_dict, 'slice_thickness', "")
-        dict_append(image03_dict, 'type_of_microscopy', "")
-
-    image03_df = pd.DataFrame(image03_dict)
-
-    with open(os.path.join(args.output_directory, "image03.txt"), "w") as out_fp:
-        out_fp.write('"image"\t"3"\n')
-        image03_df.to_csv(out_fp, sep="\t", index=False, quoting=csv.QUOTE_ALL)
-
-def main():
-    class MyParser(argparse.ArgumentParser):
-        def error(self, message):
-            sys.stderr.write('error: %s\n' % message)
-            self.print_help()
-            sys.exit(2)
+            print("FAILED  %s: %s" % (result.dataset.bids_directory, result.error))
+    failed = sum(result.error is not None for result in results)
+    print("%d datasets converted, %d failed" % (len(results) - failed, failed))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["batch"]:
+        return batch_main(argv[1:])
+    if argv[:1] == ["merge"]:
+        return merge_main(argv[1:])
+    if argv[:1] == ["watch"]:
+        return watch_main(argv[1:])
 
     parser = MyParser(
         description="BIDS to NDA converter.",
@@ -469,12 +1186,116 @@ def main():
                              'strict: raise an error, '
                              'warn: print a warning and continue, '
                              'ignore: silently skip missing subjects')
-    args = parser.parse_args()
+    parser.add_argument('--zip-compression',
+                        choices=ZIP_COMPRESSION_CHOICES,
+                        default=DEFAULT_ZIP_COMPRESSION,
+                        help='Compression of the metadata zip files (default: %(default)s)')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Keep a cache of converted images in OUTPUT_DIRECTORY and only convert '
+                             'images whose input files changed since the previous (possibly '
+                             'interrupted) run')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Record time spent in each conversion stage and file system operations, '
+                             'overall and per image, into %s in OUTPUT_DIRECTORY' % PROFILE_FILENAME)
+    parser.add_argument('--profile-top',
+                        type=int,
+                        default=20,
+                        metavar='N',
+                        help='Number of slowest images listed in the profile (default: %(default)s)')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Number of worker processes used to extract image records and '
+                             'write metadata zips (default: 1)')
+    parser.add_argument('--check',
+                        action='store_true',
+                        help='Only check that the dataset can be converted: report every missing GUID, '
+                             'participants.tsv or scans.tsv row, unknown suffix, bold run without '
+                             'TaskName, unsupported NIfTI units or orientation at once, reading only '
+                             'the .tsv and .json files and NIfTI headers.  Nothing is written')
+    parser.add_argument('--preflight',
+                        action='store_true',
+                        help='Run the --check validation before converting, and stop before any '
+                             'image is converted if it finds problems')
+    parser.add_argument('--manifest',
+                        action='store_true',
+                        help='Write an NDA manifest (<image>.manifest.json: path, size and MD5 of the image, '
+                             'metadata zip, bvec and bval files) for every image and fill the manifest '
+                             'column.  Digests are cached in OUTPUT_DIRECTORY, unchanged files are not '
+                             'hashed again')
+    parser.add_argument('--manifest-threads',
+                        type=int,
+                        default=4,
+                        metavar='N',
+                        help='Number of threads hashing files for --manifest (default: %(default)s)')
+    parser.add_argument('--output-format',
+                        choices=['parquet', 'arrow'],
+                        help='Also write the image03 table with typed columns as Parquet (image03.parquet) '
+                             'or Arrow IPC (image03.arrow), next to image03.txt.  Requires pyarrow')
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=0,
+                        metavar='DEPTH',
+                        help='Read the sidecars, NIfTI headers, scans.tsv and events files of up to DEPTH '
+                             'upcoming images in background threads while the current one is converted, '
+                             'to hide file system latency (e.g. network storage).  Only used with -j 1 '
+                             '(default: 0, off)')
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help='Report progress while converting: images converted, current image, files/s, '
+                             'MB/s read, metadata zip bytes written and estimated time left.  Drawn as a '
+                             'progress bar when stderr is a terminal, written to stderr as JSON lines '
+                             'events otherwise')
+    parser.add_argument('--progress-file',
+                        metavar='FILE',
+                        help='Append JSON lines progress events to FILE (implies --progress)')
+    parser.add_argument('--progress-interval',
+                        type=float,
+                        default=1.0,
+                        metavar='SECONDS',
+                        help='Minimum time between progress events (default: %(default)s)')
+    parser.add_argument('--participant-label',
+                        nargs='+',
+                        metavar='LABEL',
+                        help='Only convert these subjects (with or without "sub-"); other subject '
+                             'directories are not traversed.  Writes image03.partial.txt')
+    parser.add_argument('--session-label',
+                        nargs='+',
+                        metavar='LABEL',
+                        help='Only convert these sessions (with or without "ses-").  Writes '
+                             'image03.partial.txt')
+    parser.add_argument('--suffix',
+                        nargs='+',
+                        metavar='SUFFIX',
+                        help='Only convert images with these suffixes (e.g. T1w bold).  Writes '
+                             'image03.partial.txt')
+    parser.add_argument('--merge',
+                        action='store_true',
+                        help='With --participant-label, --session-label or --suffix, then replace the '
+                             'rows of the selected images in OUTPUT_DIRECTORY/image03.txt by the converted '
+                             'ones, keeping the rows of all other images')
+    parser.add_argument('--shard',
+                        type=_shard_argument,
+                        metavar='I/N',
+                        help='Only convert the Ith of N equal shares of the subject directories (in '
+                             'sorted order), for running conversions in parallel on several nodes.  '
+                             'Writes image03.shard-I-of-N.txt, see "bids2nda merge -h" to combine them')
+    args = parser.parse_args(argv)
+    if args.merge and args.shard is not None:
+        parser.error('--merge cannot be used with --shard, use "bids2nda merge" once all shards are done')
+    if args.merge and args.participant_label is None and args.session_label is None and args.suffix is None:
+        parser.error('--merge requires --participant-label, --session-label or --suffix')
 
     try:
         run(args)
     except Exception as e:
-        import sys
+        from .preflight import PreflightError
+        if isinstance(e, PreflightError):
+            print(e, file=sys.stderr)
+            return 1
         import traceback
         print("An error occurred during metadata extraction:", file=sys.stderr)
         print("-" * 50, file=sys.stderr)
@@ -484,9 +1305,10 @@ def main():
         print(f"Error details: {e}", file=sys.stderr)
         return 1    
     
-    print("Metadata extraction complete.")
+    if not args.check:
+        print("Metadata extraction complete.")
     return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
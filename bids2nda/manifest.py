@@ -0,0 +1,154 @@
+"""NDA manifest files listing the files of every image03 row (``bids2nda --manifest``)
+
+For every record a ``<image>.manifest.json`` file is written next to its
+metadata zip, listing the path, name, size and MD5 checksum of the files
+the row refers to (the image, metadata zip, bvec and bval files), in the
+format NDA's upload tools expect::
+
+    {"files": [{"path": "...", "name": "...", "size": 123, "md5sum": "..."}]}
+
+and its path is set as the record's ``manifest`` column.
+
+Files are hashed in fixed size chunks by a pool of threads (hashlib
+releases the GIL while hashing), so memory use does not depend on file
+sizes.  Digests are cached by path, size and modification time in the
+output directory, so files which did not change are not hashed again by
+later runs.
+"""
+import hashlib
+import json
+import os
+import pickle
+from collections import deque
+
+DIGEST_CACHE_FILENAME = ".bids2nda_digests.pkl"
+
+# Bump whenever the content of the digest cache changes, to invalidate old caches
+DIGEST_CACHE_VERSION = 1
+
+# Columns of the image03 record holding paths of files listed in the manifest
+MANIFEST_FILE_COLUMNS = ('image_file', 'data_file2', 'bvecfile', 'bvalfile')
+
+HASH_CHUNK_SIZE = 1 << 20
+
+DEFAULT_MANIFEST_THREADS = 4
+
+
+def file_md5(path, chunk_size=HASH_CHUNK_SIZE):
+    """Return the MD5 hex digest of the file at `path`, read `chunk_size` bytes at a time"""
+    digest = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DigestCache(object):
+    """File digests keyed by path, cached as long as the size and mtime of the file do not change"""
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._digests = {}
+        self.hashed = 0
+        if cache_file is not None:
+            try:
+                with open(cache_file, "rb") as fp:
+                    version, digests = pickle.load(fp)
+                if version == DIGEST_CACHE_VERSION:
+                    self._digests = digests
+            except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+                pass
+
+    def md5(self, path):
+        """Return (size, MD5 hex digest) of the file at `path`"""
+        st = os.stat(path)
+        cached = self._digests.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return st.st_size, cached[2]
+        md5 = file_md5(path)
+        self.hashed += 1
+        self._digests[path] = (st.st_size, st.st_mtime_ns, md5)
+        return st.st_size, md5
+
+    def save(self, paths=None):
+        """Write the cache file, keeping only the digests of `paths` if given"""
+        if self.cache_file is None:
+            return
+        digests = self._digests
+        if paths is not None:
+            digests = {path: digests[path] for path in paths if path in digests}
+        tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        with open(tmp_file, "wb") as fp:
+            pickle.dump((DIGEST_CACHE_VERSION, digests), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+
+
+def manifest_path(output_directory, image_file):
+    _, fname = os.path.split(image_file)
+    return os.path.join(output_directory, fname.split(".")[0] + ".manifest.json")
+
+
+def manifest_files(record):
+    """Return the paths of the files the image03 `record` refers to"""
+    return [record[column] for column in MANIFEST_FILE_COLUMNS if record.get(column)]
+
+
+def write_manifest(path, files, digests):
+    """Write the manifest of `files` to `path` (unless unchanged), using `digests` (a DigestCache)"""
+    entries = []
+    for file in files:
+        size, md5 = digests.md5(file)
+        entries.append({"path": file, "name": os.path.basename(file), "size": size, "md5sum": md5})
+    content = json.dumps({"files": entries}, indent=4)
+    try:
+        with open(path) as fp:
+            if fp.read() == content:
+                return
+    except OSError:
+        pass
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+class ManifestStage(object):
+    """Write the manifest of records as they stream through, filling their manifest column
+
+    Manifests of up to `depth` records are computed by `threads` threads
+    while the previous records are written out; records are passed on in
+    their original order.
+    """
+
+    def __init__(self, output_directory, threads=DEFAULT_MANIFEST_THREADS, depth=None, digests=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.output_directory = output_directory
+        self.depth = depth or 4 * threads
+        self.digests = digests if digests is not None else DigestCache()
+        self.files = set()
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _manifest(self, record):
+        path = manifest_path(self.output_directory, record['image_file'])
+        files = manifest_files(record)
+        write_manifest(path, files, self.digests)
+        self.files.update(files)
+        # a copy, as the record may be held by the record cache, which must stay manifest-free
+        record = record.copy()
+        record['manifest'] = path
+        return record
+
+    def __call__(self, records):
+        """Yield `records` with their manifest column set, in order"""
+        pending = deque()
+        try:
+            for record in records:
+                pending.append(self._executor.submit(self._manifest, record))
+                if len(pending) > self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
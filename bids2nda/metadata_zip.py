@@ -0,0 +1,75 @@
+"""Writing of the per-image ``.metadata.zip`` files referenced as image03 data_file2
+
+Archives are deterministic: members are written in a fixed order with fixed
+timestamps and permissions, so identical content always gives identical
+bytes.  A hash of the payload (member names, contents and compression) is
+stored in the archive comment, which lets an existing archive be kept
+untouched when the archive which would replace it has the same payload.
+"""
+import hashlib
+import os
+import zipfile
+
+ZIP_COMPRESSION_CHOICES = ['stored'] + ['deflate-%d' % level for level in range(1, 10)]
+
+# zlib's default level, which is what ZIP_DEFLATED uses when no level is given
+DEFAULT_ZIP_COMPRESSION = 'deflate-6'
+
+# Earliest timestamp representable in a zip file
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+COMMENT_PREFIX = b"bids2nda-sha256:"
+
+
+def parse_zip_compression(zip_compression):
+    """Return the (compression, compresslevel) zipfile arguments for a ZIP_COMPRESSION_CHOICES value"""
+    if zip_compression == 'stored':
+        return zipfile.ZIP_STORED, None
+    if zip_compression in ZIP_COMPRESSION_CHOICES:
+        return zipfile.ZIP_DEFLATED, int(zip_compression.split("-")[1])
+    raise ValueError("Unknown zip compression %r, must be one of %s"
+                     % (zip_compression, ", ".join(ZIP_COMPRESSION_CHOICES)))
+
+
+def payload_hash(members, zip_compression=DEFAULT_ZIP_COMPRESSION):
+    """Return the hex digest identifying an archive of `members` ((arcname, bytes) pairs)"""
+    digest = hashlib.sha256(zip_compression.encode())
+    for arcname, data in members:
+        digest.update(b"\0%d:%s\0%d:" % (len(arcname), arcname.encode(), len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def existing_payload_hash(zip_path):
+    """Return the payload hash stored in the comment of `zip_path`, or None"""
+    try:
+        with zipfile.ZipFile(zip_path) as zipf:
+            comment = zipf.comment
+    except (OSError, zipfile.BadZipFile):
+        return None
+    if comment.startswith(COMMENT_PREFIX):
+        return comment[len(COMMENT_PREFIX):].decode("ascii", "replace")
+    return None
+
+
+def write_metadata_zip(zip_path, members, zip_compression=DEFAULT_ZIP_COMPRESSION):
+    """Write `members` ((arcname, bytes) pairs) to `zip_path` unless an identical archive exists
+
+    Returns True if the archive was written and False if it was up to date.
+    """
+    compression, compresslevel = parse_zip_compression(zip_compression)
+    digest = payload_hash(members, zip_compression)
+    if existing_payload_hash(zip_path) == digest:
+        return False
+
+    tmp_path = zip_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression, compresslevel=compresslevel) as zipf:
+        for arcname, data in members:
+            info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+            info.compress_type = compression
+            info.create_system = 3
+            info.external_attr = 0o644 << 16
+            zipf.writestr(info, data, compresslevel=compresslevel)
+        zipf.comment = COMMENT_PREFIX + digest.encode("ascii")
+    os.replace(tmp_path, zip_path)
+    return True
@@ -0,0 +1,125 @@
+"""Fast extraction of the NIfTI header fields used for image03
+
+Only the fixed size NIfTI-1 (348 bytes) or NIfTI-2 (540 bytes) header is
+read: for ``.nii.gz`` files just enough of the gzip stream is decompressed,
+and for plain ``.nii`` files the header is memory-mapped.  Anything the fast
+path does not understand is handed over to nibabel.
+
+numpy and nibabel are only imported once a header is actually read, so that
+importing this module (and the command line interface) stays cheap.
+"""
+import gzip
+import mmap
+import os
+from collections import namedtuple
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# Same labels as nibabel.nifti1.unit_codes
+UNIT_LABELS = {0: 'unknown',
+               1: 'meter',
+               2: 'mm',
+               3: 'micron',
+               8: 'sec',
+               16: 'msec',
+               24: 'usec',
+               32: 'hz',
+               40: 'ppm',
+               48: 'rads'}
+
+NIFTI_EXTENSIONS = (".nii.gz", ".nii")
+
+
+def split_nifti_ext(path):
+    """Split `path` into (stem, extension) for .nii.gz and .nii files"""
+    for ext in NIFTI_EXTENSIONS:
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return os.path.splitext(path)
+
+
+NiftiHeaderRecord = namedtuple('NiftiHeaderRecord', ['shape', 'zooms', 'xyzt_units'])
+NiftiHeaderRecord.__doc__ = """Header fields of a NIfTI image
+
+shape : tuple of int, as nibabel's ``img.shape``
+zooms : tuple of float, as ``img.header.get_zooms()``
+xyzt_units : (str, str), as ``img.header.get_xyzt_units()``
+"""
+
+
+def _read_header_bytes(path):
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as fp:
+            return fp.read(NIFTI2_HEADER_SIZE)
+    with open(path, "rb") as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[:NIFTI2_HEADER_SIZE]
+
+
+def parse_nifti_header(buf):
+    """Parse a raw NIfTI-1 or NIfTI-2 header into a NiftiHeaderRecord
+
+    Returns None if `buf` is not a header the fast path can handle.
+    """
+    import numpy as np
+
+    if len(buf) < 4:
+        return None
+    for endian in ("<", ">"):
+        sizeof_hdr = int(np.frombuffer(buf, dtype=endian + "i4", count=1)[0])
+        if sizeof_hdr in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            break
+    else:
+        return None
+
+    if sizeof_hdr == NIFTI1_HEADER_SIZE:
+        if len(buf) < NIFTI1_HEADER_SIZE or buf[344:348] not in (b"n+1\x00", b"ni1\x00"):
+            return None
+        dims = np.frombuffer(buf, dtype=endian + "i2", count=8, offset=40)
+        pixdims = np.frombuffer(buf, dtype=endian + "f4", count=8, offset=76)
+        xyzt_units = int(buf[123])
+    else:
+        if len(buf) < NIFTI2_HEADER_SIZE or buf[4:8] not in (b"n+2\x00", b"ni2\x00"):
+            return None
+        dims = np.frombuffer(buf, dtype=endian + "i8", count=8, offset=16)
+        pixdims = np.frombuffer(buf, dtype=endian + "f8", count=8, offset=104)
+        xyzt_units = int(np.frombuffer(buf, dtype=endian + "i4", count=1, offset=500)[0])
+
+    ndim = int(dims[0])
+    if not 1 <= ndim <= 7 or (dims[1:ndim + 1] < 1).any():
+        return None
+
+    xyz_code = xyzt_units % 8
+    t_code = xyzt_units - xyz_code
+    if xyz_code not in UNIT_LABELS or t_code not in UNIT_LABELS:
+        return None
+
+    # nibabel fixes negative spatial pixdims to their absolute value when
+    # loading a header (its pixdim[1,2,3] check), and so does get_zooms()
+    zooms = pixdims[1:ndim + 1].copy()
+    zooms[:3] = np.abs(zooms[:3])
+    return NiftiHeaderRecord(shape=tuple(int(d) for d in dims[1:ndim + 1]),
+                             zooms=tuple(zooms),
+                             xyzt_units=(UNIT_LABELS[xyz_code], UNIT_LABELS[t_code]))
+
+
+def read_nifti_header(path):
+    """Return the NiftiHeaderRecord of the NIfTI image at `path`
+
+    Falls back to nibabel for files the fast header parser does not handle
+    (e.g. other formats, unusual dimensions or unit codes).
+    """
+    try:
+        record = parse_nifti_header(_read_header_bytes(path))
+    except (OSError, EOFError, ValueError):
+        record = None
+    if record is not None:
+        return record
+
+    import nibabel as nb
+
+    nii = nb.load(path)
+    return NiftiHeaderRecord(shape=tuple(nii.shape),
+                             zooms=tuple(nii.header.get_zooms()),
+                             xyzt_units=tuple(nii.header.get_xyzt_units()))
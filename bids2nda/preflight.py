@@ -0,0 +1,113 @@
+"""Preflight validation of a conversion (``bids2nda --check`` and ``--preflight``)
+
+Finds, in one pass and without converting anything, the problems which
+would otherwise stop a conversion at the first image having them:
+subjects missing from the GUID mapping or participants.tsv, images without
+a (dated) row in their scans.tsv, suffixes bids2nda has no scan_type for,
+bold runs without TaskName, unsupported NIfTI units and image orientations
+which cannot be deduced.
+
+Only the dataset listing, the .tsv files, the JSON sidecars and the NIfTI
+headers (the first few hundred bytes of each image) are read; no zip is
+written.
+"""
+from collections import namedtuple
+
+from .main import cosines_to_orientations, lookup_scan_date, suffix_to_scan_type, units_dict
+from .nifti_header import read_nifti_header
+
+PreflightProblem = namedtuple("PreflightProblem", ["file", "message"])
+
+# Number of problems listed in the message of a PreflightError
+MAX_REPORTED_PROBLEMS = 50
+
+
+class PreflightError(Exception):
+    """Raised when preflight validation finds problems, all of them being in `problems`"""
+
+    def __init__(self, problems):
+        self.problems = problems
+        lines = ["%s: %s" % problem for problem in problems[:MAX_REPORTED_PROBLEMS]]
+        if len(problems) > MAX_REPORTED_PROBLEMS:
+            lines.append("... and %d more" % (len(problems) - MAX_REPORTED_PROBLEMS))
+        super(PreflightError, self).__init__(
+            "Preflight check found %d problems:\n  %s" % (len(problems), "\n  ".join(lines)))
+
+
+def _check_image(context, file, problems):
+    """Check a single image; return its ImageOrientationPatient if it has one"""
+    entities = context.entities(file)
+    suffix = entities['suffix']
+
+    if entities['sub'] not in context.guid_mapping:
+        problems.append(PreflightProblem(file, "sub-%s is not in the GUID mapping" % entities['sub']))
+
+    if suffix not in suffix_to_scan_type:
+        problems.append(PreflightProblem(file, "no NDA scan_type for suffix %r" % suffix))
+
+    scans_file = context.scans_file(entities['sub'], entities.get('ses'))
+    if not context.exists(scans_file):
+        problems.append(PreflightProblem(file, "%s not found" % scans_file))
+    else:
+        try:
+            lookup_scan_date(context.scans_index(scans_file), scans_file, file)
+        except Exception as e:
+            problems.append(PreflightProblem(file, str(e)))
+
+    try:
+        metadata = context.sidecar_resolver.get_metadata(file)
+    except ValueError as e:
+        problems.append(PreflightProblem(file, "invalid JSON sidecar: %s" % e))
+        metadata = {}
+    if suffix == "bold" and "TaskName" not in metadata:
+        problems.append(PreflightProblem(file, "bold run without TaskName in its sidecars"))
+
+    try:
+        header = read_nifti_header(file)
+    except Exception as e:
+        problems.append(PreflightProblem(file, "unreadable NIfTI header: %s" % e))
+    else:
+        if header.xyzt_units[0] not in units_dict:
+            problems.append(PreflightProblem(file, "unsupported spatial units %r" % (header.xyzt_units[0],)))
+        if len(header.shape) > 3 and header.xyzt_units[1] not in units_dict:
+            problems.append(PreflightProblem(file, "unsupported time units %r" % (header.xyzt_units[1],)))
+
+    metadata_const = metadata.get('global', {}).get('const', {})
+    return metadata.get('ImageOrientationPatientDICOM', metadata_const.get("ImageOrientationPatient", None))
+
+
+def preflight_problems(context, nifti_files):
+    """Return the list of PreflightProblem which converting `nifti_files` would run into"""
+    problems = []
+    try:
+        context.participants.check('sub-' + context.entities(file)['sub'] for file in nifti_files)
+    except Exception as e:
+        problems.append(PreflightProblem(context.participants.participants_file, str(e)))
+
+    iop_files, iops = [], []
+    for file in nifti_files:
+        iop = _check_image(context, file, problems)
+        if not iop:
+            continue
+        try:
+            iop = [float(value) for value in iop]
+        except (TypeError, ValueError):
+            iop = None
+        if iop is None or len(iop) != 6:
+            problems.append(PreflightProblem(file, "ImageOrientationPatient is not 6 numbers"))
+            continue
+        iop_files.append(file)
+        iops.append(iop)
+
+    # orientations of all images at once
+    if iops:
+        _, errors = cosines_to_orientations(iops)
+        problems.extend(PreflightProblem(file, error) for file, error in zip(iop_files, errors) if error)
+    return problems
+
+
+def preflight(context, nifti_files):
+    """Raise a PreflightError listing every problem converting `nifti_files` would run into"""
+    problems = preflight_problems(context, nifti_files)
+    if problems:
+        raise PreflightError(problems)
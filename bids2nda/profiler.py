@@ -0,0 +1,230 @@
+"""Stage and file system profiling of a conversion (``bids2nda --profile``)
+
+A Profiler accumulates wall time and call counts per named stage, and
+counts file system operations (stat, open and directory listing calls, plus
+bytes read and written as reported by ``/proc/self/io`` where available).
+Work done while converting a single image is recorded in a per-file entry
+which is merged into the totals with `add_file()`, so that entries
+produced in worker processes can be sent back and aggregated.  The entry
+being recorded is per thread: work done for an image in another thread
+(e.g. a Prefetcher) gets its own entry, merged into the one of the image
+with `merge_file()`.
+"""
+import builtins
+import io
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+PROFILE_FILENAME = "image03.profile.json"
+
+# Profiler receiving the file system counts of this process, see activate()
+_active_profiler = None
+_originals = {}
+
+
+def _counting(name, func):
+    def wrapper(*args, **kwargs):
+        if _active_profiler is not None:
+            _active_profiler.count(name)
+        return func(*args, **kwargs)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def _install_wrappers():
+    if _originals:
+        return
+    _originals["stat"] = os.stat
+    _originals["lstat"] = os.lstat
+    _originals["scandir"] = os.scandir
+    _originals["open"] = builtins.open
+    os.stat = _counting("stat", os.stat)
+    os.lstat = _counting("stat", os.lstat)
+    os.scandir = _counting("listdir", os.scandir)
+    builtins.open = io.open = _counting("open", builtins.open)
+
+
+def _uninstall_wrappers():
+    if not _originals:
+        return
+    os.stat = _originals.pop("stat")
+    os.lstat = _originals.pop("lstat")
+    os.scandir = _originals.pop("scandir")
+    builtins.open = io.open = _originals.pop("open")
+
+
+def _proc_io():
+    """Return (bytes read, bytes written) of this process so far, or None"""
+    try:
+        with _originals.get("open", builtins.open)("/proc/self/io") as fp:
+            fields = dict(line.split(":") for line in fp.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class NullProfiler(object):
+    """Profiler interface doing nothing, used when profiling is off"""
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def begin_file(self, file):
+        pass
+
+    def end_file(self):
+        return None
+
+    def add_file(self, entry):
+        pass
+
+    def merge_file(self, entry):
+        pass
+
+
+class Profiler(NullProfiler):
+    enabled = True
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.fs = Counter()
+        self.files = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = None
+        self._io_start = None
+        self.wall_seconds = None
+
+    def __getstate__(self):
+        # worker processes get a fresh profiler
+        return {"enabled": True}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def activate(self):
+        """Count file system operations of this process into this profiler"""
+        global _active_profiler
+        _install_wrappers()
+        _active_profiler = self
+
+    def deactivate(self):
+        global _active_profiler
+        _active_profiler = None
+        _uninstall_wrappers()
+
+    def start(self):
+        self.activate()
+        self._start = time.perf_counter()
+        self._io_start = _proc_io()
+
+    def stop(self):
+        self.wall_seconds = time.perf_counter() - self._start
+        io_end = _proc_io()
+        if self._io_start is not None and io_end is not None:
+            self.fs["bytes_read"] += io_end[0] - self._io_start[0]
+            self.fs["bytes_written"] += io_end[1] - self._io_start[1]
+        self.deactivate()
+
+    @property
+    def _file(self):
+        """Entry of the image being profiled in the current thread, or None"""
+        return getattr(self._local, "file", None)
+
+    @_file.setter
+    def _file(self, entry):
+        self._local.file = entry
+
+    def count(self, name, n=1):
+        file = self._file
+        if file is not None:
+            file["fs"][name] += n
+        else:
+            with self._lock:
+                self.fs[name] += n
+
+    def _add_stage(self, stages, name, seconds, calls=1):
+        totals = stages.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            file = self._file
+            if file is not None:
+                self._add_stage(file["stages"], name, seconds)
+            else:
+                with self._lock:
+                    self._add_stage(self.stages, name, seconds)
+
+    def begin_file(self, file):
+        self._file = {"file": file, "stages": OrderedDict(), "fs": Counter(),
+                      "_pid": os.getpid(), "_start": time.perf_counter(), "_io": _proc_io()}
+
+    def end_file(self):
+        """Finish the entry started by begin_file() and return it"""
+        entry, self._file = self._file, None
+        entry["seconds"] = time.perf_counter() - entry.pop("_start")
+        io_start, io_end = entry.pop("_io"), _proc_io()
+        if io_start is not None and io_end is not None:
+            entry["fs"]["bytes_read"] = io_end[0] - io_start[0]
+            entry["fs"]["bytes_written"] = io_end[1] - io_start[1]
+        entry["fs"] = dict(entry["fs"])
+        return entry
+
+    def merge_file(self, entry):
+        """Merge an entry recorded for the current image in another thread into the current entry
+
+        Bytes read and written are left out, as /proc/self/io counts them
+        for the whole process and they are already part of the current entry
+        or of the totals.
+        """
+        file = self._file
+        for name, (seconds, calls) in entry["stages"].items():
+            self._add_stage(file["stages"], name, seconds, calls)
+        for name, n in entry["fs"].items():
+            if not name.startswith("bytes_"):
+                file["fs"][name] += n
+
+    def add_file(self, entry):
+        """Merge a per-file entry (possibly from another process) into the totals"""
+        pid = entry.pop("_pid")
+        self.files.append(entry)
+        for name, (seconds, calls) in entry["stages"].items():
+            self._add_stage(self.stages, name, seconds, calls)
+        for name, n in entry["fs"].items():
+            # bytes of this process are counted for the whole run in stop()
+            if not (name.startswith("bytes_") and pid == os.getpid()):
+                self.fs[name] += n
+
+    def report(self, top=20):
+        """Return the summary, the `top` slowest images and the per-file table as a dict"""
+        n_files = len(self.files)
+        summary = OrderedDict()
+        summary["wall_seconds"] = self.wall_seconds
+        summary["images"] = n_files
+        summary["images_per_second"] = (n_files / self.wall_seconds) if self.wall_seconds else None
+        summary["stages"] = OrderedDict(
+            (name, {"seconds": seconds, "calls": calls}) for name, (seconds, calls) in self.stages.items())
+        summary["fs"] = dict(self.fs)
+
+        def file_row(entry):
+            return OrderedDict([("file", entry["file"]),
+                                ("seconds", entry["seconds"]),
+                                ("stages", OrderedDict((name, seconds)
+                                                       for name, (seconds, _) in entry["stages"].items())),
+                                ("fs", entry["fs"])])
+
+        files = [file_row(entry) for entry in self.files]
+        slowest = sorted(files, key=lambda row: row["seconds"], reverse=True)[:top]
+        return OrderedDict([("summary", summary), ("slowest", slowest), ("files", files)])
@@ -0,0 +1,161 @@
+"""Progress and throughput reporting of a conversion (``bids2nda --progress``)
+
+A Progress reports, as JSON lines events and/or as a one line progress bar
+redrawn on a terminal, how many images were found and converted, the image
+being converted, the conversion rate over the last few seconds, the rate
+at which input files are read, the size of the metadata zips written and
+the estimated time left.  Events look like::
+
+    {"event": "discovered", "elapsed": 0.12, "total": 1200}
+    {"event": "progress", "elapsed": 4.0, "completed": 96, "total": 1200, "file": "...",
+     "files_per_second": 24.1, "mb_per_second": 3.2, "bytes_read": 12800000, "zip_bytes": 402000,
+     "eta_seconds": 45.8}
+    {"event": "done", ...}
+
+update() is called for every converted image but only counts it; events
+are written at most every `interval` seconds, so that reporting costs
+next to nothing per image.  Bytes read are those of this process and its
+worker processes, as reported by ``/proc/<pid>/io`` (null where that is
+not available).
+"""
+from __future__ import print_function
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+
+DEFAULT_INTERVAL = 1.0
+
+# Rates are computed over the events of the last RATE_WINDOW seconds
+RATE_WINDOW = 10.0
+
+BAR_WIDTH = 24
+
+
+def _bytes_read(pid):
+    try:
+        with open("/proc/%d/io" % pid) as fp:
+            for line in fp:
+                if line.startswith("rchar:"):
+                    return int(line.split(":")[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds) if hours else "%02d:%02d" % (minutes, seconds)
+
+
+class Progress(object):
+    """Report the progress of a conversion to `events` (JSON lines) and/or `bar` (a terminal) streams"""
+
+    def __init__(self, events=None, bar=None, interval=DEFAULT_INTERVAL):
+        self.events = events
+        self.bar = bar
+        self.interval = interval
+        self.total = None
+        self.completed = 0
+        self.zip_bytes = 0
+        self.file = None
+        self._start = time.monotonic()
+        self._next_report = self._start + interval
+        self._pending_zips = []
+        # pid -> bytes read, kept for worker processes which exited
+        self._process_bytes = {}
+        self._samples = deque()
+
+    def _bytes_read(self):
+        pids = [os.getpid()] + [process.pid for process in multiprocessing.active_children()]
+        for pid in pids:
+            count = _bytes_read(pid)
+            if count is not None:
+                self._process_bytes[pid] = count
+        if os.getpid() not in self._process_bytes:
+            return None
+        return sum(self._process_bytes.values())
+
+    def _state(self, now):
+        for zip_file in self._pending_zips:
+            try:
+                self.zip_bytes += os.path.getsize(zip_file)
+            except OSError:
+                pass
+        del self._pending_zips[:]
+        bytes_read = self._bytes_read()
+
+        # rates over the samples of the last RATE_WINDOW seconds
+        self._samples.append((now, self.completed, bytes_read))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= RATE_WINDOW:
+            self._samples.popleft()
+        then, completed_then, bytes_then = self._samples[0]
+        seconds = now - then
+        files_per_second = mb_per_second = eta = None
+        if seconds > 0 and len(self._samples) > 1:
+            files_per_second = (self.completed - completed_then) / seconds
+            if bytes_read is not None and bytes_then is not None:
+                mb_per_second = (bytes_read - bytes_then) / seconds / 1e6
+            if files_per_second > 0 and self.total is not None:
+                eta = (self.total - self.completed) / files_per_second
+
+        def rounded(value, digits=3):
+            return None if value is None else round(value, digits)
+
+        return {"elapsed": rounded(now - self._start), "completed": self.completed, "total": self.total,
+                "file": self.file, "files_per_second": rounded(files_per_second),
+                "mb_per_second": rounded(mb_per_second), "bytes_read": bytes_read, "zip_bytes": self.zip_bytes,
+                "eta_seconds": rounded(eta, 1)}
+
+    def _emit(self, event, state):
+        if self.events is not None:
+            state = dict(state, event=event)
+            self.events.write(json.dumps(state, sort_keys=True) + "\n")
+            self.events.flush()
+        if self.bar is not None and event != "discovered":
+            self._draw(state, final=event == "done")
+
+    def _draw(self, state, final=False):
+        total = state["total"] or 0
+        fraction = min(1.0, float(state["completed"]) / total) if total else 1.0
+        filled = int(round(fraction * BAR_WIDTH))
+        line = "[%s%s] %d/%d %3d%%" % ("#" * filled, "." * (BAR_WIDTH - filled), state["completed"], total,
+                                      100 * fraction)
+        if state["files_per_second"] is not None:
+            line += " %.1f files/s" % state["files_per_second"]
+        if state["mb_per_second"] is not None:
+            line += " %.1f MB/s" % state["mb_per_second"]
+        if final:
+            line += " in %s" % _format_seconds(state["elapsed"])
+        else:
+            line += " ETA %s" % _format_seconds(state["eta_seconds"])
+        self.bar.write("\r" + line.ljust(79))
+        if final:
+            self.bar.write("\n")
+        self.bar.flush()
+
+    def discovered(self, total):
+        """Report the number of images to convert"""
+        self.total = total
+        now = time.monotonic()
+        self._samples.append((now, 0, self._bytes_read()))
+        self._emit("discovered", {"elapsed": round(now - self._start, 3), "total": total})
+
+    def update(self, record):
+        """Count the image03 `record` of an image as converted"""
+        self.completed += 1
+        self.file = record['image_file']
+        if record['data_file2']:
+            self._pending_zips.append(record['data_file2'])
+        now = time.monotonic()
+        if now >= self._next_report:
+            self._next_report = now + self.interval
+            self._emit("progress", self._state(now))
+
+    def finish(self):
+        """Report the end of the conversion"""
+        self._emit("done", self._state(time.monotonic()))
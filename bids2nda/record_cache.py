@@ -0,0 +1,96 @@
+"""Persistent cache of image03 records for incremental conversions
+
+Every converted image is appended to a cache file in the output directory
+together with the size and modification time of each input file its record
+was built from (the NIfTI itself, its sidecar chain, scans.tsv, events and
+bval/bvec files) and the options of the metadata zip (directory and
+compression).  On the next run images whose inputs and options did not
+change reuse their cached record instead of being converted again.  Entries are written
+as soon as an image is done, so an interrupted run resumes where it stopped.
+"""
+import os
+import pickle
+
+CACHE_FILENAME = ".bids2nda_cache.pkl"
+
+# Bump whenever the content of image03 records changes, to invalidate old caches
+CACHE_VERSION = 2
+
+
+def fingerprint(paths, exists=None):
+    """Return a (path, size, mtime) tuple for every path, size and mtime being None for missing files
+
+    `exists`, if given, is a callable telling which paths are worth a stat call.
+    """
+    result = []
+    for path in paths:
+        if exists is not None and not exists(path):
+            result.append((path, None, None))
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            result.append((path, None, None))
+        else:
+            result.append((path, st.st_size, st.st_mtime_ns))
+    return tuple(result)
+
+
+class RecordCache(object):
+    """Append-only on-disk cache of image03 records keyed by image file"""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._entries = {}
+        self._fp = None
+        if os.path.exists(cache_file):
+            self._load()
+
+    def _load(self):
+        with open(self.cache_file, "r+b") as fp:
+            while True:
+                offset = fp.tell()
+                try:
+                    version, image_file, inputs, record = pickle.load(fp)
+                except Exception:
+                    # end of file, or an entry truncated by an interrupted run,
+                    # which is dropped so that new entries can be appended
+                    fp.truncate(offset)
+                    break
+                if version == CACHE_VERSION:
+                    self._entries[image_file] = (inputs, record)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, image_file, inputs):
+        """Return the cached record of `image_file` if it was built from the same `inputs`, else None"""
+        entry = self._entries.get(image_file)
+        if entry is None or entry[0] != inputs:
+            return None
+        return entry[1]
+
+    def add(self, image_file, inputs, record):
+        """Store `record` and append it to the cache file right away"""
+        self._entries[image_file] = (inputs, record)
+        if self._fp is None:
+            self._fp = open(self.cache_file, "ab")
+        pickle.dump((CACHE_VERSION, image_file, inputs, record), self._fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def compact(self, image_files):
+        """Rewrite the cache file with only the entries of `image_files`"""
+        self.close()
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "wb") as fp:
+            for image_file in image_files:
+                if image_file in self._entries:
+                    inputs, record = self._entries[image_file]
+                    pickle.dump((CACHE_VERSION, image_file, inputs, record), fp,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from ..batch import read_batch_file, run_batch
+from ..benchmark import generate_dataset
+from ..image03 import read_image03
+from ..main import main
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_run_batch(tmp_path, jobs):
+    datasets = []
+    for site in ["a", "b", "c", "d"]:
+        bids_root = str(tmp_path / site / "bids")
+        guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=1)
+        datasets.append((bids_root, guid_mapping, str(tmp_path / site / "nda")))
+    # site b has an image without scans.tsv row
+    scans_file = os.path.join(datasets[1][0], "sub-0002", "ses-1", "sub-0002_ses-1_scans.tsv")
+    with open(scans_file) as fp:
+        lines = fp.read().splitlines()
+    with open(scans_file, "w") as fp:
+        fp.write("\n".join(lines[:-1]) + "\n")
+
+    # site d has a session without scans.tsv
+    os.remove(os.path.join(datasets[3][0], "sub-0001", "ses-1", "sub-0001_ses-1_scans.tsv"))
+
+    batch_file = str(tmp_path / "batch.tsv")
+    with open(batch_file, "w") as fp:
+        fp.write("bids_directory\tguid_mapping\toutput_directory\n")
+        for dataset in datasets + [(str(tmp_path / "missing"), datasets[0][1], str(tmp_path / "missing_nda"))]:
+            fp.write("\t".join(dataset) + "\n")
+
+    results = run_batch(read_batch_file(batch_file), jobs=jobs)
+    assert [result.images for result in results] == [n_images, 0, n_images, 0, 0]
+    assert results[0].error is None and results[2].error is None
+    assert "has no row with filename" in results[1].error
+    assert "sub-0001_ses-1_scans.tsv file not found" in results[3].error
+    assert "participants.tsv" in results[4].error
+    assert not os.path.exists(os.path.join(datasets[3][2], "image03.txt"))
+    assert len(list(read_image03(os.path.join(datasets[2][2], "image03.txt")))) == n_images
+    assert not os.path.exists(os.path.join(datasets[1][2], "image03.txt"))
+    assert [name for name in os.listdir(datasets[1][2]) if name.endswith(".tmp")] == []
+
+    assert main(["batch", batch_file, "-j", str(jobs)]) == 1
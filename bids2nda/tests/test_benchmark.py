@@ -0,0 +1,38 @@
+import json
+import os
+
+import pytest
+
+from ..benchmark import benchmark_startup, generate_dataset, main, run_benchmark
+
+
+@pytest.mark.parametrize("sessions", [0, 2])
+def test_generate_and_convert(tmp_path, sessions):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=3, sessions=sessions, runs=2)
+    assert n_images == 3 * max(sessions, 1) * 4
+
+    output_directory = str(tmp_path / "nda")
+    results = run_benchmark(bids_root, guid_mapping, output_directory)
+    assert results["end_to_end"]["files"] == n_images
+    assert "help_seconds" in results["startup"]
+    assert set(results["stages"]) == {"discovery", "sidecars", "headers", "zips", "output"}
+
+    with open(os.path.join(output_directory, "image03.txt")) as fp:
+        lines = fp.read().splitlines()
+    assert len(lines) == 2 + n_images
+    assert len([f for f in os.listdir(output_directory) if f.endswith(".metadata.zip")]) == n_images
+
+
+def test_benchmark_main(tmp_path):
+    output = str(tmp_path / "bench.json")
+    assert main(["--subjects", "2", "--runs", "1", "--output", output]) == 0
+    with open(output) as fp:
+        results = json.load(fp)
+    assert results["dataset"]["images"] == 6
+
+
+def test_startup_does_not_import_heavy_modules():
+    results = benchmark_startup(repeat=1)
+    assert results["heavy_modules_imported"] == []
+    assert results["import_seconds"] > 0
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from ..bids_index import BIDSIndex, parse_entities, parse_shard
+
+
+def test_parse_entities():
+    assert parse_entities("sub-01_ses-1_task-rest_acq-mb_run-2_bold.nii.gz") == {
+        'sub': '01', 'ses': '1', 'task': 'rest', 'acq': 'mb', 'run': '2',
+        'suffix': 'bold', 'extension': '.nii.gz'}
+    assert parse_entities("task-rest_bold.json") == {'task': 'rest', 'suffix': 'bold', 'extension': '.json'}
+    assert parse_entities("dwi.bval") == {'suffix': 'dwi', 'extension': '.bval'}
+
+
+def test_bids_index(tmp_path):
+    files = ["participants.tsv",
+             "task-rest_bold.json",
+             "sub-01/sub-01_scans.tsv",
+             "sub-01/anat/sub-01_T1w.nii.gz",
+             "sub-01/anat/sub-01_T1w.json",
+             "sub-02/ses-1/sub-02_ses-1_scans.tsv",
+             "sub-02/ses-1/func/sub-02_ses-1_task-rest_bold.nii",
+             "sub-02/ses-1/func/sub-02_ses-1_task-rest_events.tsv",
+             "sub-02/ses-1/func/.sub-02_ses-1_task-rest_bold.nii.gz",
+             "derivatives/sub-01/anat/sub-01_T1w.nii.gz"]
+    for fname in files:
+        path = tmp_path / fname
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+
+    index = BIDSIndex(str(tmp_path))
+    assert index.nifti_files() == [str(tmp_path / "sub-01/anat/sub-01_T1w.nii.gz"),
+                                   str(tmp_path / "sub-02/ses-1/func/sub-02_ses-1_task-rest_bold.nii")]
+    assert index.exists(str(tmp_path / "task-rest_bold.json"))
+    assert index.exists(str(tmp_path / "sub-02/ses-1/sub-02_ses-1_scans.tsv"))
+    assert index.exists(os.path.join(str(tmp_path), "sub-02", "ses-1", "func", "sub-02_ses-1_task-rest_events.tsv"))
+    assert not index.exists(str(tmp_path / "sub-01/anat/sub-01_T2w.json"))
+    assert index.entities(index.nifti_files()[1])['task'] == 'rest'
+
+
+def test_bids_index_filters(tmp_path):
+    for fname in ["sub-01/anat/sub-01_T1w.nii.gz",
+                  "sub-02/ses-1/anat/sub-02_ses-1_T1w.nii.gz",
+                  "sub-02/ses-2/anat/sub-02_ses-2_T1w.nii.gz",
+                  "sub-03/ses-1/anat/sub-03_ses-1_T1w.nii.gz"]:
+        path = tmp_path / fname
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+
+    def names(index):
+        return [os.path.basename(path) for path in index.nifti_files()]
+
+    assert not BIDSIndex(str(tmp_path)).filtered
+    index = BIDSIndex(str(tmp_path), participant_labels=["sub-02", "03"])
+    assert index.filtered and index.subjects == ["02", "03"]
+    assert names(index) == ["sub-02_ses-1_T1w.nii.gz", "sub-02_ses-2_T1w.nii.gz", "sub-03_ses-1_T1w.nii.gz"]
+    assert names(BIDSIndex(str(tmp_path), session_labels=["1"])) == ["sub-02_ses-1_T1w.nii.gz",
+                                                                     "sub-03_ses-1_T1w.nii.gz"]
+    index = BIDSIndex(str(tmp_path), participant_labels=["02"], session_labels=["2"])
+    assert index.selects(str(tmp_path / "sub-02/ses-2/func/sub-02_ses-2_task-rest_bold.nii.gz"))
+    assert not index.selects(str(tmp_path / "sub-02/ses-1/anat/sub-02_ses-1_T1w.nii.gz"))
+    assert not index.selects(str(tmp_path / "sub-01/anat/sub-01_T1w.nii.gz"))
+    shards = [BIDSIndex(str(tmp_path), shard=(i, 2)) for i in (1, 2)]
+    assert [index.subjects for index in shards] == [["01", "03"], ["02"]]
+    assert sorted(names(shards[0]) + names(shards[1])) == names(BIDSIndex(str(tmp_path)))
+
+
+def test_bids_index_suffixes(tmp_path):
+    for fname in ["sub-01/anat/sub-01_T1w.nii.gz",
+                  "sub-01/anat/sub-01_T1w.json",
+                  "sub-01/func/sub-01_task-rest_bold.nii.gz",
+                  "sub-02/ses-1/func/sub-02_ses-1_task-rest_bold.nii",
+                  "sub-02/ses-1/dwi/sub-02_ses-1_dwi.nii.gz"]:
+        path = tmp_path / fname
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+
+    index = BIDSIndex(str(tmp_path), suffixes=["bold"])
+    assert index.filtered and index.subjects == ["01", "02"]
+    assert [os.path.basename(path) for path in index.nifti_files()] == ["sub-01_task-rest_bold.nii.gz",
+                                                                        "sub-02_ses-1_task-rest_bold.nii"]
+    # other files are still indexed
+    assert index.exists(str(tmp_path / "sub-01/anat/sub-01_T1w.json"))
+    assert index.selects(str(tmp_path / "sub-03/func/sub-03_task-rest_bold.nii.gz")) is False
+    assert index.selects(str(tmp_path / "sub-02/func/sub-02_task-other_bold.nii.gz"))
+    assert not index.selects(str(tmp_path / "sub-02/ses-1/dwi/sub-02_ses-1_dwi.nii.gz"))
+
+
+def test_parse_shard():
+    assert parse_shard("1/1") == (1, 1)
+    for shard in ["0/2", "3/2", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from ..image03 import IMAGE03_COLUMNS
+
+pa = pytest.importorskip("pyarrow")
+
+from ..columnar import Image03ColumnarWriter  # noqa: E402
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_columnar_writer(tmp_path, output_format, capsys):
+    path = str(tmp_path / ("image03." + output_format))
+    with Image03ColumnarWriter(path, output_format, row_group_size=2) as writer:
+        writer.write({'subjectkey': 'NDAR_INV0001', 'interview_age': 360, 'image_extent4': '',
+                      'image_resolution1': np.float32(1.1), 'slice_timing': [0.0, 0.5]})
+        writer.write({'subjectkey': 'NDAR_INV0002', 'image_extent4': np.int64(200),
+                      'mri_echo_time_pd': 'n/a', 'slice_timing': ''})
+        writer.write({'subjectkey': 'NDAR_INV0003'})
+    assert "1 values of column mri_echo_time_pd are not numbers" in capsys.readouterr().err
+
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        assert pq.ParquetFile(path).num_row_groups == 2
+    else:
+        import pyarrow.ipc as ipc
+        table = ipc.open_file(path).read_all()
+    assert table.column_names == list(IMAGE03_COLUMNS)
+    assert table.schema.field('image_extent4').type == pa.int64()
+    rows = table.to_pylist()
+    assert [row['subjectkey'] for row in rows] == ['NDAR_INV0001', 'NDAR_INV0002', 'NDAR_INV0003']
+    assert [row['image_extent4'] for row in rows] == [None, 200, None]
+    assert rows[0]['image_resolution1'] == 1.1
+    assert rows[0]['interview_age'] == 360
+    assert [row['slice_timing'] for row in rows] == [[0.0, 0.5], None, None]
+    assert rows[1]['mri_echo_time_pd'] is None
+    assert rows[2]['type_of_microscopy'] == ''
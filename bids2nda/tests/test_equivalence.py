@@ -0,0 +1,59 @@
+import os
+import zipfile
+
+from ..benchmark import generate_dataset
+from ..equivalence import cells_equal, check_equivalence, compare_outputs, json_equal, main, normalize_zoom
+
+
+def test_cells_equal():
+    assert cells_equal('image_resolution1', '1.1', '1.100000023841858')
+    assert not cells_equal('image_resolution1', '1.1', '1.2')
+    assert cells_equal('image_extent1', '64', '64.0')
+    assert cells_equal('slice_timing', '[0.0, 0.5]', '[0, 0.5000000001]')
+    assert not cells_equal('slice_timing', '[0.0, 0.5]', '[0.0]')
+    # dates and other text must be identical
+    assert not cells_equal('interview_date', '01/02/2020', '1/2/2020')
+    assert json_equal({"a": [1, 2.0]}, {"a": [1.0, 2.0000000001]})
+    assert not json_equal({"a": True}, {"a": 1})
+
+
+def test_normalize_zoom():
+    assert normalize_zoom('3.299999952316284') == '3.3'
+    assert normalize_zoom('2.0') == '2.0'
+    # not a float32 value (e.g. from a sidecar), or not a number
+    assert normalize_zoom('3.3') == '3.3'
+    assert normalize_zoom('') == ''
+
+
+def test_check_equivalence(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, _ = generate_dataset(bids_root, subjects=3, sessions=1, runs=1)
+    work_directory = str(tmp_path / "work")
+    results = check_equivalence(bids_root, guid_mapping, work_directory, ["default", "jobs", "incremental-warm"])
+    assert results == {"default": [], "jobs": [], "incremental-warm": []}
+    # the reference image03.txt is written by pandas, with the float64 digits of the float32 voxel sizes
+    with open(os.path.join(work_directory, "reference", "image03.txt")) as fp:
+        assert '"3.299999952316284"' in fp.read()
+
+    # perturb a cell and a zip member of a candidate output
+    candidate = os.path.join(work_directory, "jobs")
+    image03_file = os.path.join(candidate, "image03.txt")
+    with open(image03_file) as fp:
+        lines = fp.read().splitlines(True)
+    lines[2] = lines[2].replace('"176"', '"177"', 1).replace('"1.0"', '"1.0000000001"', 1)
+    with open(image03_file, "w") as fp:
+        fp.writelines(lines)
+    zip_name = sorted(name for name in os.listdir(candidate) if name.endswith(".metadata.zip"))[0]
+    with zipfile.ZipFile(os.path.join(candidate, zip_name), "a") as zf:
+        zf.writestr("extra.txt", "")
+
+    differences = compare_outputs(os.path.join(work_directory, "reference"), candidate)
+    assert any(difference.where.endswith("column image_extent1") for difference in differences)
+    # within tolerance
+    assert not any(difference.where.endswith("column image_resolution1") for difference in differences)
+    assert any(difference.where == "%s members" % zip_name for difference in differences)
+
+
+def test_main(tmp_path, capsys):
+    assert main(["--subjects", "2", "--runs", "1", "--variant", "prefetch"]) == 0
+    assert "prefetch" in capsys.readouterr().out
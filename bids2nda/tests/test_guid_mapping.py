@@ -0,0 +1,72 @@
+import os
+import pickle
+
+import pytest
+
+from ..benchmark import generate_dataset
+from ..guid_mapping import GUID_CACHE_PREFIX, GUID_CACHE_VERSION, GUIDMappingError, load_guid_mapping, read_guid_mapping
+from ..main import main
+from ..verify_guid_file import verify_guid_file
+
+
+def test_load_guid_mapping(tmp_path):
+    path = str(tmp_path / "guids.txt")
+    with open(path, "w") as fp:
+        fp.write("sub-01 - NDAR_INVAB123CDE\r\n"
+                 "\n"
+                 "02 - NDARAB123CDF\n"
+                 "sub-01 - NDAR_INVAB123CDE\n"
+                 "sub-03 - 1234\n")
+    mapping, problems = read_guid_mapping(path)
+    assert mapping == {'01': 'NDAR_INVAB123CDE', '02': 'NDARAB123CDF', '03': '1234'}
+    assert [(problem.line_number, problem.severity) for problem in problems] == [(4, "warning"), (5, "warning")]
+    assert load_guid_mapping(path, warn=False) == mapping
+    assert verify_guid_file(path)
+
+    with open(path, "a") as fp:
+        fp.write("sub-04 NDAR_INVAB123CDG\n"
+                 "sub-02 - NDAR_INVAB123CDH\n")
+    with pytest.raises(GUIDMappingError) as excinfo:
+        load_guid_mapping(path)
+    assert [problem.line_number for problem in excinfo.value.problems] == [6, 7]
+    assert "line 7: error: sub-02 already mapped to NDARAB123CDF on line 3" in str(excinfo.value)
+    assert not verify_guid_file(path)
+
+
+def test_guid_mapping_cache(tmp_path):
+    path = str(tmp_path / "guids.txt")
+    with open(path, "w") as fp:
+        fp.write("sub-01 - NDAR_INVAB123CDE\n")
+    cache_directory = str(tmp_path / "cache")
+    os.makedirs(cache_directory)
+
+    assert load_guid_mapping(path, cache_directory) == {'01': 'NDAR_INVAB123CDE'}
+    cache_files = [name for name in os.listdir(cache_directory) if name.startswith(GUID_CACHE_PREFIX)]
+    assert len(cache_files) == 1
+
+    # the cache is keyed by content: same content is read from the cache,
+    # changed content is parsed again
+    with open(os.path.join(cache_directory, cache_files[0]), "wb") as fp:
+        pickle.dump((GUID_CACHE_VERSION, {'01': 'cached'}, []), fp)
+    assert load_guid_mapping(path, cache_directory) == {'01': 'cached'}
+    with open(path, "w") as fp:
+        fp.write("sub-01 - NDAR_INVAB123CDF\n")
+    assert load_guid_mapping(path, cache_directory) == {'01': 'NDAR_INVAB123CDF'}
+    # the cache of the previous content is removed
+    assert len(os.listdir(cache_directory)) == 1
+    assert os.listdir(cache_directory) != cache_files
+
+
+def test_guid_mapping_cache_of_conversions(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, _ = generate_dataset(bids_root, subjects=2, sessions=1, runs=1)
+    output_directory = str(tmp_path / "nda")
+
+    def cache_files():
+        return [name for name in os.listdir(output_directory) if name.startswith(GUID_CACHE_PREFIX)]
+
+    # only conversions keeping state in the output directory cache the mapping there
+    assert main([bids_root, guid_mapping, output_directory]) == 0
+    assert cache_files() == []
+    assert main([bids_root, guid_mapping, output_directory, "--incremental"]) == 0
+    assert len(cache_files()) == 1
@@ -1,8 +1,202 @@
-from ..main import cosine_to_orientation
+import argparse
+import os
+
+import numpy as np
+import pytest
+
+from ..benchmark import generate_dataset
+from ..image03 import Image03Record
+from .. import main
+from ..main import (cosine_to_orientation, cosines_to_orientations, get_metadata_for_nifti, iter_image03_records,
+                    load_scans_index, lookup_scan_date, ParticipantsIndex, Prefetcher, SidecarResolver)
+from ..profiler import NullProfiler
 
 
 def test_cosine_to_orientation():
     assert cosine_to_orientation([0.9, -0.03, -0.1, 0.03, 0.9, 0.1]) == 'Axial'
     assert cosine_to_orientation([0, 0.9, 0.1, 0.03, 0.1, -0.9]) == 'Sagittal'
+    assert cosine_to_orientation([1, 0, 0, 0, 0, -1]) == 'Coronal'
+    with pytest.raises(RuntimeError, match="Could not deduce the image orientation"):
+        cosine_to_orientation([0.4, 0.4, 0.4, 0.4, 0.4, 0.4])
+
+
+def test_cosines_to_orientations():
+    iops = [[0.9, -0.03, -0.1, 0.03, 0.9, 0.1],
+            [0.4, 0.4, 0.4, 0.4, 0.4, 0.4],
+            [0, 0.9, 0.1, 0.03, 0.1, -0.9],
+            [1, 0, 0, 0, 0, -1]]
+    orientations, errors = cosines_to_orientations(iops)
+    assert orientations == ['Axial', '', 'Sagittal', 'Coronal']
+    assert errors[0] is None and errors[2] is None and errors[3] is None
+    assert errors[1].startswith("Could not deduce the image orientation of [0.4, 0.4, 0.4, 0.4, 0.4, 0.4]")
+    assert cosines_to_orientations(np.empty((0, 6))) == ([], [])
+    with pytest.raises(ValueError):
+        cosines_to_orientations([[1, 0, 0]])
+
+
+def test_load_scans_index(tmp_path):
+    scans_file = tmp_path / "sub-01_ses-1_scans.tsv"
+    scans_file.write_text("filename\tacq_time\n"
+                          "anat/sub-01_ses-1_T1w.nii.gz\t2020-01-31T10:00:00\n"
+                          "func/sub-01_ses-1_task-rest_bold.nii.gz\t2020-02-01\n"
+                          "dwi/sub-01_ses-1_dwi.nii.gz\tn/a\n")
+    scans_index = load_scans_index(str(scans_file))
+    assert scans_index == {"anat/sub-01_ses-1_T1w.nii.gz": "01/31/2020",
+                           "func/sub-01_ses-1_task-rest_bold.nii.gz": "02/01/2020",
+                           "dwi/sub-01_ses-1_dwi.nii.gz": None}
+
+    anat = str(tmp_path / "anat" / "sub-01_ses-1_T1w.nii.gz")
+    assert lookup_scan_date(scans_index, str(scans_file), anat) == "01/31/2020"
+    with pytest.raises(Exception, match="no row with filename"):
+        lookup_scan_date(scans_index, str(scans_file), str(tmp_path / "anat" / "sub-01_ses-1_T2w.nii.gz"))
+    with pytest.raises(Exception, match="no valid acq_time"):
+        lookup_scan_date(scans_index, str(scans_file), str(tmp_path / "dwi" / "sub-01_ses-1_dwi.nii.gz"))
+
+
+def test_sidecar_resolver(tmp_path):
+    func = tmp_path / "sub-01" / "ses-1" / "func"
+    func.mkdir(parents=True)
+    (tmp_path / "task-rest_bold.json").write_text('{"TaskName": "rest", "EchoTime": 0.03}')
+    (tmp_path / "sub-01" / "ses-1" / "sub-01_ses-1_task-rest_bold.json").write_text('{"EchoTime": 0.02}')
+    (func / "sub-01_ses-1_task-rest_run-1_bold.json").write_text('{"FlipAngle": 90}')
+
+    resolver = SidecarResolver(str(tmp_path))
+    run1 = resolver.get_metadata(str(func / "sub-01_ses-1_task-rest_run-1_bold.nii.gz"))
+    assert run1 == {"TaskName": "rest", "EchoTime": 0.02, "FlipAngle": 90}
+    run2 = resolver.get_metadata(str(func / "sub-01_ses-1_task-rest_run-2_bold.nii"))
+    assert run2 == {"TaskName": "rest", "EchoTime": 0.02}
+    assert get_metadata_for_nifti(str(tmp_path), str(func / "sub-01_ses-1_task-rest_run-1_bold.nii.gz")) == run1
+
+
+def test_participants_index(tmp_path):
+    participants_file = tmp_path / "participants.tsv"
+    participants_file.write_text("participant_id\tsex\tage\n"
+                                 "sub-01\tM\t30\n"
+                                 "sub-02\tn/a\t25.5\n"
+                                 "sub-03\tF\tn/a\n"
+                                 "sub-04\tF\t40y\n"
+                                 "sub-06\t\t20\n"
+                                 "sub-07\tNA\t20\n"
+                                 "sub-08\tnan\t20\n")
+    participants = ParticipantsIndex(str(participants_file))
+    assert participants.participant_ids == ["sub-01", "sub-02", "sub-03", "sub-04", "sub-06", "sub-07", "sub-08"]
+    assert participants.fields("sub-01") == (360, "M")
+    # missing values as pandas.read_csv reads them
+    for participant_id in ["sub-02", "sub-06", "sub-07", "sub-08"]:
+        assert participants.fields(participant_id)[1] == ""
+    assert participants.fields("sub-02") == (306, "")
+    participants.check(["sub-01", "sub-02"])
+    with pytest.raises(Exception) as excinfo:
+        participants.check(["sub-01", "sub-03", "sub-04", "sub-05"])
+    message = str(excinfo.value)
+    assert "sub-03: age 'n/a' is not a number" in message
+    assert "sub-04: age '40y' is not a number" in message
+    assert "no row with participant_id = 'sub-05'" in message
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_iter_image03_records(tmp_path, jobs):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=1)
+
+    records = list(iter_image03_records(bids_root, guid_mapping, jobs=jobs))
+    assert len(records) == n_images
+    assert all(isinstance(record, Image03Record) for record in records)
+    assert [record['image_file'] for record in records] == sorted(record['image_file'] for record in records)
+    assert records[0]['subjectkey'] == 'NDAR_INV00000001'
+    assert all(record['data_file2'] == "" for record in records)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["bids", os.path.basename(guid_mapping)])
+
+    zip_directory = str(tmp_path / "zips")
+    guids = {'sub-0001': 'NDAR_INV00000001', '0002': 'NDAR_INV00000002'}
+    records = iter_image03_records(bids_root, guids, zip_directory=zip_directory, jobs=jobs)
+    bold = next(record for record in records if record['scan_type'] == 'fMRI')
+    assert bold['data_file2'] == os.path.join(zip_directory, "sub-0001_ses-1_task-rest_run-1_bold.metadata.zip")
+    assert os.path.exists(bold['data_file2'])
+
+
+def test_iter_image03_records_interleaved(tmp_path):
+    datasets = []
+    for name in ["a", "b"]:
+        bids_root = str(tmp_path / name)
+        guid_mapping, n_images = generate_dataset(bids_root, subjects=1, sessions=1, runs=1)
+        datasets.append((bids_root, {'sub-0001': 'NDAR_INV%s' % (name.upper() * 8)}))
+    with open(os.path.join(datasets[1][0], "sub-0001", "ses-1", "sub-0001_ses-1_scans.tsv")) as fp:
+        scans = fp.read()
+    with open(os.path.join(datasets[1][0], "sub-0001", "ses-1", "sub-0001_ses-1_scans.tsv"), "w") as fp:
+        fp.write(scans.replace("2020-01-02", "1999-01-02"))
+
+    expected = [list(iter_image03_records(bids_root, guids)) for bids_root, guids in datasets]
+    generators = [iter_image03_records(bids_root, guids) for bids_root, guids in datasets]
+    interleaved = [[], []]
+    for _ in range(n_images):
+        for records, generator in zip(interleaved, generators):
+            records.append(next(generator))
+    assert interleaved == expected
+    assert set(record['subjectkey'] for record in interleaved[0]) == {'NDAR_INVAAAAAAAA'}
+    assert set(record['interview_date'] for record in interleaved[1]) == {'01/02/1999'}
+
+
+def test_merge_partial_conversion(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=3, sessions=1, runs=1)
+    output_directory = str(tmp_path / "nda")
+    image03_file = os.path.join(output_directory, "image03.txt")
+    assert main.main([bids_root, guid_mapping, output_directory]) == 0
+    with open(image03_file) as fp:
+        content = fp.read()
+
+    # a corrected subject: a bold run removed
+    os.remove(os.path.join(bids_root, "sub-0002", "ses-1", "func", "sub-0002_ses-1_task-rest_run-1_bold.nii.gz"))
+    assert main.main([bids_root, guid_mapping, output_directory, "--participant-label", "0002", "--suffix", "bold",
+                      "--merge"]) == 0
+    with open(os.path.join(output_directory, "image03.partial.txt")) as fp:
+        assert len(fp.read().splitlines()) == 2
+    with open(image03_file) as fp:
+        merged = fp.read()
+    assert merged.splitlines() == [line for line in content.splitlines()
+                                   if "sub-0002_ses-1_task-rest_run-1_bold" not in line]
+
+    with pytest.raises(SystemExit):
+        main.main([bids_root, guid_mapping, output_directory, "--merge"])
+
+
+def test_failed_conversion_keeps_image03(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=1)
+    output_directory = str(tmp_path / "nda")
+    image03_file = os.path.join(output_directory, "image03.txt")
+    assert main.main([bids_root, guid_mapping, output_directory]) == 0
+    with open(image03_file) as fp:
+        content = fp.read()
+
+    # an image which can no longer be read fails the conversion
+    with open(os.path.join(bids_root, "sub-0002", "ses-1", "func", "sub-0002_ses-1_task-rest_run-1_bold.nii.gz"),
+              "wb") as fp:
+        fp.write(b"not a nifti file")
+    assert main.main([bids_root, guid_mapping, output_directory]) == 1
+    with open(image03_file) as fp:
+        assert fp.read() == content
+    assert not [name for name in os.listdir(output_directory) if name.endswith(main.IN_PROGRESS_SUFFIX)]
+
 
+def test_prefetch(tmp_path, monkeypatch):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=2)
+    expected = list(iter_image03_records(bids_root, guid_mapping, zip_directory=str(tmp_path / "zips")))
+    prefetched = list(iter_image03_records(bids_root, guid_mapping, zip_directory=str(tmp_path / "zips"),
+                                           prefetch=3))
+    assert prefetched == expected
 
+    monkeypatch.setattr(main, "load_image_inputs", lambda context, file: file)
+    prefetcher = Prefetcher(argparse.Namespace(profiler=NullProfiler()), depth=2)
+    submitted = []
+    submit = prefetcher._executor.submit
+    monkeypatch.setattr(prefetcher._executor, "submit",
+                        lambda func, context, file: submitted.append(file) or submit(func, context, file))
+    files = iter(prefetcher("abcdef"))
+    assert next(files)[1].result() == "a"
+    # the current image and at most `depth` upcoming ones are read
+    assert submitted == ["a", "b", "c"]
+    assert [future.result() for _, future in files] == list("bcdef")
+    prefetcher.close()
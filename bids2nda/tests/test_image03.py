@@ -0,0 +1,89 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from ..image03 import (IMAGE03_COLUMNS, Image03Record, Image03Writer, merge_image03, read_image03,
+                       replace_image03_rows)
+
+
+def test_image03_writer(tmp_path):
+    path = str(tmp_path / "image03.txt")
+    with Image03Writer(path) as writer:
+        writer.write({'subjectkey': 'NDAR_INV0001', 'image_resolution1': np.float32(1.1),
+                      'image_extent4': '', 'slice_timing': [0.0, 0.5]})
+    lines = open(path).read().split("\n")
+    assert lines[0] == '"image"\t"3"'
+    assert lines[1].split("\t") == ['"%s"' % column for column in IMAGE03_COLUMNS]
+    row = dict(zip(IMAGE03_COLUMNS, lines[2].split("\t")))
+    assert row['subjectkey'] == '"NDAR_INV0001"'
+    assert row['image_resolution1'] == '"1.1"'
+    assert row['slice_timing'] == '"[0.0, 0.5]"'
+    assert row['type_of_microscopy'] == '""'
+    assert lines[3:] == ['']
+
+
+def test_image03_record():
+    record = Image03Record(subjectkey='NDAR_INV0001')
+    record['image_file'] = 'sub-01_T1w.nii.gz'
+    assert record.keys() == ['subjectkey', 'image_file']
+    assert record['image_file'] == record.image_file == 'sub-01_T1w.nii.gz'
+    assert 'scan_type' not in record and record.get('scan_type', '') == ''
+    with pytest.raises(KeyError):
+        record['scan_type']
+    with pytest.raises(KeyError):
+        record['not_a_column'] = 1
+    assert not hasattr(record, '__dict__')
+
+    copy = pickle.loads(pickle.dumps(record))
+    assert copy == record and copy.as_dict() == record.as_dict()
+    copy.update({'subjectkey': 'NDAR_INV0002'})
+    assert copy != record
+
+    row = record.as_row()
+    assert len(row) == len(IMAGE03_COLUMNS)
+    assert row[:IMAGE03_COLUMNS.index('image_file') + 1] == ['NDAR_INV0001', '', '', '', '', 'sub-01_T1w.nii.gz']
+
+
+def test_merge_image03(tmp_path):
+    part1, part2, merged = (str(tmp_path / name) for name in ["part1.txt", "part2.txt", "image03.txt"])
+    with Image03Writer(part1) as writer:
+        writer.write({'image_file': 'b.nii.gz', 'scan_type': 'old'})
+        writer.write({'image_file': 'c.nii.gz', 'slice_timing': 'a\tb "quoted"'})
+    with Image03Writer(part2) as writer:
+        writer.write({'image_file': 'a.nii.gz'})
+        writer.write({'image_file': 'b.nii.gz', 'scan_type': 'new'})
+
+    assert merge_image03([part1, part2], merged) == 3
+    records = list(read_image03(merged))
+    assert [record['image_file'] for record in records] == ['a.nii.gz', 'b.nii.gz', 'c.nii.gz']
+    assert records[1]['scan_type'] == 'new'
+    assert records[2]['slice_timing'] == 'a\tb "quoted"'
+    assert records[0]['type_of_microscopy'] == ''
+
+    # merging is deterministic and merging into one of the inputs works
+    content = open(merged).read()
+    assert merge_image03([merged, part1, part2], merged) == 3
+    assert open(merged).read() == content
+
+    with open(part1, "w") as fp:
+        fp.write("not an image03 file\n")
+    with pytest.raises(ValueError, match="not an image03 file"):
+        list(read_image03(part1))
+
+
+def test_replace_image03_rows(tmp_path):
+    path = str(tmp_path / "image03.txt")
+    assert replace_image03_rows(path, [{'image_file': 'sub-02_T1w.nii.gz'}], lambda image_file: True) == (0, 1)
+    with Image03Writer(path) as writer:
+        for image_file in ['sub-01_T1w.nii.gz', 'sub-02_T1w.nii.gz', 'sub-02_bold.nii.gz', 'sub-03_T1w.nii.gz']:
+            writer.write({'image_file': image_file, 'scan_type': 'old'})
+
+    # sub-02_bold.nii.gz is gone, sub-02_dwi.nii.gz is new
+    new = [{'image_file': 'sub-02_dwi.nii.gz', 'scan_type': 'new'},
+           {'image_file': 'sub-02_T1w.nii.gz', 'scan_type': 'new'}]
+    assert replace_image03_rows(path, new, lambda image_file: image_file.startswith('sub-02_')) == (2, 4)
+    records = list(read_image03(path))
+    assert [(record['image_file'], record['scan_type']) for record in records] == [
+        ('sub-01_T1w.nii.gz', 'old'), ('sub-02_T1w.nii.gz', 'new'), ('sub-02_dwi.nii.gz', 'new'),
+        ('sub-03_T1w.nii.gz', 'old')]
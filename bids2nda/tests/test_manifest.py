@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+
+from ..benchmark import generate_dataset
+from ..image03 import Image03Record, read_image03
+from ..main import main
+from ..manifest import DigestCache, file_md5, ManifestStage
+
+
+def test_file_md5(tmp_path):
+    path = str(tmp_path / "data.bin")
+    data = os.urandom(10000)
+    with open(path, "wb") as fp:
+        fp.write(data)
+    assert file_md5(path, chunk_size=1000) == hashlib.md5(data).hexdigest()
+
+
+def test_digest_cache(tmp_path):
+    path = str(tmp_path / "data.bin")
+    with open(path, "wb") as fp:
+        fp.write(b"abc")
+    cache_file = str(tmp_path / "digests.pkl")
+    digests = DigestCache(cache_file)
+    assert digests.md5(path) == (3, hashlib.md5(b"abc").hexdigest())
+    digests.save()
+
+    digests = DigestCache(cache_file)
+    assert digests.md5(path) == (3, hashlib.md5(b"abc").hexdigest())
+    assert digests.hashed == 0
+    with open(path, "wb") as fp:
+        fp.write(b"abcd")
+    assert digests.md5(path) == (4, hashlib.md5(b"abcd").hexdigest())
+    assert digests.hashed == 1
+
+
+def test_manifest_stage(tmp_path):
+    records = []
+    for i in range(20):
+        image_file = str(tmp_path / ("sub-%02d_T1w.nii.gz" % i))
+        with open(image_file, "wb") as fp:
+            fp.write(b"%d" % i)
+        records.append(Image03Record(image_file=image_file, data_file2="", bvecfile=""))
+
+    stage = ManifestStage(str(tmp_path), threads=3, depth=4)
+    try:
+        output = list(stage(iter(records)))
+    finally:
+        stage.close()
+    assert [record['image_file'] for record in output] == [record['image_file'] for record in records]
+    assert all(not record.get('manifest') for record in records)
+    assert stage.files == set(record['image_file'] for record in records)
+
+    with open(output[3]['manifest']) as fp:
+        manifest = json.load(fp)
+    assert output[3]['manifest'] == str(tmp_path / "sub-03_T1w.manifest.json")
+    assert manifest == {"files": [{"path": records[3]['image_file'], "name": "sub-03_T1w.nii.gz", "size": 1,
+                                   "md5sum": hashlib.md5(b"3").hexdigest()}]}
+
+
+def test_incremental_without_manifest(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=1, sessions=1, runs=1)
+    output_directory = str(tmp_path / "nda")
+    image03_file = os.path.join(output_directory, "image03.txt")
+
+    assert main([bids_root, guid_mapping, output_directory, "--incremental", "--manifest"]) == 0
+    assert all(record['manifest'] for record in read_image03(image03_file))
+    # the records cached by the --manifest run have no manifest
+    assert main([bids_root, guid_mapping, output_directory, "--incremental"]) == 0
+    assert [record['manifest'] for record in read_image03(image03_file)] == [""] * n_images
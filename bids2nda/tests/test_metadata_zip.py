@@ -0,0 +1,40 @@
+import os
+import zipfile
+
+import pytest
+
+from ..metadata_zip import parse_zip_compression, write_metadata_zip
+
+
+def test_write_metadata_zip(tmp_path):
+    zip_path = str(tmp_path / "sub-01_task-rest_bold.metadata.zip")
+    members = [("sub-01_task-rest_bold.json", b'{"TaskName": "rest"}'),
+               ("sub-01_task-rest_events.tsv", b"onset\tduration\n")]
+
+    assert write_metadata_zip(zip_path, members)
+    content = open(zip_path, "rb").read()
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert zipf.namelist() == [arcname for arcname, _ in members]
+        assert zipf.read("sub-01_task-rest_bold.json") == members[0][1]
+        assert zipf.getinfo("sub-01_task-rest_bold.json").compress_type == zipfile.ZIP_DEFLATED
+
+    # identical payload: archive is left untouched
+    os.utime(zip_path, (0, 0))
+    assert not write_metadata_zip(zip_path, members)
+    assert os.stat(zip_path).st_mtime == 0
+
+    # rewritten archives are byte-identical
+    os.remove(zip_path)
+    assert write_metadata_zip(zip_path, members)
+    assert open(zip_path, "rb").read() == content
+
+    assert write_metadata_zip(zip_path, members, "stored")
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert zipf.getinfo("sub-01_task-rest_bold.json").compress_type == zipfile.ZIP_STORED
+
+
+def test_parse_zip_compression():
+    assert parse_zip_compression("stored") == (zipfile.ZIP_STORED, None)
+    assert parse_zip_compression("deflate-9") == (zipfile.ZIP_DEFLATED, 9)
+    with pytest.raises(ValueError):
+        parse_zip_compression("deflate-10")
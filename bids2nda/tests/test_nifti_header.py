@@ -0,0 +1,50 @@
+import nibabel as nb
+import numpy as np
+import pytest
+
+from ..nifti_header import parse_nifti_header, read_nifti_header
+
+
+@pytest.mark.parametrize("image_class", [nb.Nifti1Image, nb.Nifti2Image])
+@pytest.mark.parametrize("fname", ["img.nii.gz", "img.nii"])
+def test_read_nifti_header_matches_nibabel(tmp_path, image_class, fname):
+    img = image_class(np.zeros((4, 5, 6, 3), dtype=np.uint8), np.eye(4))
+    img.header.set_zooms((1.2, 1.5, 2.0, 2000.))
+    img.header.set_xyzt_units("mm", "msec")
+    path = str(tmp_path / fname)
+    nb.save(img, path)
+
+    nii = nb.load(path)
+    record = read_nifti_header(path)
+    assert record.shape == nii.shape
+    assert record.zooms == nii.header.get_zooms()
+    assert [type(z) for z in record.zooms] == [type(z) for z in nii.header.get_zooms()]
+    assert record.xyzt_units == nii.header.get_xyzt_units()
+
+
+def test_parse_nifti_header_big_endian():
+    hdr = nb.Nifti1Header(endianness=">")
+    hdr.set_data_shape((2, 3, 4))
+    hdr.set_zooms((1., 2., 3.))
+    hdr.set_xyzt_units("mm", "sec")
+    record = parse_nifti_header(hdr.binaryblock)
+    assert record.shape == (2, 3, 4)
+    assert record.zooms == (1., 2., 3.)
+    assert record.xyzt_units == ("mm", "sec")
+
+
+@pytest.mark.parametrize("image_class", [nb.Nifti1Image, nb.Nifti2Image])
+def test_read_nifti_header_negative_pixdims(tmp_path, image_class):
+    img = image_class(np.zeros((4, 5, 6, 3), dtype=np.uint8), np.eye(4))
+    img.header['pixdim'][1:5] = [-1.5, 2.0, -3.0, 2.5]
+    path = str(tmp_path / "img.nii")
+    nb.save(img, path)
+
+    record = read_nifti_header(path)
+    assert record.zooms == nb.load(path).header.get_zooms()
+    assert record.zooms == (1.5, 2.0, 3.0, 2.5)
+
+
+def test_parse_nifti_header_rejects_unknown():
+    assert parse_nifti_header(b"") is None
+    assert parse_nifti_header(b"\x00" * 348) is None
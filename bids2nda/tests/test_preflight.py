@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from ..benchmark import generate_dataset
+from ..guid_mapping import load_guid_mapping
+from ..main import ConversionContext, ParticipantsIndex
+from ..preflight import preflight, PreflightError, preflight_problems
+
+
+def test_preflight(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, _ = generate_dataset(bids_root, subjects=3, sessions=1, runs=1)
+
+    def problems():
+        context = ConversionContext(bids_root, None, load_guid_mapping(guid_mapping),
+                                    ParticipantsIndex(os.path.join(bids_root, "participants.tsv")))
+        return [(os.path.basename(file), message)
+                for file, message in preflight_problems(context, context.index.nifti_files())]
+
+    assert problems() == []
+
+    with open(guid_mapping) as fp:
+        lines = fp.read().splitlines()
+    with open(guid_mapping, "w") as fp:
+        fp.write("\n".join(lines[:2]) + "\n")
+    with open(os.path.join(bids_root, "task-rest_bold.json"), "w") as fp:
+        json.dump({"RepetitionTime": 2.0}, fp)
+    with open(os.path.join(bids_root, "sub-0001", "ses-1", "anat", "sub-0001_ses-1_T1w.json"), "w") as fp:
+        json.dump({"ImageOrientationPatientDICOM": [0.4] * 6}, fp)
+    scans_file = os.path.join(bids_root, "sub-0002", "ses-1", "sub-0002_ses-1_scans.tsv")
+    with open(scans_file) as fp:
+        scans = fp.read().splitlines()
+    with open(scans_file, "w") as fp:
+        fp.write("\n".join(line for line in scans if "dwi" not in line) + "\n")
+    os.remove(os.path.join(bids_root, "sub-0003", "ses-1", "sub-0003_ses-1_scans.tsv"))
+
+    found = problems()
+    messages = "\n".join("%s: %s" % problem for problem in found)
+    assert len([message for _, message in found if "without TaskName" in message]) == 3
+    assert "sub-0001_ses-1_T1w.nii.gz: Could not deduce the image orientation" in messages
+    assert "sub-0002_ses-1_dwi.nii.gz: %s has no row with filename" % scans_file in messages
+    assert "sub-0003_ses-1_T1w.nii.gz: sub-0003 is not in the GUID mapping" in messages
+    assert "sub-0003_ses-1_scans.tsv not found" in messages
+
+    context = ConversionContext(bids_root, None, load_guid_mapping(guid_mapping),
+                                ParticipantsIndex(os.path.join(bids_root, "participants.tsv")))
+    with pytest.raises(PreflightError) as excinfo:
+        preflight(context, context.index.nifti_files())
+    assert len(excinfo.value.problems) == len(found)
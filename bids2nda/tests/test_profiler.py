@@ -0,0 +1,48 @@
+import argparse
+import builtins
+import json
+import os
+
+from ..benchmark import generate_dataset
+from ..main import run
+from ..profiler import PROFILE_FILENAME
+
+
+def test_run_profile(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=2)
+    output_directory = str(tmp_path / "nda")
+    open_before = builtins.open
+    run(argparse.Namespace(bids_directory=bids_root, guid_mapping=guid_mapping,
+                           output_directory=output_directory, strictness='strict',
+                           profile=True, profile_top=3))
+    assert builtins.open is open_before
+
+    with open(os.path.join(output_directory, PROFILE_FILENAME)) as fp:
+        profile = json.load(fp)
+    summary = profile["summary"]
+    assert summary["images"] == n_images
+    for stage in ("discovery", "sidecars", "scans", "header", "zip", "output"):
+        assert stage in summary["stages"]
+    assert summary["stages"]["header"]["calls"] == n_images
+    assert summary["fs"]["open"] > 0
+    assert len(profile["files"]) == n_images
+    assert len(profile["slowest"]) == 3
+    assert profile["slowest"][0]["seconds"] >= profile["slowest"][-1]["seconds"]
+
+
+def test_run_profile_prefetch(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=2)
+    output_directory = str(tmp_path / "nda")
+    run(argparse.Namespace(bids_directory=bids_root, guid_mapping=guid_mapping,
+                           output_directory=output_directory, strictness='strict',
+                           profile=True, prefetch=4))
+
+    with open(os.path.join(output_directory, PROFILE_FILENAME)) as fp:
+        profile = json.load(fp)
+    assert profile["summary"]["stages"]["header"]["calls"] == n_images
+    # the reads done by the prefetch threads are recorded for their own image
+    for entry in profile["files"]:
+        assert set(["sidecars", "header", "prefetch_wait", "zip"]) <= set(entry["stages"]), entry["file"]
+        assert entry["fs"]["open"] > 0
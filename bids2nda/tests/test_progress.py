@@ -0,0 +1,59 @@
+import io
+import json
+import os
+
+from ..benchmark import generate_dataset
+from ..main import main
+from ..progress import Progress
+
+
+def _events(text):
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def test_progress_events(tmp_path):
+    zip_file = str(tmp_path / "a.metadata.zip")
+    with open(zip_file, "wb") as fp:
+        fp.write(b"x" * 100)
+    events = io.StringIO()
+    progress = Progress(events=events, interval=0)
+    progress.discovered(3)
+    for name in ["a", "b", "c"]:
+        progress.update({'image_file': name, 'data_file2': zip_file if name == "a" else ""})
+    progress.finish()
+
+    events = _events(events.getvalue())
+    assert [event["event"] for event in events] == ["discovered", "progress", "progress", "progress", "done"]
+    assert events[-1]["completed"] == 3 and events[-1]["total"] == 3
+    assert events[-1]["file"] == "c"
+    assert events[-1]["zip_bytes"] == 100
+    assert events[-1]["eta_seconds"] in (0.0, None)
+
+
+def test_progress_is_rate_limited():
+    events = io.StringIO()
+    bar = io.StringIO()
+    progress = Progress(events=events, bar=bar, interval=3600)
+    progress.discovered(1000)
+    for number in range(1000):
+        progress.update({'image_file': str(number), 'data_file2': ""})
+    progress.finish()
+    assert [event["event"] for event in _events(events.getvalue())] == ["discovered", "done"]
+    assert bar.getvalue().startswith("\r[########################] 1000/1000 100%")
+    assert bar.getvalue().endswith("\n")
+
+
+def test_progress_file(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=1)
+    progress_file = str(tmp_path / "progress.jsonl")
+    assert main([bids_root, guid_mapping, str(tmp_path / "nda"), "--progress-file", progress_file,
+                 "--progress-interval", "0"]) == 0
+    with open(progress_file) as fp:
+        events = _events(fp.read())
+    assert events[0] == {"event": "discovered", "total": n_images, "elapsed": events[0]["elapsed"]}
+    assert len(events) == n_images + 2
+    assert events[-1]["event"] == "done"
+    zips = [os.path.join(str(tmp_path / "nda"), name) for name in os.listdir(str(tmp_path / "nda"))
+            if name.endswith(".metadata.zip")]
+    assert events[-1]["zip_bytes"] == sum(os.path.getsize(name) for name in zips)
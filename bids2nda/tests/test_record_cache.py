@@ -0,0 +1,53 @@
+import os
+import zipfile
+from collections import OrderedDict
+
+from ..benchmark import generate_dataset
+from ..main import main
+from ..record_cache import fingerprint, RecordCache
+
+
+def test_record_cache_roundtrip(tmp_path):
+    nifti = tmp_path / "sub-01_T1w.nii.gz"
+    nifti.write_bytes(b"data")
+    cache_file = str(tmp_path / "cache.pkl")
+    inputs = fingerprint([str(nifti), str(tmp_path / "sub-01_T1w.json")])
+    assert inputs[1][1:] == (None, None)
+
+    cache = RecordCache(cache_file)
+    cache.add(str(nifti), inputs, OrderedDict([("image_file", str(nifti))]))
+    cache.add("gone.nii.gz", inputs, OrderedDict())
+    cache.close()
+
+    # simulate a run interrupted while appending an entry
+    with open(cache_file, "ab") as fp:
+        fp.write(b"\x80\x05garbage")
+
+    cache = RecordCache(cache_file)
+    assert len(cache) == 2
+    assert cache.lookup(str(nifti), inputs) == OrderedDict([("image_file", str(nifti))])
+    nifti.write_bytes(b"new data")
+    assert cache.lookup(str(nifti), fingerprint([str(nifti), str(tmp_path / "sub-01_T1w.json")])) is None
+
+    cache.compact([str(nifti)])
+    assert len(RecordCache(cache_file)) == 1
+
+
+def test_incremental_zip_options(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=1, sessions=1, runs=1)
+    output_directory = str(tmp_path / "nda")
+
+    def compressions():
+        result = set()
+        for name in os.listdir(output_directory):
+            if name.endswith(".metadata.zip"):
+                with zipfile.ZipFile(os.path.join(output_directory, name)) as zf:
+                    result.update(info.compress_type for info in zf.infolist())
+        return result
+
+    assert main([bids_root, guid_mapping, output_directory, "--incremental"]) == 0
+    assert compressions() == {zipfile.ZIP_DEFLATED}
+    # cached records are not reused with other zip options
+    assert main([bids_root, guid_mapping, output_directory, "--incremental", "--zip-compression", "stored"]) == 0
+    assert compressions() == {zipfile.ZIP_STORED}
@@ -0,0 +1,63 @@
+import os
+import shutil
+
+from ..benchmark import generate_dataset
+from ..image03 import read_image03
+from ..watch import Watcher
+
+
+def test_watcher(tmp_path):
+    bids_root = str(tmp_path / "bids")
+    guid_mapping, n_images = generate_dataset(bids_root, subjects=2, sessions=1, runs=1)
+    output_directory = str(tmp_path / "nda")
+    image03_file = os.path.join(output_directory, "image03.txt")
+
+    watcher = Watcher(bids_root, guid_mapping, output_directory)
+    assert watcher.poll() == (n_images, 0, [])
+    assert len(list(read_image03(image03_file))) == n_images
+    mtime = os.stat(image03_file).st_mtime_ns
+    assert watcher.poll() == (0, 0, [])
+    assert os.stat(image03_file).st_mtime_ns == mtime
+
+    # a new session lands, its scans.tsv last
+    session = os.path.join(bids_root, "sub-0001", "ses-1")
+    new_session = os.path.join(bids_root, "sub-0001", "ses-2")
+    shutil.copytree(session, new_session)
+    for dirpath, _, filenames in os.walk(new_session):
+        for filename in filenames:
+            os.rename(os.path.join(dirpath, filename), os.path.join(dirpath, filename.replace("ses-1", "ses-2")))
+    scans_file = os.path.join(new_session, "sub-0001_ses-2_scans.tsv")
+    os.rename(scans_file, scans_file + ".partial")
+    converted, removed, failed = watcher.poll()
+    assert (converted, removed) == (0, 0) and len(failed) == 3
+    assert "scans.tsv not found" in str(failed[0][1])
+
+    with open(scans_file + ".partial") as fp:
+        scans = fp.read().replace("ses-1", "ses-2")
+    with open(scans_file, "w") as fp:
+        fp.write(scans)
+    assert watcher.poll() == (3, 0, [])
+    records = list(read_image03(image03_file))
+    assert len(records) == n_images + 3
+    assert sum(record['visit'] == '2' for record in records) == 3
+
+    shutil.rmtree(new_session)
+    assert watcher.poll() == (0, 3, [])
+    assert len(list(read_image03(image03_file))) == n_images
+    watcher.close()
+
+    # a restarted watcher reuses the records of the cache
+    watcher = Watcher(bids_root, guid_mapping, output_directory)
+    assert watcher.poll() == (0, 0, [])
+    assert len(list(read_image03(image03_file))) == n_images
+    watcher.close()
+
+    # a watcher whose first poll fails keeps the cache
+    os.rename(guid_mapping, guid_mapping + ".moved")
+    watcher = Watcher(bids_root, guid_mapping, output_directory)
+    watcher.run(interval=0, max_polls=1)
+    os.rename(guid_mapping + ".moved", guid_mapping)
+    watcher = Watcher(bids_root, guid_mapping, output_directory)
+    assert len(watcher.cache) == n_images
+    assert watcher.poll() == (0, 0, [])
+    watcher.close()
@@ -0,0 +1,189 @@
+"""Keep the image03 table of a growing BIDS dataset up to date (``bids2nda watch``)
+
+A Watcher polls the dataset: every poll lists the tree again (one
+``os.scandir`` pass, see BIDSIndex) and compares the size and modification
+time of the input files of every image with those of its current record.
+Only new and changed images are converted, records of images which are
+gone are dropped, and image03.txt is then rewritten atomically.
+
+State is kept between polls: parsed sidecars (re-read only when modified),
+scans.tsv indexes, participants.tsv and the GUID mapping (reloaded only when
+they change).  Records and fingerprints are also saved in the record cache
+of the output directory, so that a restarted watcher does not convert the
+whole dataset again.
+
+Images which cannot be converted yet, e.g. because the session is still
+being copied and its scans.tsv is missing, are reported and retried on the
+next poll.
+"""
+from __future__ import print_function
+import os
+import time
+
+from .bids_index import BIDSIndex
+from .guid_mapping import load_guid_mapping
+from .image03 import write_image03
+from .main import (check_guid_mapping, ConversionContext, image03_record, image_fingerprint, ParticipantsIndex,
+                   SidecarResolver, subject_fields)
+from .metadata_zip import DEFAULT_ZIP_COMPRESSION
+from .record_cache import CACHE_FILENAME, fingerprint, RecordCache
+
+DEFAULT_INTERVAL = 30.0
+
+
+class Watcher(object):
+    """Incrementally maintained image03 table of a BIDS dataset, see poll()"""
+
+    def __init__(self, bids_directory, guid_mapping_file, output_directory, strictness='strict',
+                 zip_compression=DEFAULT_ZIP_COMPRESSION):
+        self.bids_directory = bids_directory
+        self.guid_mapping_file = guid_mapping_file
+        self.output_directory = output_directory
+        self.image03_file = os.path.join(output_directory, "image03.txt")
+        self.strictness = strictness
+        self.zip_compression = zip_compression
+        self.participants_file = os.path.join(bids_directory, "participants.tsv")
+
+        self.guid_mapping = None
+        self.participants = None
+        self._guid_mapping_fingerprint = None
+        self._participants_fingerprint = None
+        self.sidecar_resolver = SidecarResolver(bids_directory)
+        # scans.tsv path -> (fingerprint, scans index)
+        self._scans = {}
+        # image file -> record and fingerprint of its input files
+        self.records = {}
+        self.inputs = {}
+        # whether self.records reflects the dataset, i.e. a poll completed
+        self.polled = False
+
+        os.makedirs(output_directory, exist_ok=True)
+        self.cache = RecordCache(os.path.join(output_directory, CACHE_FILENAME))
+
+    def _reload_subjects(self):
+        """Reload the GUID mapping and participants.tsv if they changed; return True if they did"""
+        guid_mapping_fingerprint = fingerprint([self.guid_mapping_file])
+        participants_fingerprint = fingerprint([self.participants_file])
+        if (guid_mapping_fingerprint == self._guid_mapping_fingerprint
+                and participants_fingerprint == self._participants_fingerprint):
+            return False
+
+        guid_mapping = load_guid_mapping(self.guid_mapping_file, cache_directory=self.output_directory)
+        participants = ParticipantsIndex(self.participants_file)
+        check_guid_mapping(participants, guid_mapping, self.strictness)
+        self.guid_mapping, self.participants = guid_mapping, participants
+        self._guid_mapping_fingerprint = guid_mapping_fingerprint
+        self._participants_fingerprint = participants_fingerprint
+        return True
+
+    def _context(self, index):
+        context = ConversionContext(self.bids_directory, self.output_directory, self.guid_mapping,
+                                    self.participants, zip_compression=self.zip_compression, index=index)
+        # keep parsed sidecars, and the scans.tsv files which did not change
+        self.sidecar_resolver.index = index
+        self.sidecar_resolver.invalidate()
+        context.sidecar_resolver = self.sidecar_resolver
+        for scans_file, (scans_fingerprint, scans_index) in self._scans.items():
+            if fingerprint([scans_file], index.exists) == scans_fingerprint:
+                context.scans_indexes[scans_file] = scans_index
+        return context
+
+    def _convert(self, context, file):
+        entities = context.entities(file)
+        scans_file = context.scans_file(entities['sub'], entities.get('ses'))
+        if not context.exists(scans_file):
+            raise Exception("%s not found" % scans_file)
+        record = image03_record(context, file)
+        if scans_file not in self._scans:
+            self._scans[scans_file] = (fingerprint([scans_file]), context.scans_index(scans_file))
+        return record
+
+    def poll(self):
+        """Bring image03.txt up to date with the dataset
+
+        Returns (number of images converted, number of images removed,
+        list of (image, error) for the images which could not be converted).
+        """
+        subjects_changed = self._reload_subjects()
+        index = BIDSIndex(self.bids_directory)
+        context = self._context(index)
+        nifti_files = index.nifti_files()
+
+        removed = [file for file in self.records if not index.exists(file)]
+        for file in removed:
+            del self.records[file]
+            del self.inputs[file]
+        # scans.tsv files may change while a session is being added
+        for scans_file in list(self._scans):
+            if fingerprint([scans_file], index.exists) != self._scans[scans_file][0]:
+                del self._scans[scans_file]
+
+        converted = []
+        failed = []
+        restored = False
+        for file in nifti_files:
+            inputs = image_fingerprint(context, file)
+            if self.inputs.get(file) == inputs:
+                if subjects_changed:
+                    try:
+                        self.records[file].update(subject_fields(context, file))
+                    except Exception as e:
+                        failed.append((file, e))
+                        del self.records[file], self.inputs[file]
+                continue
+            record = self.cache.lookup(file, inputs)
+            if record is not None and (not record['data_file2'] or os.path.exists(record['data_file2'])):
+                record = record.copy()
+                try:
+                    record.update(subject_fields(context, file))
+                except Exception as e:
+                    failed.append((file, e))
+                    continue
+                restored = True
+            else:
+                try:
+                    record = self._convert(context, file)
+                except Exception as e:
+                    failed.append((file, e))
+                    continue
+                self.cache.add(file, inputs, record)
+                converted.append(file)
+            self.records[file] = record
+            self.inputs[file] = inputs
+
+        if converted or removed or restored or subjects_changed or not os.path.exists(self.image03_file):
+            write_image03(self.image03_file, (self.records[file] for file in sorted(self.records)))
+        self.polled = True
+        return len(converted), len(removed), failed
+
+    def close(self):
+        self.cache.close()
+        # drop entries of images which are gone from the dataset; without a
+        # completed poll the records are not known, keep the cache whole
+        if self.polled:
+            self.cache.compact(self.records)
+
+    def run(self, interval=DEFAULT_INTERVAL, max_polls=None):
+        """Poll every `interval` seconds, forever or `max_polls` times, reporting what changed"""
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                start = time.time()
+                try:
+                    converted, removed, failed = self.poll()
+                except Exception as e:
+                    print("%s: poll failed, retrying in %gs: %s" % (time.strftime("%H:%M:%S"), interval, e))
+                else:
+                    if converted or removed or failed:
+                        print("%s: %d images converted, %d removed, %d rows in %s"
+                              % (time.strftime("%H:%M:%S"), converted, removed, len(self.records),
+                                 self.image03_file))
+                    for file, error in failed:
+                        print("  not converted yet (retrying on next poll): %s: %s" % (file, error))
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    time.sleep(max(0.0, interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
@@ -50,9 +50,13 @@ setup(
     # List run-time dependencies here.  These will be installed by pip when your
     # project is installed.
     install_requires = ["future",
-                        "pandas",
                         'nibabel'],
 
+    # Optional dependencies, e.g. pip install bids2nda[parquet]
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
+
     include_package_data=True,
 
     # To provide executable scripts, use entry points in preference to the